@@ -0,0 +1,157 @@
+import logging
+import os
+import pickle
+import queue
+import threading
+import zipfile
+from collections import deque
+from typing import Any, Optional
+
+import stable_baselines3 as sb3
+import torch as th
+from stable_baselines3.common.callbacks import CheckpointCallback
+from stable_baselines3.common.save_util import data_to_json, recursive_getattr
+from stable_baselines3.common.utils import get_system_info
+
+logger = logging.getLogger(__name__)
+
+
+def clone_to_cpu(value: Any) -> Any:
+    """Deep copy of a state dict (or any nesting of dicts, lists and tensors) with the tensors moved to CPU."""
+    if isinstance(value, th.Tensor):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return type(value)((key, clone_to_cpu(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(clone_to_cpu(item) for item in value)
+    return value
+
+
+class AsyncCheckpointCallback(CheckpointCallback):
+    """
+    CheckpointCallback that writes checkpoints on a background thread.
+
+    On the training thread a checkpoint only copies the policy and optimizer state
+    dicts to CPU memory and serializes the (small) non-tensor attributes, the
+    VecNormalize statistics and the replay buffer to bytes. `torch.save`,
+    compression and the file writes happen on the writer thread, and each file is
+    written to a temporary name and renamed once complete. Saved models load with
+    the usual `PPO.load`.
+
+    :param max_pending: snapshots waiting for the writer; further checkpoints are skipped until one is written
+    :param keep_last: keep only the files of the last `keep_last` checkpoints, None keeps all
+    :param compress: deflate the model zip archives (weights compress poorly, so this mostly costs writer time)
+    """
+
+    def __init__(self, save_freq: int, save_path: str, name_prefix: str = "rl_model", save_replay_buffer: bool = False,
+                 save_vecnormalize: bool = False, max_pending: int = 2, keep_last: Optional[int] = None,
+                 compress: bool = False, verbose: int = 0):
+        super().__init__(save_freq, save_path, name_prefix, save_replay_buffer, save_vecnormalize, verbose)
+        self.max_pending = max_pending
+        self.keep_last = keep_last
+        self.compress = compress
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.written = deque()
+        self.skipped = 0
+        self.writer = None
+
+    def _init_callback(self) -> None:
+        super()._init_callback()
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+            self.writer.start()
+
+    def _on_step(self) -> bool:
+        if self.n_calls % self.save_freq != 0:
+            return True
+        if self.queue.full():
+            self.skipped += 1
+            logger.warning(f"{self.max_pending} checkpoints still being written, skipping the one at {self.num_timesteps} steps")
+            return True
+        self.queue.put(self._snapshot())
+        return True
+
+    def _on_training_end(self) -> None:
+        self.flush()
+
+    def _snapshot(self) -> dict:
+        """Copy everything a checkpoint needs, so that training can go on while it is written."""
+        model = self.model
+        data = model.__dict__.copy()
+        exclude = set(model._excluded_save_params())
+        state_dicts_names, torch_variable_names = model._get_torch_save_params()
+        for name in state_dicts_names + torch_variable_names:
+            exclude.add(name.split(".")[0])
+        for name in exclude:
+            data.pop(name, None)
+
+        snapshot = {
+            "model_path": self._checkpoint_path(extension="zip"),
+            "data": data_to_json(data),
+            "params": clone_to_cpu(model.get_parameters()),
+            "pytorch_variables": {name: clone_to_cpu(recursive_getattr(model, name))
+                                  for name in torch_variable_names},
+            "pickles": [],
+        }
+        if self.save_replay_buffer and getattr(model, "replay_buffer", None) is not None:
+            snapshot["pickles"].append((self._checkpoint_path("replay_buffer_", extension="pkl"),
+                                        pickle.dumps(model.replay_buffer)))
+        vec_normalize = model.get_vec_normalize_env()
+        if self.save_vecnormalize and vec_normalize is not None:
+            snapshot["pickles"].append((self._checkpoint_path("vecnormalize_", extension="pkl"), pickle.dumps(vec_normalize)))
+        return snapshot
+
+    def _run(self):
+        while True:
+            snapshot = self.queue.get()
+            try:
+                if snapshot is None:
+                    return
+                self._write(snapshot)
+            except Exception:
+                logger.exception("failed to write checkpoint")
+            finally:
+                self.queue.task_done()
+
+    def _write(self, snapshot: dict):
+        paths = [snapshot["model_path"]]
+        compression = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+        tmp_path = snapshot["model_path"] + ".tmp"
+        with zipfile.ZipFile(tmp_path, mode="w", compression=compression) as archive:
+            archive.writestr("data", snapshot["data"])
+            if snapshot["pytorch_variables"]:
+                with archive.open("pytorch_variables.pth", mode="w", force_zip64=True) as f:
+                    th.save(snapshot["pytorch_variables"], f)
+            for file_name, state_dict in snapshot["params"].items():
+                with archive.open(file_name + ".pth", mode="w", force_zip64=True) as f:
+                    th.save(state_dict, f)
+            archive.writestr("_stable_baselines3_version", sb3.__version__)
+            archive.writestr("system_info.txt", get_system_info(print_info=False)[1])
+        os.replace(tmp_path, snapshot["model_path"])
+
+        for path, data in snapshot["pickles"]:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            paths.append(path)
+        if self.verbose >= 2:
+            print(f"Saved model checkpoint to {snapshot['model_path']}")
+
+        self.written.append(paths)
+        while self.keep_last is not None and len(self.written) > self.keep_last:
+            for path in self.written.popleft():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def flush(self):
+        """Block until all pending checkpoints are written."""
+        self.queue.join()
+
+    def close(self):
+        """Write the pending checkpoints and stop the writer thread."""
+        if self.writer is not None and self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        self.writer = None
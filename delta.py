@@ -0,0 +1,121 @@
+"""
+Delta frame protocol: the game sends what changed since its previous frame, the server
+merges it into the frame it has cached.
+
+Frames posted with the header `X-Frame-Encoding: delta` are JSON objects with the keys
+of a full frame, where:
+
+- `game_info` and `own_player` are always sent in full;
+- `obstacles` and `stats` are sent when they change (obstacles once per `match_id`),
+  and kept from the previous frame when left out;
+- `items`, `enemies`, `players` and `hazards` are either a full list, or an object
+  `{"changed": [...], "removed": [...], "order": [...]}` with the entities that are new
+  or changed (in full), the ids of those that are gone and the ids of the list in the
+  game's order, or left out when nothing changed.
+
+The server keeps an entity where it was when it changes and appends new ones, so
+`order` can be left out when that gives the game's order; otherwise (e.g. an entity
+respawned in the slot of the one it replaces) the list is rebuilt in `order`. The merged
+frame then lists the entities exactly as the full frame does, which matters because
+observations fill their slots in list order. Ids are unique within a list.
+
+The first frame of a match (a `match_id` the server has no frame for) must be sent in
+full, with every list. When a delta arrives that the server cannot merge, because it
+restarted or missed the start of the match, it answers 409 and the game sends its next
+frame in full.
+"""
+import json
+from typing import Dict, Optional
+
+ENTITY_LISTS = ("items", "enemies", "players", "hazards")
+REPLACED_LISTS = ("obstacles", "stats")
+DELTA_HEADER = "x-frame-encoding"
+
+
+class DeltaMerger:
+    """Server side: the full frame a stream of delta frames describes."""
+
+    def __init__(self):
+        self.match_id = None
+        self.entities: Dict[str, Dict[str, dict]] = {name: {} for name in ENTITY_LISTS}
+        self.replaced = {name: [] for name in REPLACED_LISTS}
+
+    def merge(self, body: dict) -> Optional[dict]:
+        """
+        The full frame after applying `body`, None when it is a delta against a match without
+        a full frame, or names an entity the server does not have.
+        """
+        match_id = body["game_info"].get("match_id")
+        full = all(isinstance(body.get(name), list) for name in ENTITY_LISTS + REPLACED_LISTS)
+        if not full and match_id != self.match_id:
+            return None
+        self.match_id = match_id
+
+        for name in ENTITY_LISTS:
+            value = body.get(name)
+            if value is None:
+                continue
+            if isinstance(value, list):
+                self.entities[name] = {entity["id"]: entity for entity in value}
+                continue
+            entities = self.entities[name]
+            for entity_id in value.get("removed", ()):
+                entities.pop(entity_id, None)
+            for entity in value.get("changed", ()):
+                entities[entity["id"]] = entity
+            order = value.get("order")
+            if order is not None:
+                try:
+                    self.entities[name] = {entity_id: entities[entity_id] for entity_id in order}
+                except KeyError:
+                    # out of sync, wait for the next full frame
+                    self.match_id = None
+                    return None
+        for name in REPLACED_LISTS:
+            if name in body:
+                self.replaced[name] = body[name]
+
+        frame = {"game_info": body["game_info"], "own_player": body["own_player"], **self.replaced}
+        for name in ENTITY_LISTS:
+            frame[name] = list(self.entities[name].values())
+        return frame
+
+
+class DeltaEncoder:
+    """Client side: the delta frame to send for each full frame (see standin.py)."""
+
+    def __init__(self):
+        self.match_id = None
+        # what the server holds, as serialized JSON per entity id, so that entities changed in place are noticed
+        self.sent = {}
+
+    def resync(self):
+        """Send the next frame in full."""
+        self.match_id = None
+
+    def encode(self, frame: dict) -> dict:
+        match_id = frame["game_info"].get("match_id")
+        full = match_id != self.match_id
+        self.match_id = match_id
+        body = dict(frame) if full else {"game_info": frame["game_info"], "own_player": frame["own_player"]}
+        for name in REPLACED_LISTS:
+            snapshot = json.dumps(frame[name])
+            if not full and self.sent.get(name) != snapshot:
+                body[name] = frame[name]
+            self.sent[name] = snapshot
+        for name in ENTITY_LISTS:
+            previous = self.sent.get(name, {})
+            current = {entity["id"]: json.dumps(entity) for entity in frame[name]}
+            if not full:
+                changed = [entity for entity in frame[name] if previous.get(entity["id"]) != current[entity["id"]]]
+                removed = [entity_id for entity_id in previous if entity_id not in current]
+                delta = {"changed": changed, "removed": removed}
+                # the order the server arrives at: the ids it keeps in place, then the new ones
+                order = list(current)
+                kept = [entity_id for entity_id in previous if entity_id in current]
+                if kept + [entity_id for entity_id in order if entity_id not in previous] != order:
+                    delta["order"] = order
+                if changed or removed or "order" in delta:
+                    body[name] = delta
+            self.sent[name] = current
+        return body
@@ -0,0 +1,192 @@
+"""
+Per-map obstacle clearance grids, computed once per map and cached on disk.
+
+Obstacles only change with the map, so instead of leaving the policy to work out
+free space from the raw obstacle coordinates every frame, a clearance grid is built
+the first time a map is seen: for every cell, the distance from its center to the
+nearest obstacle minus `obstacle_radius` (negative inside an obstacle). Grids are
+saved to `cache_dir` as `.npy`, named after the map and a fingerprint of its
+obstacles, and loaded memory-mapped afterwards.
+
+Per frame the encoder then only samples the grid around the own position by array
+indexing: a square egocentric patch and the free distance along a few rays.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+from typing import List, Optional
+
+import numpy as np
+
+from models import Position
+from util import POSITION_FACTOR
+
+logger = logging.getLogger(__name__)
+
+# bump when the grid computation changes, so that stale cache files are not reused
+VERSION = 1
+
+
+class DistanceField:
+    """
+    A clearance grid in map coordinates and the samplers the encoder uses.
+
+    :param grid: clearance of each cell, indexed [row (y), column (x)]; None for a map without obstacles
+    :param origin: map coordinates of the corner of cell (0, 0)
+    """
+
+    def __init__(self, grid: Optional[np.ndarray], origin: tuple, cell_size: float, max_range: float,
+                 patch_size: int = 7, patch_spacing: float = 100, n_rays: int = 8):
+        self.grid = grid
+        self.origin_x, self.origin_y = origin
+        self.cell_size = cell_size
+        self.max_range = max_range
+
+        # patch sample offsets, row major from the top left, in map units
+        half = (patch_size - 1) / 2
+        steps = (np.arange(patch_size) - half) * patch_spacing
+        patch_y, patch_x = np.meshgrid(steps, steps, indexing="ij")
+
+        # ray samples every cell along `n_rays` directions, starting east and turning clockwise (y points down)
+        self.ray_steps = np.arange(1, int(max_range / cell_size) + 1) * cell_size
+        angles = np.arange(n_rays) * (2 * np.pi / n_rays)
+        ray_x = np.cos(angles)[:, None] * self.ray_steps
+        ray_y = np.sin(angles)[:, None] * self.ray_steps
+
+        # all samples in cell units, so that a frame takes one gather from the grid
+        self.n_patch = patch_size * patch_size
+        self.n_rays = n_rays
+        self.offsets_x = np.concatenate([patch_x.ravel(), ray_x.ravel()]) / cell_size
+        self.offsets_y = np.concatenate([patch_y.ravel(), ray_y.ravel()]) / cell_size
+        self.feature_count = self.n_patch + n_rays
+
+    def sample(self, x, y) -> np.ndarray:
+        """Clearance at map coordinates x, y (scalars or arrays), clamped to the grid."""
+        return self._gather((np.asarray(x) - self.origin_x) / self.cell_size, (np.asarray(y) - self.origin_y) / self.cell_size)
+
+    def _gather(self, column, row) -> np.ndarray:
+        if self.grid is None:
+            return np.full(np.shape(column), self.max_range, dtype=np.float32)
+        rows, columns = self.grid.shape
+        # truncation and clamping agree for the negative indices
+        column = np.clip(column.astype(np.intp), 0, columns - 1)
+        row = np.clip(row.astype(np.intp), 0, rows - 1)
+        return self.grid[row, column]
+
+    def samples(self, position: Position) -> np.ndarray:
+        """Clearance at the patch samples, then along the rays, around `position`."""
+        return self._gather((position.x - self.origin_x) / self.cell_size + self.offsets_x,
+                            (position.y - self.origin_y) / self.cell_size + self.offsets_y)
+
+    def patch(self, position: Position) -> np.ndarray:
+        """Clearance at the patch samples around `position`, row major."""
+        return self.samples(position)[:self.n_patch]
+
+    def rays(self, position: Position) -> np.ndarray:
+        """Distance to the first sample without clearance along each ray, `max_range` when there is none."""
+        return self._ray_distances(self.samples(position))
+
+    def _ray_distances(self, samples: np.ndarray) -> np.ndarray:
+        blocked = samples[self.n_patch:].reshape(self.n_rays, -1) <= 0
+        return np.where(blocked.any(axis=1), self.ray_steps[blocked.argmax(axis=1)], self.max_range)
+
+    def encode(self, position: Position, out: np.ndarray):
+        """Write the patch then the rays around `position` into `out`, scaled like positions."""
+        samples = self.samples(position)
+        np.minimum(samples[:self.n_patch], self.max_range, out=out[:self.n_patch])
+        out[self.n_patch:] = self._ray_distances(samples)
+        out /= POSITION_FACTOR
+
+
+class DistanceFieldCache:
+    """
+    Builds, stores and loads the DistanceField of each map.
+
+    The grid of a map covers its obstacles plus `max_range` on every side. The
+    obstacle list of every frame is checked against the current field by its map
+    name, length and a few sampled coordinates; only when those change are the
+    obstacles fingerprinted in full and the field looked up on disk, or built.
+
+    :param cache_dir: where grids are stored, shared by all envs and runs
+    :param cell_size: grid resolution in map units
+    :param obstacle_radius: distance from an obstacle's position within which there is no clearance
+    :param max_range: clearance and ray distances are capped at this many map units
+    """
+
+    def __init__(self, cache_dir: str, cell_size: float = 25, obstacle_radius: float = 50, max_range: float = 1000,
+                 patch_size: int = 7, patch_spacing: float = 100, n_rays: int = 8):
+        self.cache_dir = cache_dir
+        self.cell_size = cell_size
+        self.obstacle_radius = obstacle_radius
+        self.max_range = max_range
+        self.sampler_kwargs = dict(patch_size=patch_size, patch_spacing=patch_spacing, n_rays=n_rays)
+        self.feature_count = patch_size * patch_size + n_rays
+        self.key = None
+        self.field: Optional[DistanceField] = None
+
+    def get(self, map_name: str, obstacles: List[Position]) -> DistanceField:
+        """The field of `map_name` with these obstacles, building it the first time they are seen."""
+        count = len(obstacles)
+        probes = tuple((obstacles[i].x, obstacles[i].y) for i in range(0, count, max(count // 8, 1)))
+        key = (map_name, count, probes)
+        if key != self.key:
+            self.field = self._load(map_name, obstacles)
+            self.key = key
+        return self.field
+
+    def _load(self, map_name: str, obstacles: List[Position]) -> DistanceField:
+        if not obstacles:
+            return DistanceField(None, (0, 0), self.cell_size, self.max_range, **self.sampler_kwargs)
+        points = np.array([(obstacle.x, obstacle.y) for obstacle in obstacles], dtype=np.float64)
+        path = os.path.join(self.cache_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', map_name)}_{self.fingerprint(points)}")
+        try:
+            with open(path + ".json") as f:
+                origin = tuple(json.load(f)["origin"])
+            # a plain ndarray view of the mapping, np.memmap adds overhead to every gather
+            grid = np.load(path + ".npy", mmap_mode="r").view(np.ndarray)
+        except (OSError, ValueError, KeyError):
+            grid, origin = self.build(points)
+            self._save(path, grid, origin)
+            logger.info(f"built the distance field of map {map_name!r}: {grid.shape[1]}x{grid.shape[0]} cells")
+        return DistanceField(grid, origin, self.cell_size, self.max_range, **self.sampler_kwargs)
+
+    def fingerprint(self, points: np.ndarray) -> str:
+        """Hash of the obstacle set (in any order) and of the grid parameters."""
+        points = points[np.lexsort((points[:, 1], points[:, 0]))]
+        digest = hashlib.sha1(np.ascontiguousarray(points).tobytes())
+        digest.update(repr((VERSION, self.cell_size, self.obstacle_radius, self.max_range)).encode())
+        return digest.hexdigest()[:16]
+
+    def build(self, points: np.ndarray, chunk: int = 4096):
+        """Clearance of every cell center, from its distance to the nearest obstacle position."""
+        low = points.min(axis=0) - self.max_range
+        high = points.max(axis=0) + self.max_range
+        columns, rows = np.ceil((high - low) / self.cell_size).astype(int)
+        centers_x = low[0] + (np.arange(columns) + 0.5) * self.cell_size
+        centers_y = low[1] + (np.arange(rows) + 0.5) * self.cell_size
+        cells = np.stack(np.meshgrid(centers_x, centers_y, indexing="xy"), axis=-1).reshape(-1, 2)
+
+        # squared distances as |c|^2 - 2 c.p + |p|^2, so that the bulk of the work is one matrix product per chunk
+        nearest = np.empty(len(cells), dtype=np.float64)
+        points_norm = (points * points).sum(axis=1)
+        for start in range(0, len(cells), chunk):
+            block = cells[start:start + chunk]
+            squared = block @ (-2 * points.T)
+            squared += points_norm
+            nearest[start:start + chunk] = squared.min(axis=1) + (block * block).sum(axis=1)
+        nearest = np.sqrt(np.maximum(nearest, 0))
+        grid = (nearest - self.obstacle_radius).astype(np.float32).reshape(rows, columns)
+        return grid, (float(low[0]), float(low[1]))
+
+    def _save(self, path: str, grid: np.ndarray, origin: tuple):
+        # written under temporary names and renamed, other envs may be reading the same cache
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, grid)
+        os.replace(tmp, path + ".npy")
+        with open(tmp, "w") as f:
+            json.dump({"origin": origin, "cell_size": self.cell_size, "obstacle_radius": self.obstacle_radius}, f)
+        os.replace(tmp, path + ".json")
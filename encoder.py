@@ -0,0 +1,327 @@
+import heapq
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from gymnasium import spaces
+
+from frame_dedup import VOLATILE
+from models import LevelData
+from util import serialize_player, serialize_own_player, serialize_enemy, serialize_item, serialize_gameinfo, serialize_hazard, serialize_obstacle, serialize_player_stat, serialize_anchor, own_player_feature_count, player_feature_count, enemy_feature_count, game_info_feature_count, hazard_feature_count, item_feature_count, obstacle_feature_count, stat_feature_count, anchor_feature_count, own_player_feature_dtypes, player_feature_dtypes, enemy_feature_dtypes, game_info_feature_dtypes, hazard_feature_dtypes, item_feature_dtypes, obstacle_feature_dtypes, stat_feature_dtypes, anchor_feature_dtypes, clearance_feature_dtypes, ORIGIN, POSITION_FACTOR
+
+
+class ObservationEncoder:
+    """
+    Writes a LevelData into a flat float32 observation, optionally in place.
+
+    With `absolute_obstacles` the obstacle block is encoded in map coordinates
+    instead of relative to the own player, so it stays identical for all frames of
+    a map, and an anchor block with the own absolute position is appended.
+
+    With `track_slots` players, enemies, hazards and items keep the slot of their
+    id for as long as they exist (see SlotTracker) instead of being packed in list
+    order. The encoder is then stateful and should see the frames in order. The
+    trackers are updated under a lock, since with `encode_in_server` the server thread
+    encodes every frame while the env thread can still encode its own state (a stalled
+    step, the reset frame).
+
+    With `distance_fields` a clearance block follows the own player: a patch of the
+    map's obstacle clearance around the own position and the free distance along a
+    few rays (see distance_field.py). It can stand in for the raw obstacles, with
+    `max_obstacles=0`.
+    """
+
+    def __init__(self, max_players=6, max_enemies=40, max_items=60, max_hazards=20, max_obstacles=1500, absolute_obstacles=False,
+                 track_slots=False, distance_fields=None):
+        self.max_players = max_players
+        self.max_enemies = max_enemies
+        self.max_items = max_items
+        self.max_hazards = max_hazards
+        self.max_obstacles = max_obstacles
+        self.absolute_obstacles = absolute_obstacles
+        self.distance_fields = distance_fields
+
+        # (name, slots, feature count, feature dtypes), in encoding order
+        self.layout = [("own_player", 1, own_player_feature_count, own_player_feature_dtypes)]
+        if distance_fields is not None:
+            self.layout.append(("clearance", 1, distance_fields.feature_count, clearance_feature_dtypes * distance_fields.feature_count))
+        self.layout += [
+            ("players", self.max_players - 1, player_feature_count, player_feature_dtypes),
+            ("enemies", self.max_enemies, enemy_feature_count, enemy_feature_dtypes),
+            ("hazards", self.max_hazards, hazard_feature_count, hazard_feature_dtypes),
+            ("items", self.max_items, item_feature_count, item_feature_dtypes),
+            ("obstacles", self.max_obstacles, obstacle_feature_count, obstacle_feature_dtypes),
+            ("stats", self.max_players, stat_feature_count, stat_feature_dtypes),
+            ("game_info", 1, game_info_feature_count, game_info_feature_dtypes),
+        ]
+        if absolute_obstacles:
+            self.layout.append(("anchor", 1, anchor_feature_count, anchor_feature_dtypes))
+
+        # name -> (start, end) of each block in the observation
+        self.blocks = {}
+        offset = 0
+        for name, slots, feature_count, _ in self.layout:
+            self.blocks[name] = (offset, offset + slots * feature_count)
+            offset += slots * feature_count
+        self.size = offset
+
+        self.trackers = None
+        self.lock = threading.Lock()
+        if track_slots:
+            self.trackers = {
+                "players": SlotTracker(self.max_players - 1, player_feature_count, serialize_player, position_columns=(1, 2)),
+                "enemies": SlotTracker(self.max_enemies, enemy_feature_count, serialize_enemy),
+                "hazards": SlotTracker(self.max_hazards, hazard_feature_count, serialize_hazard),
+                "items": SlotTracker(self.max_items, item_feature_count, serialize_item),
+            }
+
+    def observation_space(self):
+        return spaces.Box(low=-np.inf, high=np.inf, shape=(self.size,), dtype=np.float32)
+
+    def feature_dtypes(self) -> np.ndarray:
+        """
+        The narrowest dtype each feature can be stored in without losing what the
+        policy needs: uint8/int8 for flags and categorical codes, float16 for
+        normalized values and positions, float32 for everything unbounded.
+        """
+        return np.concatenate([np.array(dtypes * slots) for _, slots, _, dtypes in self.layout])
+
+    def dynamic_size(self) -> int:
+        """Length of the leading own player, clearance, players, enemies and hazards blocks, the ones that move."""
+        return self.blocks["hazards"][1]
+
+    def static_block(self) -> Optional[Tuple[int, int]]:
+        """(start, end) of the block that only changes with the map, if there is one."""
+        return self.blocks["obstacles"] if self.absolute_obstacles else None
+
+    def encode(self, level_data: LevelData, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Encode `level_data` into `out` (allocated if not given) and return it."""
+        if out is None:
+            out = np.empty(self.size, dtype=np.float32)
+        center_pos = level_data.own_player.position
+        obstacle_center = ORIGIN if self.absolute_obstacles else center_pos
+
+        offset = self._write(out, 0, serialize_own_player(level_data.own_player))
+        if self.distance_fields is not None:
+            field = self.distance_fields.get(level_data.game_info.map, level_data.obstacles)
+            start, offset = self.blocks["clearance"]
+            field.encode(center_pos, out[start:offset])
+        if self.trackers is not None:
+            with self.lock:
+                offset = self.trackers["players"].write(out, offset, level_data.players, center_pos)
+                offset = self.trackers["enemies"].write(out, offset, level_data.enemies, center_pos)
+                offset = self.trackers["hazards"].write(out, offset, level_data.hazards, center_pos)
+                offset = self.trackers["items"].write(out, offset, level_data.items, center_pos)
+        else:
+            offset = self._write_slots(out, offset, level_data.players, self.max_players - 1, player_feature_count, serialize_player, center_pos)
+            offset = self._write_slots(out, offset, level_data.enemies, self.max_enemies, enemy_feature_count, serialize_enemy, center_pos)
+            offset = self._write_slots(out, offset, level_data.hazards, self.max_hazards, hazard_feature_count, serialize_hazard, center_pos)
+            offset = self._write_slots(out, offset, level_data.items, self.max_items, item_feature_count, serialize_item, center_pos)
+        offset = self._write_slots(out, offset, level_data.obstacles, self.max_obstacles, obstacle_feature_count, serialize_obstacle, obstacle_center)
+        offset = self._write_slots(out, offset, level_data.stats, self.max_players, stat_feature_count, serialize_player_stat)
+        offset = self._write(out, offset, serialize_gameinfo(level_data.game_info))
+        if self.absolute_obstacles:
+            self._write(out, offset, serialize_anchor(center_pos))
+        return out
+
+    def encode_game_info(self, level_data: LevelData, out: np.ndarray):
+        """Rewrite only the game_info block of an observation of `level_data`."""
+        start, end = self.blocks["game_info"]
+        out[start:end] = serialize_gameinfo(level_data.game_info)
+
+    @staticmethod
+    def _write(out, offset, values):
+        end = offset + len(values)
+        out[offset:end] = values
+        return end
+
+    @staticmethod
+    def _write_slots(out, offset, entities, max_slots, feature_count, serialize, *args):
+        values = []
+        for entity in entities[:max_slots]:
+            values.extend(serialize(entity, *args))
+        end = offset + len(values)
+        out[offset:end] = values
+        # Fill empty slots if fewer than max
+        slots_end = offset + max_slots * feature_count
+        out[end:slots_end] = 0
+        return slots_end
+
+
+class SlotTracker:
+    """
+    Keeps entities in the same observation slot for their whole lifetime.
+
+    Slots are keyed on `GameObject.id`: a new id takes the lowest free slot, an id
+    missing from a frame frees its slot. Features are cached per slot in map
+    coordinates and an entity is only serialized again when it differs from the one
+    seen in the previous frame; the own position is subtracted from all occupied
+    slots at once when the block is written. New ids that find no free slot are
+    left out until one frees up, and repeated ids within a frame share a slot.
+
+    :param position_columns: columns of the x and y position in the serialized features, adjacent
+    """
+
+    def __init__(self, max_slots: int, feature_count: int, serialize: Callable, position_columns=(0, 1)):
+        self.serialize = serialize
+        self.x_column = position_columns[0]
+        if position_columns[1] != self.x_column + 1:
+            raise ValueError(f"position columns must be adjacent, got {position_columns}")
+        self.features = np.zeros((max_slots, feature_count), dtype=np.float32)
+        self.occupied = np.zeros((max_slots, 1), dtype=bool)
+        self.entities: List = [None] * max_slots
+        self.slots = {}
+        self.free = list(range(max_slots))
+        # slots serialized by the last update, for profiling
+        self.rewritten = 0
+
+    def update(self, entities: List):
+        slots = self.slots
+        # free the slots of despawned ids first, so newcomers can take them this frame
+        for entity_id in slots.keys() - {entity.id for entity in entities}:
+            slot = slots.pop(entity_id)
+            self.features[slot] = 0
+            self.occupied[slot] = False
+            self.entities[slot] = None
+            heapq.heappush(self.free, slot)
+
+        cached = self.entities
+        changed_slots, changed_features = [], []
+        for entity in entities:
+            slot = slots.get(entity.id)
+            if slot is None:
+                if not self.free:
+                    continue
+                slot = slots[entity.id] = heapq.heappop(self.free)
+                self.occupied[slot] = True
+            if cached[slot] != entity:
+                cached[slot] = entity
+                changed_slots.append(slot)
+                changed_features.append(self.serialize(entity, ORIGIN))
+        if changed_slots:
+            self.features[changed_slots] = changed_features
+        self.rewritten = len(changed_slots)
+
+    def write(self, out: np.ndarray, offset: int, entities: List, center_pos) -> int:
+        """Update the slots from `entities` and write the block, relative to `center_pos`, at `offset`."""
+        self.update(entities)
+        end = offset + self.features.size
+        block = out[offset:end].reshape(self.features.shape)
+        block[:] = self.features
+        positions = block[:, self.x_column:self.x_column + 2]
+        center = (center_pos.x / POSITION_FACTOR, center_pos.y / POSITION_FACTOR)
+        np.subtract(positions, center, out=positions, where=self.occupied)
+        return end
+
+
+class FrameStack:
+    """
+    Stacks the last `k` observations in a ring buffer without copying the stack.
+
+    Every frame is stored twice, in rows `i` and `i + k` of a (2k, d) buffer, so the
+    last k frames always form the contiguous rows `i + 1 ... i + k` (oldest first)
+    and the stacked observation is a view. Each step costs two frame copies
+    whatever `k` is.
+
+    With `dynamic_size` only that many leading features (the dynamic blocks, see
+    ObservationEncoder.dynamic_size) are stacked and the observation is a dict of
+    the stacked `dynamic` features and the `static` rest of the newest frame.
+
+    Returned observations are views that are rewritten by the following steps.
+    """
+
+    def __init__(self, frame_size: int, k: int, dynamic_size: Optional[int] = None):
+        self.frame_size = frame_size
+        self.k = k
+        self.dynamic_size = dynamic_size
+        stacked_size = frame_size if dynamic_size is None else dynamic_size
+        self.buffer = np.zeros((2 * k, stacked_size), dtype=np.float32)
+        # the newest full frame, when only its dynamic part is stacked
+        self.current = None if dynamic_size is None else np.zeros(frame_size, dtype=np.float32)
+        self.index = 0
+
+    def observation_space(self) -> Union[spaces.Box, spaces.Dict]:
+        stacked = spaces.Box(low=-np.inf, high=np.inf, shape=(self.k * self.buffer.shape[1],), dtype=np.float32)
+        if self.dynamic_size is None:
+            return stacked
+        return spaces.Dict({
+            "dynamic": stacked,
+            "static": spaces.Box(low=-np.inf, high=np.inf, shape=(self.frame_size - self.dynamic_size,), dtype=np.float32),
+        })
+
+    def frame_buffer(self) -> np.ndarray:
+        """Where the next frame should be encoded before calling `push`."""
+        if self.current is not None:
+            return self.current
+        return self.buffer[self.index]
+
+    def push(self, first: bool = False) -> Union[np.ndarray, Dict[str, np.ndarray]]:
+        """Add the frame written into `frame_buffer()`; `first` fills the whole stack with it."""
+        i = self.index
+        if self.current is not None:
+            self.buffer[i] = self.current[:self.dynamic_size]
+        if first:
+            self.buffer[:] = self.buffer[i]
+        else:
+            self.buffer[i + self.k] = self.buffer[i]
+        self.index = (i + 1) % self.k
+        stacked = self.buffer[i + 1:i + 1 + self.k].reshape(-1)
+        if self.current is None:
+            return stacked
+        return {"dynamic": stacked, "static": self.current[self.dynamic_size:]}
+
+
+class BufferedFrameEncoder:
+    """
+    Double-buffered observation encoder driven by the frame server.
+
+    The server thread decodes each frame, encodes it into the back buffer and
+    computes its reward against the previously encoded frame, then swaps the
+    buffers. The env thread takes ownership of the front buffer with `take()`.
+
+    A buffer returned by `take()` is only rewritten two frames later, so it stays
+    valid for the step that returned it and the one after that.
+    """
+
+    def __init__(self, encoder: ObservationEncoder, reward_fn: Callable[[LevelData, LevelData], float]):
+        self.encoder = encoder
+        self.reward_fn = reward_fn
+        self.buffers = np.zeros((2, encoder.size), dtype=np.float32)
+        self.rewards = [0.0, 0.0]
+        self.frames: list = [None, None]
+        self.front = 0
+        self.previous: Optional[LevelData] = None
+        self.lock = threading.Lock()
+        # seconds spent encoding and computing rewards, for time attribution
+        self.encode_time = 0.0
+        self.reward_time = 0.0
+
+    def encode(self, level_data: LevelData, repeated: Optional[str] = None):
+        """
+        Called from the server thread for every decoded frame. A frame that `repeated` the
+        previous one (see frame_dedup.py) copies its observation, with the game_info block
+        rewritten when only the volatile fields changed.
+        """
+        back = 1 - self.front
+        started = time.perf_counter()
+        if repeated is not None and self.previous is not None:
+            self.buffers[back] = self.buffers[self.front]
+            if repeated == VOLATILE:
+                self.encoder.encode_game_info(level_data, self.buffers[back])
+        else:
+            self.encoder.encode(level_data, out=self.buffers[back])
+        encoded = time.perf_counter()
+        self.rewards[back] = self.reward_fn(self.previous, level_data) if self.previous is not None else 0
+        self.encode_time += encoded - started
+        self.reward_time += time.perf_counter() - encoded
+        self.frames[back] = level_data
+        self.previous = level_data
+        with self.lock:
+            self.front = back
+
+    def take(self) -> Tuple[Optional[LevelData], np.ndarray, float]:
+        """Return the most recently encoded frame, its observation and its reward."""
+        with self.lock:
+            front = self.front
+        return self.frames[front], self.buffers[front], self.rewards[front]
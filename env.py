@@ -1,17 +1,24 @@
 import gymnasium as gym
 from gymnasium import spaces
 import numpy as np
-from server import app, step, reset, get_data
-from models import Position, GameState, LevelData
-from util import serialize_player, serialize_own_player, serialize_enemy, serialize_item, serialize_gameinfo, serialize_hazard, serialize_obstacle, serialize_player_stat, own_player_feature_count, player_feature_count, enemy_feature_count, game_info_feature_count, hazard_feature_count, item_feature_count, obstacle_feature_count, stat_feature_count
+from models import Position, GameState, LevelData, OwnPlayer
+from encoder import ObservationEncoder, BufferedFrameEncoder, FrameStack
+from frame_process import FrameServerProcess
+from frame_skip import FrameSkipController
+from distance_field import DistanceFieldCache
+from features import FeatureEncoder, FeatureSpec
+from rewards import RewardFunction
+from frame_dedup import VOLATILE
+from util import own_player_feature_count, player_feature_count, enemy_feature_count, game_info_feature_count, hazard_feature_count, item_feature_count, obstacle_feature_count, stat_feature_count
 import threading
 import asyncio
+import time
+import os
+from concurrent.futures import Future
 from functools import partial
 from enum import Enum
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 gym.envs.registration.register(
@@ -52,13 +59,143 @@ class ActionSpace(Enum):
     REDEEM_SKILL_POINTS_SPEED = 24
 
 
+def match_over(level_data: LevelData) -> bool:
+    return level_data.game_info.state in (GameState.ENDED, GameState.MATCH_COMPLETED)
+
+
+DASH_ACTIONS = [action.value for action in ActionSpace if action.name.startswith("DASH_")]
+REDEEM_ACTIONS = [action.value for action in ActionSpace if action.name.startswith("REDEEM_SKILL_POINTS_")]
+
+
+def action_masks(own_players: list) -> np.ndarray:
+    """
+    Which ActionSpace members would do something for each own player, shape (players, actions).
+
+    Dashing needs `is_dash_ready`, the special `is_special_ready` and an equipped special,
+    the shield `is_shield_ready`, using an item one in the inventory and redeeming skill
+    points available ones. Moving and attacking are always possible, so every row has a
+    valid action. Players that are not decoded yet (the placeholder state) allow everything.
+    """
+    masks = np.ones((len(own_players), len(ActionSpace)), dtype=bool)
+    for mask, player in zip(masks, own_players):
+        if not isinstance(player, OwnPlayer):
+            continue
+        mask[DASH_ACTIONS] = player.is_dash_ready
+        mask[ActionSpace.SPECIAL.value] = player.is_special_ready and player.special_equipped != ""
+        mask[ActionSpace.SHIELD.value] = player.is_shield_ready
+        mask[ActionSpace.USE_RING.value] = len(player.items.rings) > 0
+        mask[ActionSpace.USE_SPEED_ZAPPER.value] = len(player.items.speed_zappers) > 0
+        mask[ActionSpace.USE_BIG_POTION.value] = len(player.items.big_potions) > 0
+        mask[REDEEM_ACTIONS] = player.levelling.available_skill_points > 0
+    return masks
+
+
 class CustomEnv(gym.Env):
-    def __init__(self, max_players=6, max_enemies=40, max_items=60, max_hazards=20, max_obstacles=1500, skip_frames=0):
+    def __init__(self, max_players=6, max_enemies=40, max_items=60, max_hazards=20, max_obstacles=1500, skip_frames=0, encode_in_server=False, server_process=False, port=3000,
+                 reset_timeout=30.0, respawn_timeout=30.0, reset_retries=2, compact_observations=False,
+                 track_slots=False, record_dir=None, frame_stack=1, stack_dynamic_only=False,
+                 target_decision_rate=None, skip_bounds=(1, 30), step_timeout=None, distance_field_dir=None,
+                 feature_spec=None, macros=None, reward_terms=None, profile_dir=None, connect_timeout=None):
+        """
+        :param port: port the frame server listens on; each env owns its own ServerState.
+        :param reset_timeout: seconds to wait for the game to restart before requesting the reset again
+            (counted from its first frame, see `connect_timeout`)
+        :param respawn_timeout: seconds to wait for a respawn after dying before falling back to a reset
+        :param reset_retries: how many times a reset is re-requested before `reset` raises TimeoutError
+        :param connect_timeout: seconds a reset waits for the game's first frame before raising TimeoutError,
+            None waits until the game is launched
+        :param encode_in_server: decode, encode and compute rewards on the server thread
+            into a double-buffered observation array, so that `step` only takes the ready buffer
+            and copies it out (or into the `out` array of a vectorized env).
+        :param server_process: run the frame server in its own process and exchange observations,
+            rewards, actions and infos through a shared-memory ring (see frame_process.py).
+            `state` is not mirrored into this process in that mode.
+        :param compact_observations: encode obstacles in map coordinates (plus an anchor block with
+            the own position) so that rollout storage can keep them once per map,
+            see rollout_buffer.CompactRolloutBuffer.
+        :param track_slots: keep players, enemies, hazards and items in the slot of their id while they
+            exist, and only re-serialize entities that changed since the previous frame (see encoder.SlotTracker).
+        :param record_dir: record every decoded frame as a binary snapshot to `record_dir/frames_<port>.snap`,
+            with a marker after the frames steps and resets returned (see snapshot.FrameRecorder, read them
+            back with snapshot.read_frames or snapshot.read_records).
+        :param frame_stack: observe the last `frame_stack` frames, stacked oldest first (see encoder.FrameStack).
+            Returned observations are then views that later steps rewrite.
+        :param stack_dynamic_only: only stack the own player, players, enemies and hazards blocks; the
+            observation is then a dict of the stacked `dynamic` blocks and the `static` rest of the newest frame.
+        :param target_decision_rate: decide on every Nth frame instead, with N adapted online to hold this many
+            steps per second (see frame_skip.FrameSkipController), within `skip_bounds`; `skip_frames` is then
+            not used. The current N is reported as `info["decide_every"]` and with the server metrics at GET /metrics.
+
+        :param distance_field_dir: add a block of obstacle clearance samples around the own position, from
+            per-map clearance grids cached in this directory (see distance_field.DistanceFieldCache).
+        :param step_timeout: seconds a step waits for the game's next frame. When the game stalls the step
+            returns the last observation truncated with `info["stalled"]`, and the next reset restarts the game
+            instead of waiting for a respawn. None waits forever.
+        :param feature_spec: encode the observation from a features.FeatureSpec (or the path of one saved as
+            JSON) instead of the full ObservationEncoder layout, e.g. with features or entity types dropped.
+            Cannot be combined with compact_observations, track_slots or distance_field_dir.
+        :param macros: list of macros.Macro; each action then plays a macro, a sequence of moves the server
+            sends one per frame, and the step returns the frame after its last move (or the frame that
+            interrupted it) with the rewards of all its frames added up, and `info["macro"]`.
+            `step_timeout` applies to the whole macro.
+        :param reward_terms: list of rewards.RewardTerm the reward is the weighted sum of, by default
+            rewards.DEFAULT_TERMS. The same terms relabel recorded frames offline (see rewards.py).
+        :param profile_dir: allow sampling the stacks of the frame server thread and of the thread that
+            started the env while training runs (see profiler.py). Sessions are started and stopped with
+            GET /profile/start?seconds=30&hz=100 and /profile/stop on the frame server, or by sending SIGUSR2
+            to the process when the env was started from its main thread, and are written to
+            `profile_dir/profile_<port>_<time>.collapsed`.
+
+        `action_masks()` tells which actions would do something in the current state (see
+        `action_masks`), in the form sb3-contrib's MaskablePPO expects, and every step and reset
+        reports it as `info["action_mask"]`. With `server_process` the state stays in the server
+        process, and `action_masks()` returns the mask of the last info it sent.
+
+        Every step reports `info["timings"]`: seconds spent waiting for the game, decoding the frame,
+        encoding the observation and computing the reward (see time_attribution_callback.py). With
+        `server_process` they are the server process's, which does that work.
+        """
         super(CustomEnv, self).__init__()
-        # Start server in separate thread
-        self.server_thread = threading.Thread(target=self.run_server)
-        self.server_thread.daemon = True
-        self.server_thread.start()
+        self.port = port
+        # The frame server is only started by `start()` or the first `reset()`
+        self.server_state = None
+        self.app = None
+        self.uvicorn_server = None
+        self.server_thread = None
+        self.frame_server = None
+        self.frame_recorder = None
+        self.record_dir = record_dir
+        self.profiler = None
+        self.profile_dir = profile_dir
+        self.env_thread = None
+        self.skip_controller = None
+        if target_decision_rate is not None:
+            self.skip_controller = FrameSkipController(target_decision_rate, min_every=skip_bounds[0], max_every=skip_bounds[1])
+        self.last_step_at = None
+        self.last_frames_received = 0
+        self.last_frames_ignored = 0
+        self.ready: Future = None
+        self.started_at = None
+        self.time_to_first_step = None
+        self.server_process = server_process
+        # the action mask of the last info from the server process
+        self.server_action_mask = None
+        # the state encoded last and a copy of its observation, reused when the next frame repeats it
+        self.encoded_state = None
+        self.encoded_obs = None
+        self.reset_timeout = reset_timeout
+        self.respawn_timeout = respawn_timeout
+        self.reset_retries = reset_retries
+        self.connect_timeout = connect_timeout
+        self.step_timeout = step_timeout
+        self.stalled = False
+        self.env_kwargs = dict(max_players=max_players, max_enemies=max_enemies, max_items=max_items, max_hazards=max_hazards,
+                               max_obstacles=max_obstacles, skip_frames=skip_frames, encode_in_server=encode_in_server, port=port,
+                               reset_timeout=reset_timeout, respawn_timeout=respawn_timeout, reset_retries=reset_retries,
+                               compact_observations=compact_observations, track_slots=track_slots,
+                               record_dir=record_dir, target_decision_rate=target_decision_rate, skip_bounds=skip_bounds,
+                               step_timeout=step_timeout, distance_field_dir=distance_field_dir, feature_spec=feature_spec, macros=macros,
+                               reward_terms=reward_terms, profile_dir=profile_dir, connect_timeout=connect_timeout)
         # Create event loop in main thread
         self.loop = asyncio.get_event_loop()
         if self.loop.is_closed():
@@ -71,11 +208,39 @@ class CustomEnv(gym.Env):
         self.max_hazards = max_hazards
         self.max_items = max_items
         self.max_obstacles = max_obstacles
+        self.reward_function = RewardFunction(reward_terms)
+        if feature_spec is not None:
+            if compact_observations or track_slots or distance_field_dir is not None:
+                raise ValueError("feature_spec cannot be combined with compact_observations, track_slots or distance_field_dir")
+            if isinstance(feature_spec, str):
+                feature_spec = FeatureSpec.load(feature_spec)
+            self.encoder = FeatureEncoder(feature_spec)
+        else:
+            distance_fields = DistanceFieldCache(distance_field_dir) if distance_field_dir is not None else None
+            self.encoder = ObservationEncoder(max_players, max_enemies, max_items, max_hazards, max_obstacles,
+                                              absolute_obstacles=compact_observations, track_slots=track_slots,
+                                              distance_fields=distance_fields)
+
+        self.frame_encoder = None
+        if encode_in_server and not server_process:
+            self.frame_encoder = BufferedFrameEncoder(self.encoder, lambda previous, new: self.get_reward(new, previous))
+
+        # stacking happens in this process, the server process sends single frames
+        self.frame_stack = None
+        if frame_stack > 1:
+            self.frame_stack = FrameStack(self.encoder.size, frame_stack,
+                                          dynamic_size=self.encoder.dynamic_size() if stack_dynamic_only else None)
 
-        self.action_space = spaces.Discrete(len(ActionSpace))  # Number of possible moves
+        self.macros = macros
+        self.macro_run = None
+        # a macro is allowed when its first move is
+        self.macro_first_actions = None if macros is None else np.array([macro.actions[0].value for macro in macros])
+        self.action_space = spaces.Discrete(len(ActionSpace) if macros is None else len(macros))  # Number of possible moves
         self.observation_space = self.get_flat_observation_space()
         
         self.state = self.initialize_game()
+        self.game_action = []
+        self.action_idx = -1
         self.truncated = False
         
 
@@ -92,21 +257,119 @@ class CustomEnv(gym.Env):
             stats=[]
         )
 
+    def start(self) -> Future:
+        """
+        Start the frame server if it is not running yet.
+
+        Returns a future that resolves once the server accepts connections
+        (or fails with the reason it could not start).
+        """
+        if self.ready is not None:
+            return self.ready
+        self.ready = Future()
+        self.started_at = time.perf_counter()
+
+        if self.server_process:
+            # Run the frame server in its own process, exchanging frames through shared memory
+            self.frame_server = FrameServerProcess(self.encoder.size, self.env_kwargs)
+            threading.Thread(target=self.frame_server.wait_started, args=(self.ready,), daemon=True).start()
+            return self.ready
+
+        # Deferred so that importing this module does not load FastAPI and uvicorn
+        from server import ServerState, FrameServer, create_app, set_decide_every, set_frame_encoder, set_frame_recorder, set_profiler
+
+        self.server_state = ServerState()
+        self.app = create_app(self.server_state)
+        if self.frame_encoder is not None:
+            set_frame_encoder(self.frame_encoder, server_state=self.server_state)
+        if self.record_dir is not None:
+            from snapshot import FrameRecorder
+            os.makedirs(self.record_dir, exist_ok=True)
+            self.frame_recorder = FrameRecorder(os.path.join(self.record_dir, f"frames_{self.port}.snap"))
+            set_frame_recorder(self.frame_recorder, server_state=self.server_state)
+        if self.profile_dir is not None:
+            from profiler import SamplingProfiler, install_signal_toggle
+            self.env_thread = threading.get_ident()
+            self.profiler = SamplingProfiler(self.profiled_threads, self.profile_dir, name=f"profile_{self.port}")
+            set_profiler(self.profiler, server_state=self.server_state)
+            install_signal_toggle(self.profiler)
+        if self.skip_controller is not None:
+            set_decide_every(self.skip_controller.decide_every, server_state=self.server_state)
+        self.uvicorn_server = FrameServer(self.app, host="0.0.0.0", port=self.port, ready=self.ready)
+
+        # Start server in separate thread
+        self.server_thread = threading.Thread(target=self.run_server, name=f"frame-server-{self.port}")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        return self.ready
+
     def run_server(self):
-        import uvicorn
-        uvicorn.run(app, host="0.0.0.0", port=3000, log_level="warning")
+        self.uvicorn_server.run_until_stopped()
+
+    def profiled_threads(self) -> dict:
+        threads = {"env": self.env_thread}
+        if self.server_thread is not None:
+            threads["frame-server"] = self.server_thread.ident
+        return threads
 
     def reset(self, seed=None, options=None):
         super().reset(seed=seed, options=options)
 
-        if self.truncated:
-            while self.state.own_player.health <= 0:
-                self.state = self.loop.run_until_complete(get_data(immediate=True))
-        else:
-            self.state = self.loop.run_until_complete(reset(seed=seed, options=options))
+        if self.server_process:
+            self.start().result()
+            obs, info = self.frame_server.reset(seed=seed, options=options)
+            self.server_action_mask = info.get("action_mask")
+            return (obs if self.frame_stack is None else self.stack_frame(obs, first=True)), info
+
+        return self.loop.run_until_complete(self.async_reset(seed=seed, options=options))
+
+    async def async_reset(self, seed=None, options=None, out: np.ndarray = None):
+        """
+        Coroutine behind `reset`; writes the observation into `out` when given.
+
+        After a death it waits for the respawn instead of restarting the game. Both
+        waits are woken only by a matching frame, and their latency is reported in
+        the info dict as `respawn_latency_s` or `reset_latency_s`.
+        """
+        from server import reset, wait_for_state
+
+        await asyncio.wrap_future(self.start())
+        info = {}
+        # the time spent resetting is not a step
+        self.last_step_at = None
+        started = time.perf_counter()
+        respawned = False
+        # a stalled game is restarted, and there is no respawn once the match is over
+        if self.truncated and not self.stalled and not match_over(self.state):
+            try:
+                if self.state.own_player.health <= 0:
+                    self.state = await wait_for_state(lambda level_data: level_data.own_player.health > 0 or match_over(level_data),
+                                                      timeout=self.respawn_timeout, server_state=self.server_state)
+                respawned = not match_over(self.state)
+                if respawned:
+                    info["respawn_latency_s"] = time.perf_counter() - started
+            except asyncio.TimeoutError:
+                logger.warning(f"no respawn on port {self.port} within {self.respawn_timeout}s, requesting a reset")
+        if not respawned and self.server_state.frames_received == 0:
+            # the game may be launched after the trainer, the reset timeout starts with its first frame
+            logger.info(f"waiting for the game to connect on port {self.port}")
+            try:
+                await wait_for_state(lambda level_data: True, timeout=self.connect_timeout, server_state=self.server_state)
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"the game did not connect to port {self.port} within {self.connect_timeout}s") from None
+            started = time.perf_counter()
+        if not respawned:
+            self.state = await reset(seed=seed, options=options, timeout=self.reset_timeout,
+                                     retries=self.reset_retries, server_state=self.server_state)
+            info["reset_latency_s"] = time.perf_counter() - started
+            logger.info(f"game reset in {info['reset_latency_s']:.3f}s")
+        self.stalled = False
+        if self.frame_recorder is not None:
+            self.frame_recorder.mark_step(self.state, -1)
+        info["action_mask"] = self.action_masks()
         
-        obs = self.get_observation()
-        return obs, {}
+        obs = self.observe(self.take_encoded_frame(self.state), out, first=True)
+        return obs, info
 
     def get_move_coordinates(self, delta: Position):
         # Convert delta to coordinates
@@ -155,54 +418,209 @@ class CustomEnv(gym.Env):
         return move
 
     def step(self, action_idx: int):
+        if self.server_process:
+            obs, reward, terminated, truncated, info = self.frame_server.step(int(action_idx))
+            self.server_action_mask = info.get("action_mask")
+            self.record_first_step()
+            if self.frame_stack is not None:
+                obs = self.stack_frame(obs)
+            return obs, reward, terminated, truncated, info
+
+        self.send_action(action_idx)
+        return self.loop.run_until_complete(self.receive_step())
+
+    def adapt_skip_frames(self, level_data: LevelData):
+        """Feed the step time, frames received and missed since the last step and the game latency to the skip controller."""
+        if self.skip_controller is None:
+            return
+        from server import set_decide_every
+
+        now = time.perf_counter()
+        frames_received = self.server_state.frames_received
+        frames_ignored = self.server_state.frames_ignored
+        if self.last_step_at is not None:
+            decide_every = self.skip_controller.update(now - self.last_step_at, frames_received - self.last_frames_received,
+                                                      frames_ignored - self.last_frames_ignored, level_data.game_info.latency)
+            set_decide_every(decide_every, server_state=self.server_state)
+            self.server_state.step_metrics.update(self.skip_controller.metrics())
+        self.last_step_at = now
+        self.last_frames_received = frames_received
+        self.last_frames_ignored = frames_ignored
+
+    def server_metrics(self) -> dict:
+        """Counters of this env's frame server (see ServerState.metrics), None before it runs in this process."""
+        if self.server_state is None:
+            return None
+        return self.server_state.metrics()
+
+    def record_first_step(self):
+        if self.time_to_first_step is None:
+            self.time_to_first_step = time.perf_counter() - self.started_at
+            logger.info(f"time to first step: {self.time_to_first_step:.3f}s after starting the server on port {self.port}")
+
+    def send_action(self, action_idx: int):
+        """Queue the move for `action_idx`; the server hands it to the game with the next frame."""
+        from server import set_moves
+
+        if self.ready is None:
+            self.start().result()
+        self.action_idx = int(action_idx)
+        if self.macros is not None:
+            self.send_macro(self.macros[action_idx])
+            return
         # convert the action index to a move
-        game_action = self.get_game_move(ActionSpace(action_idx))
-        # pass the action to the server and get the new state
-        new_level_data = self.loop.run_until_complete(step(game_action))
+        self.game_action = self.get_game_move(ActionSpace(action_idx))
+        set_moves(self.game_action, server_state=self.server_state)
+
+    def action_masks(self) -> np.ndarray:
+        """Boolean mask of the actions that would do something in the current state."""
+        if self.server_process and self.server_action_mask is not None:
+            return self.server_action_mask
+        return self.mask_actions(action_masks([self.state.own_player]))[0]
+
+    def mask_actions(self, masks: np.ndarray) -> np.ndarray:
+        """ActionSpace masks as masks of this env's actions, the macros' when it has them."""
+        return masks if self.macro_first_actions is None else masks[:, self.macro_first_actions]
+
+    def send_macro(self, macro):
+        """Queue the moves of `macro`, the server sends them one per frame."""
+        from server import MacroRun, set_moves
+
+        batches = [self.get_game_move(action) for action in macro.actions]
+        self.macro_run = MacroRun(batches[1:], self.state, interrupt=macro.interrupt,
+                                  reward_fn=lambda previous, new: self.get_reward(new, previous))
+        self.game_action = batches[0]
+        set_moves(self.game_action, server_state=self.server_state, macro=self.macro_run)
+
+    async def receive_step(self, out: np.ndarray = None):
+        """Wait for the frame following the queued action and build the step result, encoding into `out` when given."""
+        from server import get_data, wait_for_macro
+
+        game_action = self.game_action
+        macro_run, self.macro_run = self.macro_run, None
+        server_state, frame_encoder = self.server_state, self.frame_encoder
+        decode_time = server_state.decode_time
+        server_encode_time = frame_encoder.encode_time if frame_encoder is not None else 0.0
+        server_reward_time = frame_encoder.reward_time if frame_encoder is not None else 0.0
+        started = time.perf_counter()
+        # get the new state from the server
+        try:
+            if macro_run is not None:
+                new_level_data = await wait_for_macro(macro_run, timeout=self.step_timeout, server_state=server_state)
+            else:
+                new_level_data = await get_data(timeout=self.step_timeout, server_state=server_state)
+        except asyncio.TimeoutError:
+            logger.warning(f"no frame from the game on port {self.port} within {self.step_timeout}s, truncating the episode")
+            self.stalled = self.truncated = True
+            return self.observe(None, out), 0.0, False, True, {"stalled": True, "action_mask": self.action_masks()}
+        received = time.perf_counter()
+        frame = self.take_encoded_frame(new_level_data)
         
         # calculate the reward
-        reward = self.get_reward(new_level_data=new_level_data)
+        if macro_run is not None:
+            # added up over the macro's frames by the server thread
+            reward = macro_run.reward
+        else:
+            reward = frame[2] if frame is not None else self.get_reward(new_level_data=new_level_data)
+        rewarded = time.perf_counter()
         if reward != 0:
             logger.debug(f"reward: {reward}, game_action: {game_action}")
         
         # check if the round is over
-        terminated = new_level_data.game_info.state == GameState.ENDED or new_level_data.game_info.state == GameState.MATCH_COMPLETED
+        terminated = match_over(new_level_data)
         if terminated:
             logger.debug(f"terminated: {terminated}")
         self.truncated = new_level_data.own_player.health <= 0
         
         info = {}
+        info["action_mask"] = self.action_masks()
+        if macro_run is not None:
+            info["macro"] = {"frames": macro_run.frames, "interrupted": macro_run.interrupted}
+        self.adapt_skip_frames(new_level_data)
+        info["skip_frames"] = self.server_state.skip_frames
+        info["decide_every"] = self.server_state.decide_every
         
         # set the updated state
         self.state = new_level_data
-        obs = self.get_observation()
+        if self.frame_recorder is not None:
+            self.frame_recorder.mark_step(new_level_data, self.action_idx)
+        encode_started = time.perf_counter()
+        obs = self.observe(frame, out)
+        self.record_first_step()
+
+        # decoding (and encoding, with encode_in_server) happens on the server thread while this step waits
+        decode = server_state.decode_time - decode_time
+        server_encode = frame_encoder.encode_time - server_encode_time if frame_encoder is not None else 0.0
+        server_reward = frame_encoder.reward_time - server_reward_time if frame_encoder is not None else 0.0
+        info["timings"] = {
+            "game_wait": max(received - started - decode - server_encode - server_reward, 0.0),
+            "decode": decode,
+            "encode": server_encode + time.perf_counter() - encode_started,
+            "reward": server_reward + rewarded - received,
+        }
 
         return obs, reward, terminated, self.truncated, info
-    
-    def get_reward(self, new_level_data: LevelData):
-        reward = new_level_data.own_player.score - self.state.own_player.score
 
-        # # moved
-        # if round(self.state.own_player.position.x) != round(new_level_data.own_player.position.x) or round(self.state.own_player.position.y) != round(new_level_data.own_player.position.y):
-        #     reward += 1
-        
-        # took damage
-        if self.state.own_player.health - new_level_data.own_player.health > 0:
-            reward -= self.state.own_player.health - new_level_data.own_player.health
-        
-        # got zapped
-        if not self.state.own_player.is_zapped and new_level_data.own_player.is_zapped:
-            reward -= 10
-        
-        # got frozen
-        if not self.state.own_player.is_frozen and new_level_data.own_player.is_frozen:
-            reward -= 10
-        
-        # died
-        if self.state.own_player.health > 0 and new_level_data.own_player.health <= 0:
-            reward -= 30
-        
-        return reward
+    def observe(self, frame, out: np.ndarray = None, first: bool = False):
+        """Observation of the current state, taken from the server-encoded `frame` if there is one."""
+        if self.frame_stack is not None:
+            obs = self.stack_frame(None if frame is None else frame[1], first)
+            if out is None:
+                return obs
+            np.copyto(out, obs)
+            return out
+        if frame is None:
+            return self.encode_state(out)
+        if out is None:
+            # frame[1] is a BufferedFrameEncoder buffer the server rewrites two frames later, e.g. during the next macro
+            return frame[1].copy()
+        np.copyto(out, frame[1])
+        return out
+
+    def stack_frame(self, encoded: np.ndarray = None, first: bool = False):
+        """Push `encoded`, or the encoding of the current state, onto the frame stack and return the stack."""
+        target = self.frame_stack.frame_buffer()
+        if encoded is None:
+            self.encode_state(target)
+        else:
+            np.copyto(target, encoded)
+        return self.frame_stack.push(first)
+
+    def encode_state(self, out: np.ndarray = None) -> np.ndarray:
+        """
+        Encode the current state into `out` (allocated if not given). When the server decoded it as
+        a repeat of the frame encoded last (see frame_dedup.py), that observation is copied instead,
+        with only the game_info block rewritten for a frame whose volatile fields changed.
+        """
+        if out is None:
+            out = np.empty(self.encoder.size, dtype=np.float32)
+        level_data = self.state
+        repeat = self.server_state.repeat if self.server_state is not None else None
+        if repeat is not None and repeat[0] is level_data and repeat[2] is self.encoded_state:
+            np.copyto(out, self.encoded_obs)
+            if repeat[1] == VOLATILE:
+                self.encoder.encode_game_info(level_data, out)
+        else:
+            self.encoder.encode(level_data, out=out)
+        if self.encoded_obs is None:
+            self.encoded_obs = np.empty(self.encoder.size, dtype=np.float32)
+        np.copyto(self.encoded_obs, out)
+        self.encoded_state = level_data
+        return out
+
+    def take_encoded_frame(self, level_data: LevelData):
+        """Return (level_data, obs, reward) encoded by the server thread for `level_data`, if any."""
+        if self.frame_encoder is None:
+            return None
+        frame = self.frame_encoder.take()
+        if frame[0] is not level_data:
+            # the server did not encode this frame (e.g. the initial placeholder state)
+            return None
+        return frame
+    
+    def get_reward(self, new_level_data: LevelData, previous_level_data: LevelData = None):
+        previous = previous_level_data if previous_level_data is not None else self.state
+        return self.reward_function(previous, new_level_data)
 
 
     def get_observation(self):
@@ -230,85 +648,35 @@ class CustomEnv(gym.Env):
             dtype=np.float32)  # Adjust based on selected attributes
 
     def get_flat_observation_space(self):
-        return spaces.Box(
-            low=-np.inf, 
-            high=np.inf, 
-            shape=(
-                ((self.max_players - 1) * player_feature_count) + 
-                (own_player_feature_count) + 
-                (self.max_enemies*enemy_feature_count) +
-                game_info_feature_count+
-                (self.max_hazards * hazard_feature_count) +
-                (self.max_items * item_feature_count) +
-                (self.max_obstacles * obstacle_feature_count)+
-                (self.max_players * stat_feature_count)
-                ,
-                ), 
-            dtype=np.float32)  # Adjust based on selected attributes
+        if self.frame_stack is not None:
+            return self.frame_stack.observation_space()
+        return self.encoder.observation_space()
         
     def get_flat_observation(self):
         """Convert game state to a flattened NumPy array."""
-        players = self.state.players
-        own_player = self.state.own_player
-        center_pos = own_player.position
-        obs = []
-
-        # Add own player data
-        obs.extend(serialize_own_player(own_player))
-
-        for i in range(self.max_players-1):
-            if i < len(players):  # Existing player
-                player = players[i]
-                obs.extend(serialize_player(player, center_pos))
-            else:  # Fill empty slots if fewer than max 
-                obs.extend([0] * player_feature_count)
-        
-        for i in range(self.max_enemies):
-            if i < len(self.state.enemies):  # Enemies
-                enemy = self.state.enemies[i]
-                obs.extend(serialize_enemy(enemy, center_pos))
-            else:  # Fill empty slots if fewer than max
-                obs.extend([0] * enemy_feature_count)
-        
-        for i in range(self.max_hazards):
-            if i < len(self.state.hazards): 
-                hazard = self.state.hazards[i]
-                obs.extend(serialize_hazard(hazard, center_pos))
-            else:  # Fill empty slots if fewer than max
-                obs.extend([0] * hazard_feature_count)
-        
-        for i in range(self.max_items):
-            if i < len(self.state.items): 
-                item = self.state.items[i]
-                obs.extend(serialize_item(item, center_pos))
-            else:  # Fill empty slots if fewer than max
-                obs.extend([0] * item_feature_count)
-        
-        for i in range(self.max_obstacles):
-            if i < len(self.state.obstacles): 
-                obstacle = self.state.obstacles[i]
-                obs.extend(serialize_obstacle(obstacle, center_pos))
-            else:  # Fill empty slots if fewer than max
-                obs.extend([0] * obstacle_feature_count)
-        
-        for i in range(self.max_players):
-            if i < len(self.state.stats): 
-                stat = self.state.stats[i]
-                obs.extend(serialize_player_stat(stat))
-            else:  # Fill empty slots if fewer than max
-                obs.extend([0] * stat_feature_count)
-        
-        obs.extend(serialize_gameinfo(self.state.game_info))
-        
-        return np.array(obs, dtype=np.float32)
+        return self.encode_state()
 
     def render(self, mode='human'):
         # Implement rendering logic if needed
         pass
 
     def close(self):
-        # Implement any cleanup logic if needed
-        pass
+        if self.frame_server is not None:
+            self.frame_server.close()
+            self.frame_server = None
+        if self.uvicorn_server is not None:
+            self.uvicorn_server.should_exit = True
+            self.server_thread.join(timeout=5)
+            self.uvicorn_server = None
+        if self.frame_recorder is not None:
+            self.frame_recorder.close()
+            self.frame_recorder = None
+        if self.profiler is not None:
+            from profiler import remove_signal_toggle
+            remove_signal_toggle(self.profiler)
+            self.profiler.stop()
+            self.profiler = None
+        self.ready = None
 
 if __name__ == "__main__":
     env = CustomEnv()
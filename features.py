@@ -0,0 +1,372 @@
+"""
+Declarative observation features.
+
+A FeatureSpec lists, for every entity type, where its entities come from in
+LevelData, how many observation slots it gets and its features: the attribute to
+read, how to turn it into a number (scaled value, flag, length, categorical code,
+hashed id, or position relative to the own player) and the dtype it can be stored
+in. `default_spec()` describes the observation ObservationEncoder writes, feature for
+feature, with the dtypes, categorical mappings and feature counts of util's serializers.
+
+FeatureEncoder compiles a spec once into column extractors: every feature is read
+for all entities of a frame at once and written as one column of its block, and the
+Box space follows from the spec. Features or whole entity types can be dropped to
+shrink the observation, and a spec is saved as JSON next to the checkpoints so a
+model is always run with the features it was trained on:
+
+    spec = default_spec().select(drop=["stats", "obstacles", "enemies.is_pushed"])
+    spec.save("checkpoints/feature_spec.json")
+    env = CustomEnv(feature_spec="checkpoints/feature_spec.json")
+"""
+import json
+from dataclasses import asdict, dataclass, field, replace
+from itertools import chain
+from operator import attrgetter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from gymnasium import spaces
+
+from models import LevelData, Position
+from util import (F32, MAX_DAMAGE, MAX_HEALTH, MAX_KILLS, MAX_LEVELS, MAX_SCORE, MAX_SPEED, POSITION_FACTOR, COLLISION_TYPE_MAPPING,
+                  ENEMY_TYPE_MAPPING, GAME_STATE_MAPPING, HAZARD_STATUS_MAPPING, HAZARD_TYPE_MAPPING, ITEM_POWER_MAPPING, ITEM_TYPE_MAPPING,
+                  SPECIAL_EQUIPPED_MAPPING, collision_feature_count, collision_feature_dtypes, enemy_feature_dtypes,
+                  game_info_feature_dtypes, hazard_feature_dtypes, item_feature_dtypes, max_collisions, obstacle_feature_dtypes,
+                  own_player_feature_count, own_player_feature_dtypes, player_feature_dtypes, stat_feature_dtypes, string_to_int)
+
+# feature kinds
+VALUE = "value"        # number, divided by `scale`
+FLAG = "flag"          # bool as 0/1
+LENGTH = "length"      # len() of a list
+CATEGORY = "category"  # `mapping[value]`, `default` when missing
+ID = "id"              # string hashed with util.string_to_int
+X = "x"                # x position relative to the own player, in units of POSITION_FACTOR
+Y = "y"                # y position relative to the own player
+
+KINDS = (VALUE, FLAG, LENGTH, CATEGORY, ID, X, Y)
+
+# blocks that change from frame to frame, see FeatureEncoder.dynamic_size
+DYNAMIC_ENTITIES = ("own_player", "collisions", "players", "enemies", "hazards")
+
+
+@dataclass
+class Feature:
+    """One observation column. `path` is the (dotted) attribute read from the entity, the name by default."""
+    name: str
+    kind: str = VALUE
+    path: Optional[str] = None
+    scale: float = 1
+    mapping: Optional[Dict[str, float]] = None
+    default: float = 0
+    dtype: str = F32
+
+    def __post_init__(self):
+        if self.kind not in KINDS:
+            raise ValueError(f"feature {self.name!r} has unknown kind {self.kind!r}, expected one of {KINDS}")
+        if self.kind == CATEGORY and self.mapping is None:
+            raise ValueError(f"categorical feature {self.name!r} needs a mapping")
+        if self.path is None:
+            self.path = self.name
+
+
+@dataclass
+class EntitySpec:
+    """
+    An observation block: `slots` entities from the list at `source` (a dotted path
+    on LevelData), or the single object there when `single`.
+    """
+    name: str
+    source: str
+    slots: int
+    features: List[Feature] = field(default_factory=list)
+    single: bool = False
+
+    @property
+    def size(self) -> int:
+        return self.slots * len(self.features)
+
+
+@dataclass
+class FeatureSpec:
+    entities: List[EntitySpec]
+
+    @property
+    def size(self) -> int:
+        return sum(entity.size for entity in self.entities)
+
+    def names(self) -> List[str]:
+        """Entity names and `entity.feature` names, the ones `select` accepts."""
+        return [name for entity in self.entities for name in [entity.name] + [f"{entity.name}.{f.name}" for f in entity.features]]
+
+    def select(self, drop: Iterable[str] = (), slots: Dict[str, int] = None) -> "FeatureSpec":
+        """
+        A copy without the dropped entities (`"stats"`) and features (`"enemies.is_pushed"`),
+        and with the slot counts in `slots` changed.
+        """
+        drop = set(drop)
+        slots = slots or {}
+        valid = set(self.names())
+        unknown = (drop | set(slots)) - valid
+        if unknown:
+            raise ValueError(f"unknown features {sorted(unknown)}, expected names from {self.names()}")
+        entities = []
+        for entity in self.entities:
+            if entity.name in drop:
+                continue
+            features = [replace(f) for f in entity.features if f"{entity.name}.{f.name}" not in drop]
+            if features:
+                entities.append(replace(entity, features=features, slots=slots.get(entity.name, entity.slots)))
+        return FeatureSpec(entities)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FeatureSpec":
+        return cls([EntitySpec(**dict(entity, features=[Feature(**f) for f in entity["features"]]))
+                    for entity in data["entities"]])
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path: str) -> "FeatureSpec":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def _entity(name: str, source: str, slots: int, features: List[Feature], dtypes: List[str], single: bool = False) -> EntitySpec:
+    """An EntitySpec of util's serializer layout: `features` in serializer order, with its dtypes."""
+    if len(features) != len(dtypes):
+        raise ValueError(f"{name} declares {len(features)} features, util's serializer writes {len(dtypes)}")
+    return EntitySpec(name, source, slots, [replace(f, dtype=dtype) for f, dtype in zip(features, dtypes)], single=single)
+
+
+def _player_features() -> List[Feature]:
+    return [
+        Feature("id", ID),
+        Feature("x", X, path="position.x"),
+        Feature("y", Y, path="position.y"),
+        Feature("health", scale=MAX_HEALTH),
+        Feature("max_health", scale=MAX_HEALTH),
+        Feature("base_speed", scale=MAX_SPEED),
+        Feature("attack_damage", scale=MAX_DAMAGE),
+        Feature("shield_raised", FLAG),
+        Feature("direction", CATEGORY, mapping={"right": 1}),
+        Feature("is_attacking", FLAG),
+        Feature("score", scale=MAX_SCORE),
+        Feature("level", path="levelling.level", scale=MAX_LEVELS),
+        Feature("is_dashing", FLAG),
+        Feature("is_frozen", FLAG),
+        Feature("is_pushed", FLAG),
+        Feature("is_zapped", FLAG),
+        Feature("is_overclocking", FLAG),
+        Feature("has_health_regen", FLAG),
+        Feature("points", scale=MAX_SCORE),
+        Feature("special_equipped", CATEGORY, mapping=dict(SPECIAL_EQUIPPED_MAPPING)),
+        Feature("unleashing_shockwave", FLAG),
+    ]
+
+
+def default_spec(max_players=6, max_enemies=40, max_items=60, max_hazards=20, max_obstacles=1500) -> FeatureSpec:
+    """
+    The features of ObservationEncoder, in its order. Dtypes, categorical mappings and
+    feature counts are util's, the ones its serializers write.
+    """
+    # util counts the collision slots as part of the own player
+    own_player_dtypes = own_player_feature_dtypes[:own_player_feature_count - max_collisions * collision_feature_count]
+    return FeatureSpec([
+        _entity("own_player", "own_player", 1, single=True, dtypes=own_player_dtypes, features=_player_features() + [
+            Feature("is_cloaked", FLAG),
+            Feature("is_colliding", FLAG),
+            Feature("is_dash_ready", FLAG),
+            Feature("is_shield_ready", FLAG),
+            Feature("is_special_ready", FLAG),
+            Feature("is_zap_ready", FLAG),
+            Feature("overclock_duration"),
+            Feature("big_potions", LENGTH, path="items.big_potions"),
+            Feature("speed_zappers", LENGTH, path="items.speed_zappers"),
+            Feature("rings", LENGTH, path="items.rings"),
+            Feature("available_skill_points", path="levelling.available_skill_points"),
+            Feature("attack_points", path="levelling.attack"),
+            Feature("health_points", path="levelling.health"),
+            Feature("speed_points", path="levelling.speed"),
+        ]),
+        _entity("collisions", "own_player.collisions", max_collisions, dtypes=collision_feature_dtypes, features=[
+            Feature("x", path="relative_position.x", scale=POSITION_FACTOR),
+            Feature("y", path="relative_position.y", scale=POSITION_FACTOR),
+            Feature("type", CATEGORY, mapping=dict(COLLISION_TYPE_MAPPING)),
+        ]),
+        _entity("players", "players", max_players - 1, dtypes=player_feature_dtypes, features=_player_features()),
+        _entity("enemies", "enemies", max_enemies, dtypes=enemy_feature_dtypes, features=[
+            Feature("x", X, path="position.x"),
+            Feature("y", Y, path="position.y"),
+            Feature("health", scale=MAX_HEALTH),
+            Feature("max_health", scale=MAX_HEALTH),
+            Feature("attack_damage", scale=MAX_DAMAGE),
+            Feature("direction", CATEGORY, mapping={"right": 1}),
+            Feature("is_attacking", FLAG),
+            Feature("is_frozen", FLAG),
+            Feature("is_pushed", FLAG),
+            Feature("is_zapped", FLAG),
+            Feature("points", scale=MAX_SCORE),
+            Feature("type", CATEGORY, mapping=dict(ENEMY_TYPE_MAPPING)),
+        ]),
+        _entity("hazards", "hazards", max_hazards, dtypes=hazard_feature_dtypes, features=[
+            Feature("x", X, path="position.x"),
+            Feature("y", Y, path="position.y"),
+            Feature("type", CATEGORY, mapping=dict(HAZARD_TYPE_MAPPING), default=-1),
+            Feature("attack_damage", scale=MAX_DAMAGE),
+            Feature("status", CATEGORY, mapping=dict(HAZARD_STATUS_MAPPING)),
+        ]),
+        _entity("items", "items", max_items, dtypes=item_feature_dtypes, features=[
+            Feature("x", X, path="position.x"),
+            Feature("y", Y, path="position.y"),
+            Feature("type", CATEGORY, mapping=dict(ITEM_TYPE_MAPPING), default=-1),
+            Feature("points", scale=MAX_SCORE),
+            Feature("value"),
+            Feature("power", CATEGORY, mapping=dict(ITEM_POWER_MAPPING), default=-1),
+        ]),
+        _entity("obstacles", "obstacles", max_obstacles, dtypes=obstacle_feature_dtypes, features=[
+            Feature("x", X),
+            Feature("y", Y),
+        ]),
+        _entity("stats", "stats", max_players, dtypes=stat_feature_dtypes, features=[
+            Feature("id", ID),
+            Feature("score", scale=MAX_SCORE),
+            Feature("kills", scale=MAX_KILLS),
+            Feature("deaths", scale=MAX_KILLS),
+            Feature("xps"),
+            Feature("coins", scale=MAX_KILLS),
+            Feature("kd_ratio"),
+            Feature("kill_streak"),
+            Feature("overclocks"),
+            Feature("wolf_kills", scale=MAX_KILLS),
+            Feature("ghoul_kills", scale=MAX_KILLS),
+            Feature("minotaur_kills", scale=MAX_KILLS),
+            Feature("tiny_kills", scale=MAX_KILLS),
+            Feature("player_kills", scale=MAX_KILLS),
+        ]),
+        _entity("game_info", "game_info", 1, single=True, dtypes=game_info_feature_dtypes, features=[
+            Feature("state", CATEGORY, mapping=dict(GAME_STATE_MAPPING)),
+            Feature("map", ID),
+            Feature("time_remaining_s", scale=60),
+            Feature("latency"),
+            Feature("friendly_fire", FLAG),
+            Feature("game_type", CATEGORY, mapping={"rpg": 1}),
+        ]),
+    ])
+
+
+def _compile_column(feature: Feature):
+    """Python extractor of a non-numeric feature: its values for a list of entities."""
+    get = attrgetter(feature.path)
+    if feature.kind == LENGTH:
+        return lambda entities: [len(value) for value in map(get, entities)]
+    if feature.kind == CATEGORY:
+        lookup, default = feature.mapping.get, feature.default
+        return lambda entities: [lookup(value, default) for value in map(get, entities)]
+    return lambda entities: [string_to_int(value) for value in map(get, entities)]
+
+
+class _CompiledEntity:
+    """
+    The extractors of one EntitySpec. Numeric features (values, flags, positions) are
+    read for each entity with a single attrgetter and scaled as one matrix; lengths,
+    categories and ids go through a Python lookup per column.
+    """
+
+    def __init__(self, entity: EntitySpec, offset: int):
+        self.entity = entity
+        self.offset = offset
+        self.source = attrgetter(entity.source)
+        numeric = [i for i, f in enumerate(entity.features) if f.kind in (VALUE, FLAG, X, Y)]
+        self.numeric = np.array(numeric, dtype=np.intp)
+        self.getter = None
+        if numeric:
+            # attrgetter returns a bare value for a single path, keep the rows as tuples
+            getter = attrgetter(*[entity.features[i].path for i in numeric])
+            self.getter = getter if len(numeric) > 1 else (lambda e: (getter(e),))
+        self.divisor = np.array([POSITION_FACTOR if entity.features[i].kind in (X, Y) else entity.features[i].scale
+                                 for i in numeric], dtype=np.float64)
+        self.is_x = np.array([entity.features[i].kind == X for i in numeric])
+        self.is_y = np.array([entity.features[i].kind == Y for i in numeric])
+        self.relative = bool(self.is_x.any() or self.is_y.any())
+        self.columns = [(i, _compile_column(f)) for i, f in enumerate(entity.features) if f.kind not in (VALUE, FLAG, X, Y)]
+
+    def write(self, level_data: LevelData, center: Position, out: np.ndarray):
+        entity = self.entity
+        entities = self.source(level_data)
+        entities = [entities] if entity.single else entities[:entity.slots]
+        count = len(entities)
+        block = out[self.offset:self.offset + entity.size].reshape(entity.slots, len(entity.features))
+        if count:
+            if len(self.numeric):
+                # in float64 like the serializers, the block is a float32 view
+                values = np.fromiter(chain.from_iterable(map(self.getter, entities)), np.float64,
+                                     count * len(self.numeric)).reshape(count, -1)
+                if self.relative:
+                    values -= self.is_x * center.x + self.is_y * center.y
+                values /= self.divisor
+                block[:count, self.numeric] = values
+            for column, extract in self.columns:
+                block[:count, column] = extract(entities)
+        block[count:] = 0
+
+
+class FeatureEncoder:
+    """
+    Writes a LevelData into a flat float32 observation as described by a FeatureSpec.
+
+    Has the interface of ObservationEncoder (`size`, `blocks`, `encode`, `encode_game_info`,
+    `observation_space`, `feature_dtypes`, `dynamic_size`, `static_block`), without its
+    slot tracking, map-coordinate obstacles or clearance block.
+    """
+
+    def __init__(self, spec: FeatureSpec):
+        self.spec = spec
+        # (name, slots, feature count, feature dtypes), in encoding order
+        self.layout = [(entity.name, entity.slots, len(entity.features), [f.dtype for f in entity.features])
+                       for entity in spec.entities]
+        self.blocks: Dict[str, Tuple[int, int]] = {}
+        self.compiled = []
+        offset = 0
+        for entity in spec.entities:
+            self.blocks[entity.name] = (offset, offset + entity.size)
+            self.compiled.append(_CompiledEntity(entity, offset))
+            offset += entity.size
+        self.size = offset
+
+    def observation_space(self):
+        return spaces.Box(low=-np.inf, high=np.inf, shape=(self.size,), dtype=np.float32)
+
+    def feature_dtypes(self) -> np.ndarray:
+        return np.array([f.dtype for entity in self.spec.entities for _ in range(entity.slots) for f in entity.features])
+
+    def dynamic_size(self) -> int:
+        """Length of the leading blocks that change from frame to frame (own player, players, enemies, hazards)."""
+        end = 0
+        for name, (_, block_end) in self.blocks.items():
+            if name not in DYNAMIC_ENTITIES:
+                break
+            end = block_end
+        return end
+
+    def static_block(self) -> Optional[Tuple[int, int]]:
+        return None
+
+    def encode(self, level_data: LevelData, out: Optional[np.ndarray] = None) -> np.ndarray:
+        """Encode `level_data` into `out` (allocated if not given) and return it."""
+        if out is None:
+            out = np.empty(self.size, dtype=np.float32)
+        center = level_data.own_player.position
+        for compiled in self.compiled:
+            compiled.write(level_data, center, out)
+        return out
+
+    def encode_game_info(self, level_data: LevelData, out: np.ndarray):
+        """Rewrite only the game_info block of an observation of `level_data`."""
+        for compiled in self.compiled:
+            if compiled.entity.name == "game_info":
+                compiled.write(level_data, level_data.own_player.position, out)
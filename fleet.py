@@ -0,0 +1,226 @@
+"""
+Trains on N env workers side by side, each paired with its own game client.
+
+Every worker is a CustomEnv in its own process (SB3's SubprocVecEnv) with its frame
+server on a port allocated at launch. Each port gets a game client: the command
+given with --client_command, where `{port}` is replaced by the port, or the local
+stand-in (standin.py). A supervisor thread watches every server's frame counter
+(GET /metrics) as a heartbeat and restarts a client that exited or stopped sending
+frames. Meanwhile the env steps of that worker time out after --step_timeout and
+truncate the episode, and its next reset waits for the restarted game, so
+`model.learn` keeps running. A server that stops answering is warned about once, and
+its client is not restarted until the server is back.
+
+    python fleet.py --n_envs 8
+    python fleet.py --n_envs 8 --client_command "/path/to/start_game.sh {port}"
+"""
+import argparse
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from functools import partial
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "standin.py")
+
+
+def allocate_ports(n: int, base_port: int = None, host: str = "127.0.0.1") -> List[int]:
+    """
+    `n` free TCP ports, counting up from `base_port` or picked by the OS.
+
+    The ports are only checked, not held, so another process could still take one
+    before its frame server binds it; the server then fails to start with an error.
+    """
+    sockets = []
+    port = base_port
+    try:
+        # hold every socket until all are bound, so the OS does not hand out a port twice
+        while len(sockets) < n:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                s.bind((host, port if base_port is not None else 0))
+            except OSError:
+                s.close()
+            else:
+                sockets.append(s)
+            if base_port is not None:
+                port += 1
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def start_env(port: int, **env_kwargs):
+    """Env worker factory: a CustomEnv whose frame server is already listening on `port`, in a Monitor."""
+    from stable_baselines3.common.monitor import Monitor
+
+    from env import CustomEnv
+
+    env = CustomEnv(port=port, **env_kwargs)
+    env.start().result()
+    # episode statistics for rollout/ep_len_mean and ep_rew_mean, SB3 does not add it to VecEnvs
+    return Monitor(env)
+
+
+class GameClient:
+    """The game client process of one port, started from `command` (`{port}` is substituted) or the stand-in."""
+
+    def __init__(self, port: int, command: str = None, standin_fps: float = 60):
+        self.port = port
+        if command is None:
+            self.argv = [sys.executable, STANDIN, "--port", str(port), "--fps", str(standin_fps)]
+        else:
+            self.argv = shlex.split(command.format(port=port))
+        self.process: Optional[subprocess.Popen] = None
+        self.restarts = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(self.argv)
+
+    def stop(self, timeout: float = 5.0):
+        if not self.alive:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+
+class Fleet:
+    """
+    N env workers and their game clients, with a supervisor restarting stalled clients.
+
+    :param client_command: command starting a game client, `{port}` is replaced by its env's port;
+        None runs the stand-in
+    :param base_port: allocate consecutive free ports from here instead of letting the OS pick them
+    :param stall_timeout: seconds without a frame after which a client is restarted
+    :param startup_timeout: seconds a (re)started client has to send its first frame
+    :param env_kwargs: forwarded to every CustomEnv
+    """
+
+    def __init__(self, n_envs: int, client_command: str = None, base_port: int = None, standin_fps: float = 60,
+                 stall_timeout: float = 20.0, startup_timeout: float = 60.0, poll_interval: float = 1.0, **env_kwargs):
+        self.ports = allocate_ports(n_envs, base_port)
+        self.clients = [GameClient(port, client_command, standin_fps) for port in self.ports]
+        self.stall_timeout = stall_timeout
+        self.startup_timeout = startup_timeout
+        self.poll_interval = poll_interval
+        self.env_kwargs = env_kwargs
+        self.stop_event = threading.Event()
+        self.supervisor = None
+
+    def make_vec_env(self):
+        """Start the env workers, one process per port, with their servers listening."""
+        from stable_baselines3.common.vec_env import SubprocVecEnv
+
+        return SubprocVecEnv([partial(start_env, port, **self.env_kwargs) for port in self.ports])
+
+    def start(self):
+        """Start the game clients and their supervisor."""
+        for client in self.clients:
+            client.start()
+        logger.info(f"started {len(self.clients)} game clients on ports {self.ports}")
+        self.supervisor = threading.Thread(target=self._supervise, name="fleet-supervisor", daemon=True)
+        self.supervisor.start()
+
+    def heartbeat(self, port: int) -> Optional[int]:
+        """Frames the server on `port` has received, None if it does not answer."""
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=self.poll_interval) as response:
+                return json.load(response)["frames_received"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _supervise(self):
+        now = time.monotonic()
+        frames = [None] * len(self.clients)
+        # when each client last made progress, and how long it may go without
+        progressed_at = [now] * len(self.clients)
+        allowed = [self.startup_timeout] * len(self.clients)
+        while not self.stop_event.wait(self.poll_interval):
+            now = time.monotonic()
+            for i, client in enumerate(self.clients):
+                received = self.heartbeat(client.port)
+                if received is not None and received != frames[i]:
+                    if frames[i] is not None:
+                        allowed[i] = self.stall_timeout
+                    frames[i] = received
+                    progressed_at[i] = now
+                    continue
+                if received is None:
+                    # the env worker is down, not the game: restarting the client would not help
+                    if frames[i] is not None:
+                        logger.warning(f"env server on port {client.port} stopped answering")
+                        frames[i] = None
+                        allowed[i] = self.startup_timeout
+                    progressed_at[i] = now
+                    continue
+                if client.alive and now - progressed_at[i] < allowed[i]:
+                    continue
+                reason = "exited" if not client.alive else f"sent no frame for {now - progressed_at[i]:.0f}s"
+                logger.warning(f"game client on port {client.port} {reason}, restarting it")
+                client.restart()
+                progressed_at[i] = now
+                allowed[i] = self.startup_timeout
+
+    def close(self):
+        self.stop_event.set()
+        if self.supervisor is not None:
+            self.supervisor.join()
+        for client in self.clients:
+            client.stop()
+
+
+if __name__ == "__main__":
+    from training import add_env_arguments, add_training_arguments, check_arguments, env_kwargs, feature_spec, learn, ppo_class
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_envs", type=int, default=max((os.cpu_count() or 2) // 2, 1), help="env workers and game clients")
+    parser.add_argument("--client_command", type=str, default=None, help="game client command, {port} is replaced by its env's port; the stand-in by default")
+    parser.add_argument("--base_port", type=int, default=None, help="allocate ports from here instead of letting the OS pick them")
+    parser.add_argument("--standin_fps", type=float, default=60)
+    parser.add_argument("--stall_timeout", type=float, default=20.0, help="restart a game client after this many seconds without a frame")
+    parser.add_argument("--step_timeout", type=float, default=10.0, help="truncate the episode when a step waits longer for its frame")
+    add_training_arguments(parser)
+    add_env_arguments(parser)
+
+    args = parser.parse_args()
+    check_arguments(parser, args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Heavy imports are deferred until the arguments are parsed, so that --help starts instantly
+    PPO = ppo_class(parser, args)
+
+    spec = feature_spec(args)
+    fleet = Fleet(args.n_envs, client_command=args.client_command, base_port=args.base_port, standin_fps=args.standin_fps,
+                  stall_timeout=args.stall_timeout, step_timeout=args.step_timeout, **env_kwargs(args, spec))
+    env = fleet.make_vec_env()
+    fleet.start()
+    try:
+        model = PPO("MlpPolicy", env, n_steps=args.n_steps, n_epochs=args.n_epochs, batch_size=args.n_steps)
+        learn(model, args, spec)
+    finally:
+        fleet.close()
+        env.close()
@@ -0,0 +1,90 @@
+"""
+Recognizes posted frames that repeat the previously decoded one.
+
+While the game waits, ends a match or shows the death screen, and whenever it ticks
+faster than its state changes, consecutive frames are often byte for byte identical
+or only differ in `game_info.time_remaining_s` and `game_info.latency`. Such frames
+are not parsed again: an identical body reuses the previous LevelData, and one that
+only differs in those fields reuses it with a copy of its GameInfo carrying the new
+values. The frame server reports how often that happens at GET /metrics.
+"""
+import json
+import re
+from dataclasses import replace
+from typing import Callable, Optional, Tuple
+
+from models import LevelData
+
+EXACT = "exact"
+VOLATILE = "volatile"
+
+# game_info fields that change on frames that are otherwise the same, and the start of their values
+VOLATILE_FIELDS = [(name, re.compile(rb'"' + name.encode() + rb'"\s*:\s*')) for name in ("time_remaining_s", "latency")]
+VALUE_END = re.compile(rb"[\s,}\]]")
+
+
+def split_volatile(body: bytes) -> Tuple[bytes, Optional[dict]]:
+    """The body without the values of the volatile fields, and those values; None for the values when one is missing."""
+    spans = []
+    for name, pattern in VOLATILE_FIELDS:
+        match = pattern.search(body)
+        if match is None:
+            return body, None
+        end = VALUE_END.search(body, match.end())
+        spans.append((match.end(), end.start() if end is not None else len(body), name))
+    spans.sort()
+    parts, values, position = [], {}, 0
+    for start, end, name in spans:
+        parts.append(body[position:start])
+        values[name] = json.loads(body[start:end])
+        position = end
+    parts.append(body[position:])
+    return b"".join(parts), values
+
+
+class DuplicateFrames:
+    """
+    The LevelData of the last decoded frame, keyed on its body.
+
+    Only frames that are decoded should be passed in: the previous body must be the
+    previous frame the LevelData describes, so delta frames that are merged without
+    being decoded call `forget`.
+    """
+
+    def __init__(self):
+        self.body: Optional[bytes] = None
+        self.stripped: Optional[bytes] = None
+        self.level_data: Optional[LevelData] = None
+        self.checked = 0
+        self.exact = 0
+        self.volatile = 0
+
+    def forget(self):
+        self.body = self.stripped = self.level_data = None
+
+    def decode(self, body: bytes, parse: Callable[[], LevelData]) -> Tuple[LevelData, Optional[str]]:
+        """
+        The LevelData of `body`, from `parse` unless it repeats the previous body, and
+        EXACT or VOLATILE when it does (None otherwise).
+        """
+        self.checked += 1
+        if body == self.body:
+            self.exact += 1
+            return self.level_data, EXACT
+        stripped, values = split_volatile(body)
+        if values is not None and stripped == self.stripped:
+            self.volatile += 1
+            level_data = replace(self.level_data, game_info=replace(self.level_data.game_info, **values))
+            hit = VOLATILE
+        else:
+            level_data = parse()
+            hit = None
+        self.body, self.stripped, self.level_data = body, stripped if values is not None else None, level_data
+        return level_data, hit
+
+    def metrics(self) -> dict:
+        return {
+            "duplicate_frames": self.exact,
+            "near_duplicate_frames": self.volatile,
+            "duplicate_hit_rate": (self.exact + self.volatile) / self.checked if self.checked else 0.0,
+        }
@@ -0,0 +1,203 @@
+import json
+import logging
+import multiprocessing as mp
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# header slots
+CMD = 0
+ACTION = 1
+WRITE_SEQ = 2
+CONTROL_LENGTH = 3
+HEADER_SIZE = 8
+
+# commands
+CMD_STEP = 1
+CMD_RESET = 2
+CMD_ERROR = 3
+
+CONTROL_BYTES = 4096
+
+
+class SharedFrameRing:
+    """
+    A ring of encoded frames in one `multiprocessing.shared_memory` block.
+
+    Layout: an int64 header, a JSON control area, then per slot the observation,
+    reward and (terminated, truncated) flags. Nothing on the frame path is pickled:
+    the env writes the action into the header and the server process writes the next
+    frame into slot `write_seq % slots`. The control area carries the reset arguments
+    to the server process and the info of each step and reset back, which the env
+    reads before it sends the next command.
+    """
+
+    def __init__(self, size: int, slots: int = 4, name: str = None):
+        self.size = size
+        self.slots = slots
+        header_bytes = HEADER_SIZE * 8
+        obs_bytes = slots * size * 4
+        reward_bytes = slots * 8
+        flag_bytes = slots * 2
+        total = header_bytes + CONTROL_BYTES + obs_bytes + reward_bytes + flag_bytes
+
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=total)
+
+        offset = 0
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf, offset=offset)
+        offset += header_bytes
+        self.control = np.ndarray((CONTROL_BYTES,), dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+        offset += CONTROL_BYTES
+        self.observations = np.ndarray((slots, size), dtype=np.float32, buffer=self.shm.buf, offset=offset)
+        offset += obs_bytes
+        self.rewards = np.ndarray((slots,), dtype=np.float64, buffer=self.shm.buf, offset=offset)
+        offset += reward_bytes
+        self.flags = np.ndarray((slots, 2), dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+        if self.owner:
+            self.header[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write_control(self, payload: dict):
+        data = json.dumps(payload, default=_to_json).encode()
+        if len(data) > CONTROL_BYTES:
+            raise ValueError(f"control payload exceeds {CONTROL_BYTES} bytes")
+        self.control[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.header[CONTROL_LENGTH] = len(data)
+
+    def read_control(self) -> dict:
+        length = int(self.header[CONTROL_LENGTH])
+        return json.loads(self.control[:length].tobytes()) if length else {}
+
+    def next_slot(self) -> int:
+        return int(self.header[WRITE_SEQ]) % self.slots
+
+    def publish(self):
+        self.header[WRITE_SEQ] += 1
+
+    def latest_slot(self) -> int:
+        return (int(self.header[WRITE_SEQ]) - 1) % self.slots
+
+    def close(self):
+        # drop the numpy views before closing the mapping
+        self.header = self.control = self.observations = self.rewards = self.flags = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _to_json(value):
+    """numpy arrays and scalars in the info dict, e.g. the action mask, as JSON values."""
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def run_frame_server(ring_name, size, slots, env_kwargs, request, ready, started, stop):
+    """Entry point of the server process: runs an in-process CustomEnv and serves it through the ring."""
+    logging.basicConfig(level=logging.INFO)
+    from env import CustomEnv
+
+    ring = SharedFrameRing(size, slots, name=ring_name)
+    env = CustomEnv(**env_kwargs)
+    try:
+        env.start().result()
+        started.set()
+        while not stop.is_set():
+            if not request.acquire(timeout=0.5):
+                continue
+            slot = ring.next_slot()
+            try:
+                if ring.header[CMD] == CMD_RESET:
+                    control = ring.read_control()
+                    obs, info = env.reset(seed=control.get("seed"), options=control.get("options"))
+                    reward, terminated, truncated = 0, False, False
+                else:
+                    obs, reward, terminated, truncated, info = env.step(int(ring.header[ACTION]))
+                ring.write_control(info)
+            except Exception:
+                logger.exception("frame server failed")
+                ring.header[CMD] = CMD_ERROR
+                ready.release()
+                return
+            ring.observations[slot] = obs
+            ring.rewards[slot] = reward
+            ring.flags[slot] = (terminated, truncated)
+            ring.publish()
+            ready.release()
+    finally:
+        env.close()
+        ring.close()
+
+
+class FrameServerProcess:
+    """
+    Env-side handle of a frame server running in its own process.
+
+    Observations are returned as views into the shared ring and stay valid for the
+    next `slots - 1` steps. Infos are decoded from JSON, with the action mask as a
+    boolean array again.
+    """
+
+    def __init__(self, size: int, env_kwargs: dict, slots: int = 4, timeout: float = 5.0):
+        ctx = mp.get_context("spawn")
+        self.ring = SharedFrameRing(size, slots)
+        self.request = ctx.Semaphore(0)
+        self.ready = ctx.Semaphore(0)
+        self.started = ctx.Event()
+        self.stop = ctx.Event()
+        self.timeout = timeout
+        self.process = ctx.Process(
+            target=run_frame_server,
+            args=(self.ring.name, size, slots, env_kwargs, self.request, self.ready, self.started, self.stop),
+            daemon=True,
+        )
+        self.process.start()
+
+    def wait_started(self, ready: Future):
+        """Resolve `ready` once the server process accepts connections."""
+        while not self.started.wait(timeout=0.1):
+            if not self.process.is_alive():
+                ready.set_exception(RuntimeError(f"frame server process exited with code {self.process.exitcode}"))
+                return
+        ready.set_result(True)
+
+    def _wait(self):
+        while not self.ready.acquire(timeout=self.timeout):
+            if not self.process.is_alive():
+                raise RuntimeError(f"frame server process exited with code {self.process.exitcode}")
+        if self.ring.header[CMD] == CMD_ERROR:
+            raise RuntimeError("frame server process failed, see its log for details")
+        slot = self.ring.latest_slot()
+        terminated, truncated = self.ring.flags[slot]
+        info = self.ring.read_control()
+        if "action_mask" in info:
+            info["action_mask"] = np.array(info["action_mask"], dtype=bool)
+        return self.ring.observations[slot], float(self.ring.rewards[slot]), bool(terminated), bool(truncated), info
+
+    def reset(self, seed=None, options=None):
+        self.ring.write_control({"seed": seed, "options": options})
+        self.ring.header[CMD] = CMD_RESET
+        self.request.release()
+        obs, _, _, _, info = self._wait()
+        return obs, info
+
+    def step(self, action_idx: int):
+        self.ring.header[ACTION] = action_idx
+        self.ring.header[CMD] = CMD_STEP
+        self.request.release()
+        return self._wait()
+
+    def close(self):
+        self.stop.set()
+        self.process.join(timeout=self.timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.ring.close()
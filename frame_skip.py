@@ -0,0 +1,99 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FrameSkipController:
+    """
+    Adjusts the frame server's `decide_every` online to hold a target decision rate.
+
+    With `decide_every = N` the env decides on every Nth frame it waits on and the
+    server skips the N - 1 before it (1 skips nothing), so the decision rate is about
+    the game's frame rate divided by N and any rate down to fps / max_every can be
+    reached. Every `interval` steps the controller looks at what it measured:
+
+    - the decision rate, from the env-side time between steps;
+    - the frames the game sent per step, and how many of them arrived while the env
+      was busy and were ignored: when the env itself misses frames, skipping on top
+      only adds latency;
+    - the `game_info.latency` the game reports.
+
+    When decisions are faster than `target_rate` N is scaled by the rate error, by at
+    least one, and the same when they are slower; when they are slower and frames are
+    being missed skipping is turned off (N = 1). N is also raised when the game latency
+    exceeds `max_latency_ms`. It stays within [min_every, max_every].
+
+    :param target_rate: decisions per second to aim for
+    :param initial: starting value, 1 decides on every frame
+    :param interval: steps between adjustments
+    :param tolerance: relative rate error that is left alone
+    """
+
+    def __init__(self, target_rate: float, min_every: int = 1, max_every: int = 30, initial: int = 1,
+                 interval: int = 30, tolerance: float = 0.1, max_latency_ms: float = 100):
+        if min_every < 1:
+            raise ValueError(f"min_every must be at least 1, got {min_every}")
+        if max_every < min_every:
+            raise ValueError(f"max_every ({max_every}) is below min_every ({min_every})")
+        self.target_rate = target_rate
+        self.min_every = min_every
+        self.max_every = max_every
+        self.interval = interval
+        self.tolerance = tolerance
+        self.max_latency_ms = max_latency_ms
+        self.decide_every = min(max(initial, min_every), max_every)
+
+        self._reset_window()
+        # last measurements, for info and metrics
+        self.decision_rate = 0.0
+        self.frames_per_step = 0.0
+        self.missed_per_step = 0.0
+        self.latency_ms = 0.0
+
+    def _reset_window(self):
+        self.steps = 0
+        self.step_time = 0.0
+        self.frames = 0
+        self.missed = 0
+        self.latency = 0.0
+
+    def update(self, step_time_s: float, frames: int, missed: int, latency_ms: float) -> int:
+        """Record one step (its duration, frames received and frames missed) and return the decide_every value to use."""
+        self.steps += 1
+        self.step_time += step_time_s
+        self.frames += frames
+        self.missed += missed
+        self.latency += latency_ms
+        if self.steps < self.interval:
+            return self.decide_every
+
+        self.decision_rate = self.steps / self.step_time if self.step_time > 0 else float("inf")
+        self.frames_per_step = self.frames / self.steps
+        self.missed_per_step = self.missed / self.steps
+        self.latency_ms = self.latency / self.steps
+        self._reset_window()
+
+        previous = self.decide_every
+        # decisions are about the frame rate divided by N, so N scales with the rate error
+        scaled = round(self.decide_every * self.decision_rate / self.target_rate)
+        if self.decision_rate > self.target_rate * (1 + self.tolerance):
+            self.decide_every = max(scaled, self.decide_every + 1)
+        elif self.decision_rate < self.target_rate * (1 - self.tolerance):
+            self.decide_every = 1 if self.missed_per_step >= 0.5 else min(scaled, self.decide_every - 1)
+        if self.latency_ms > self.max_latency_ms:
+            self.decide_every = max(self.decide_every, previous + 1)
+        self.decide_every = min(max(self.decide_every, self.min_every), self.max_every)
+        if self.decide_every != previous:
+            logger.debug(f"decide_every {previous} -> {self.decide_every}: {self.decision_rate:.1f} decisions/s, "
+                         f"{self.frames_per_step:.2f} frames/step ({self.missed_per_step:.2f} missed), latency {self.latency_ms:.0f} ms")
+        return self.decide_every
+
+    def metrics(self) -> dict:
+        return {
+            "decide_every": self.decide_every,
+            "target_decision_rate": self.target_rate,
+            "decision_rate": self.decision_rate,
+            "frames_per_step": self.frames_per_step,
+            "frames_missed_per_step": self.missed_per_step,
+            "game_latency_ms": self.latency_ms,
+        }
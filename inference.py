@@ -0,0 +1,128 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Union
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def game_latency(env) -> float:
+    """Highest `game_info.latency` (ms) reported across the envs of a VecEnv, 0 if unknown."""
+    try:
+        return max(float(state.game_info.latency) for state in env.get_attr("state"))
+    except (AttributeError, TypeError, ValueError):
+        # placeholder state before the first frame, or state not mirrored (server_process)
+        return 0.0
+
+
+class DeadlineInferenceRunner:
+    """
+    Runs the policy forward pass under a per-frame deadline.
+
+    The budget for each decision is one game frame minus the latency the game
+    reports, never less than `min_budget_s`. The forward pass runs with gradients
+    disabled on a worker thread and reads from a preallocated input tensor. When it
+    misses the deadline the runner answers with the fallback action instead (the
+    previous action, or a fixed action index) and picks the late result up as the
+    new previous action once it lands.
+
+    :param model: a loaded SB3 model (e.g. PPO)
+    :param env: the VecEnv the model acts in
+    :param frame_rate: game frames per second
+    :param fallback: "previous" or an action index to use when the deadline is missed
+    :param min_budget_s: lower bound of the per-frame budget
+    :param deterministic: use the deterministic action
+    :param window: number of recent decisions the latency percentiles cover
+    """
+
+    def __init__(self, model, env, frame_rate: float = 60, fallback: Union[str, int] = "previous",
+                 min_budget_s: float = 0.002, deterministic: bool = True, window: int = 10000):
+        self.policy = model.policy
+        self.policy.set_training_mode(False)
+        self.frame_rate = frame_rate
+        self.min_budget_s = min_budget_s
+        self.deterministic = deterministic
+
+        # dict observations (stack_dynamic_only) go through the policy's own conversion
+        self.obs_tensor = None
+        if env.observation_space.shape is not None:
+            self.obs_tensor = torch.zeros((env.num_envs, *env.observation_space.shape), dtype=torch.float32, device=self.policy.device)
+        default_action = 0 if fallback == "previous" else int(fallback)
+        self.fallback = fallback
+        self.default_actions = np.full((env.num_envs,), default_action, dtype=np.int64)
+        self.previous_actions = self.default_actions.copy()
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="policy")
+        self.pending = None
+        self.latencies = deque(maxlen=window)
+        self.decisions = 0
+        self.missed = 0
+
+    def budget(self, latency_ms: float = 0) -> float:
+        return max(self.min_budget_s, 1.0 / self.frame_rate - latency_ms / 1000.0)
+
+    def _forward(self, obs: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            if self.obs_tensor is None:
+                obs_tensor, _ = self.policy.obs_to_tensor(obs)
+            else:
+                obs_tensor = self.obs_tensor
+                obs_tensor.copy_(torch.as_tensor(obs, dtype=torch.float32).reshape(obs_tensor.shape))
+            actions = self.policy._predict(obs_tensor, deterministic=self.deterministic)
+        return actions.cpu().numpy()
+
+    def _fallback_actions(self) -> np.ndarray:
+        return self.previous_actions if self.fallback == "previous" else self.default_actions
+
+    def act(self, obs: np.ndarray, latency_ms: float = 0) -> np.ndarray:
+        start = time.perf_counter()
+        self.decisions += 1
+
+        if self.pending is not None:
+            if not self.pending.done():
+                # the previous forward pass is still running and owns the input tensor
+                self.missed += 1
+                self.latencies.append(time.perf_counter() - start)
+                return self._fallback_actions()
+            self.previous_actions = self.pending.result()
+            self.pending = None
+
+        future = self.executor.submit(self._forward, obs)
+        try:
+            actions = future.result(timeout=self.budget(latency_ms))
+            self.previous_actions = actions
+        except TimeoutError:
+            self.missed += 1
+            self.pending = future
+            actions = self._fallback_actions()
+        self.latencies.append(time.perf_counter() - start)
+        return actions
+
+    def report(self) -> dict:
+        latencies_ms = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99])
+        return {
+            "decisions": self.decisions,
+            "missed_deadlines": self.missed,
+            "missed_rate": self.missed / self.decisions if self.decisions else 0.0,
+            "latency_p50_ms": float(p50),
+            "latency_p90_ms": float(p90),
+            "latency_p99_ms": float(p99),
+            "latency_max_ms": float(latencies_ms.max()),
+        }
+
+    def log_report(self):
+        report = self.report()
+        logger.info(
+            "inference: %d decisions, %.1f%% missed deadlines, latency p50 %.2f ms, p90 %.2f ms, p99 %.2f ms",
+            report["decisions"], report["missed_rate"] * 100,
+            report["latency_p50_ms"], report["latency_p90_ms"], report["latency_p99_ms"],
+        )
+        return report
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,44 @@
+"""
+Macro actions: sequences of ActionSpace moves that the frame server plays one per frame.
+
+With `CustomEnv(macros=...)` every action picks a Macro. Its first move goes with the
+next frame like a single action, the rest are queued on the server and sent with the
+following frames, so the env and the policy only see the frame after the last move
+(see server.MacroRun). The step reward is the sum of the per-frame rewards over the
+macro, and the macro stops early when its `interrupt` predicate fires on a frame, by
+default when the player takes damage.
+
+    env = CustomEnv(macros=default_macros())
+"""
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from env import ActionSpace
+from models import LevelData
+
+DIRECTIONS = ("RIGHT", "LEFT", "UP", "DOWN", "UP_RIGHT", "UP_LEFT", "DOWN_RIGHT", "DOWN_LEFT")
+
+
+def took_damage(previous: LevelData, new: LevelData) -> bool:
+    return new.own_player.health < previous.own_player.health
+
+
+@dataclass
+class Macro:
+    """Moves played on consecutive frames, stopped early when `interrupt(previous, new)` is true for a frame."""
+    name: str
+    actions: Tuple[ActionSpace, ...]
+    interrupt: Optional[Callable[[LevelData, LevelData], bool]] = took_damage
+
+
+def default_macros(move_frames: int = 4, attacks: int = 3) -> List[Macro]:
+    """
+    Every ActionSpace member as a one-frame macro (in ActionSpace order), then for each
+    direction a dash followed by `attacks` attacks and a move held for `move_frames` frames.
+    """
+    macros = [Macro(action.name, (action,)) for action in ActionSpace]
+    for direction in DIRECTIONS:
+        macros.append(Macro(f"DASH_{direction}_ATTACK", (ActionSpace[f"DASH_{direction}"],) + (ActionSpace.ATTACK,) * attacks))
+    for direction in DIRECTIONS:
+        macros.append(Macro(f"HOLD_{direction}", (ActionSpace[f"MOVE_{direction}"],) * move_frames))
+    return macros
@@ -1,27 +1,64 @@
 from pathlib import Path
-import gymnasium as gym
-from env import CustomEnv
-from stable_baselines3 import PPO
-from stable_baselines3.common.logger import configure
-from stable_baselines3.common.callbacks import CheckpointCallback, CallbackList
 import argparse
+import logging
 
-from hyper_parameter_callback import HyperParamCallback
-
-env = gym.make('CustomEnv-v0')
+from training import add_env_arguments, add_training_arguments, check_arguments, configure_logger, env_kwargs, feature_spec, learn, ppo_class
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("--n_steps", type=int, default=1000)
-    parser.add_argument("--n_epochs", type=int, default=10)
-    parser.add_argument("--checkpoint_freq", type=int, default=1000)
+    add_training_arguments(parser)
     parser.add_argument("--train", type=bool, default=False)
-    parser.add_argument("--log_path", type=str, default="./logs")
-    parser.add_argument("--checkpoint_path", type=str, default="./checkpoints")
     parser.add_argument("--model_path", type=str, default="model.zip")
+    parser.add_argument("--server_process", action="store_true", help="run the frame server in its own process")
+    parser.add_argument("--n_envs", type=int, default=1, help="number of games to step together, on ports 3000, 3001, ...")
+    parser.add_argument("--compact_observations", action="store_true", help="store rollouts in compact dtypes with obstacles kept once per map")
+    add_env_arguments(parser)
+    parser.add_argument("--record_dir", type=str, default=None, help="record every decoded frame as binary snapshots in this directory")
+    parser.add_argument("--frame_stack", type=int, default=1, help="observe the last N frames")
+    parser.add_argument("--stack_dynamic_only", action="store_true", help="only stack the player, enemy and hazard blocks (dict observations)")
+    parser.add_argument("--target_decision_rate", type=float, default=None, help="adapt frame skipping to hold this many steps per second")
+    parser.add_argument("--frame_rate", type=float, default=60, help="game frame rate, sets the inference deadline")
+    parser.add_argument("--fallback_action", type=str, default="previous", help="'previous' or an action index used when inference misses its deadline")
 
     args = parser.parse_args()
+    if args.compact_observations and args.frame_stack > 1:
+        parser.error("--compact_observations does not support --frame_stack")
+    if args.stack_dynamic_only and args.frame_stack <= 1:
+        parser.error("--stack_dynamic_only needs --frame_stack > 1")
+    if args.n_envs > 1 and args.server_process:
+        parser.error("--n_envs > 1 runs the servers in-process, it does not support --server_process")
+    if args.n_envs > 1 and args.stack_dynamic_only:
+        parser.error("--n_envs > 1 needs flat observations, it does not support --stack_dynamic_only")
+    check_arguments(parser, args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    # Heavy imports are deferred until the arguments are parsed, so that --help starts instantly
+    import gymnasium as gym
+    from env import CustomEnv
+    PPO = ppo_class(parser, args)
+    from stable_baselines3.common.vec_env import VecMonitor
+
+    from vec_env import GameVecEnv
+    from inference import DeadlineInferenceRunner, game_latency
+    from rollout_buffer import CompactRolloutBuffer, compact_buffer_kwargs
+
+    spec = feature_spec(args)
+    kwargs = dict(env_kwargs(args, spec), compact_observations=args.compact_observations, record_dir=args.record_dir,
+                  frame_stack=args.frame_stack, stack_dynamic_only=args.stack_dynamic_only,
+                  target_decision_rate=args.target_decision_rate)
+
+    # start the servers right away so the game can connect while the model is built
+    if args.n_envs > 1:
+        # GameVecEnv steps the envs itself, SB3 only adds Monitor to single envs
+        env = VecMonitor(GameVecEnv(args.n_envs, **kwargs))
+        env.env_method("start")
+        encoder = env.get_attr("encoder")[0]
+    else:
+        env = gym.make('CustomEnv-v0', server_process=args.server_process, **kwargs)
+        env.unwrapped.start()
+        encoder = env.unwrapped.encoder
 
     # hyperparameters
     n_steps = args.n_steps
@@ -34,36 +71,17 @@ if __name__ == "__main__":
     checkpoint_freq = args.checkpoint_freq
 
     # paths
-    log_path = args.log_path
-    checkpoint_path = args.checkpoint_path
     model_path = args.model_path
 
-    # log training data to stdout
-    # typically logs at the end of each epoch
-    logger = configure(log_path, ["stdout", "tensorboard"])
-
     if train:
         print("Training model")
-        model = PPO("MlpPolicy", env, n_steps=n_steps, n_epochs=n_epochs, batch_size=batch_size)
-
-
-        # save model checkpoints
-        # https://stable-baselines3.readthedocs.io/en/master/guide/callbacks.html#stoptrainingcallback
-        checkpoint_callback = CheckpointCallback(
-            save_freq=checkpoint_freq,
-            save_path=checkpoint_path,
-            name_prefix="rl_model",
-            save_replay_buffer=True,
-            save_vecnormalize=True,
-        )
-        hyperparam_callback = HyperParamCallback()
-        callback = CallbackList([checkpoint_callback, hyperparam_callback])
-
-        model.set_logger(logger)
-
-        # add a progress bar so you know it's not frozen
-        model.learn(total_timesteps=total_timesteps, progress_bar=True, callback=callback)
-        model.save("rpg_agent")
+        rollout_buffer_args = {}
+        if args.compact_observations:
+            rollout_buffer_args = dict(rollout_buffer_class=CompactRolloutBuffer, rollout_buffer_kwargs=compact_buffer_kwargs(encoder))
+        # stacking only the dynamic blocks gives dict observations
+        policy = "MultiInputPolicy" if isinstance(env.observation_space, gym.spaces.Dict) else "MlpPolicy"
+        model = PPO(policy, env, n_steps=n_steps, n_epochs=n_epochs, batch_size=batch_size, **rollout_buffer_args)
+        learn(model, args, spec)
     else:
         print("Inference mode")
 
@@ -73,10 +91,16 @@ if __name__ == "__main__":
         else:
             model = PPO.load("rpg_agent", env, n_steps=n_steps, n_epochs=n_epochs, batch_size=batch_size)
 
-            model.set_logger(logger)
+            model.set_logger(configure_logger(args))
 
             env = model.get_env()
+            fallback = args.fallback_action if args.fallback_action == "previous" else int(args.fallback_action)
+            runner = DeadlineInferenceRunner(model, env, frame_rate=args.frame_rate, fallback=fallback)
             obs = env.reset()
             for i in range(total_timesteps):
-                action, _state = model.predict(obs, deterministic=True)
+                action = runner.act(obs, latency_ms=game_latency(env))
                 obs, reward, done, info = env.step(action)
+                if (i + 1) % checkpoint_freq == 0:
+                    runner.log_report()
+            runner.log_report()
+            runner.close()
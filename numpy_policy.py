@@ -0,0 +1,166 @@
+"""
+NumPy-only runtime for PPO MlpPolicy actors.
+
+Export the actor of a trained model once (needs stable-baselines3 and torch):
+
+    python numpy_policy.py rpg_agent.zip rpg_agent.npz --check=1000
+
+then act without them:
+
+    policy = NumpyPolicy.load("rpg_agent.npz")
+    actions = policy.predict(observations)
+"""
+import argparse
+from typing import Optional
+
+import numpy as np
+
+ACTIVATIONS = {
+    "Tanh": np.tanh,
+    "ReLU": lambda x: np.maximum(x, 0),
+    "ELU": lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0))),
+    "Identity": lambda x: x,
+}
+
+
+class NumpyPolicy:
+    """Forward pass of an exported MlpPolicy actor, optionally with VecNormalize observation scaling."""
+
+    def __init__(self, weights, biases, action_weight, action_bias, activation="Tanh",
+                 obs_mean=None, obs_var=None, clip_obs=None, epsilon=1e-8):
+        self.weights = weights
+        self.biases = biases
+        self.action_weight = action_weight
+        self.action_bias = action_bias
+        self.activation = activation
+        self.activation_fn = ACTIVATIONS[activation]
+        self.obs_mean = obs_mean
+        self.obs_var = obs_var
+        self.clip_obs = clip_obs
+        self.epsilon = epsilon
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyPolicy":
+        data = np.load(path)
+        layers = int(data["layers"])
+        normalize = "obs_mean" in data
+        return cls(
+            weights=[data[f"w{i}"] for i in range(layers)],
+            biases=[data[f"b{i}"] for i in range(layers)],
+            action_weight=data["action_w"],
+            action_bias=data["action_b"],
+            activation=str(data["activation"]),
+            obs_mean=data["obs_mean"] if normalize else None,
+            obs_var=data["obs_var"] if normalize else None,
+            clip_obs=float(data["clip_obs"]) if normalize else None,
+            epsilon=float(data["epsilon"]) if normalize else 1e-8,
+        )
+
+    def save(self, path: str):
+        arrays = {"layers": np.array(len(self.weights)), "activation": np.array(self.activation)}
+        for i, (w, b) in enumerate(zip(self.weights, self.biases)):
+            arrays[f"w{i}"] = w
+            arrays[f"b{i}"] = b
+        arrays["action_w"] = self.action_weight
+        arrays["action_b"] = self.action_bias
+        if self.obs_mean is not None:
+            arrays["obs_mean"] = self.obs_mean
+            arrays["obs_var"] = self.obs_var
+            arrays["clip_obs"] = np.array(self.clip_obs)
+            arrays["epsilon"] = np.array(self.epsilon)
+        np.savez_compressed(path, **arrays)
+
+    def normalize(self, observations: np.ndarray) -> np.ndarray:
+        """Apply the exported VecNormalize scaling, if any, to a batch of observations."""
+        x = np.asarray(observations, dtype=np.float32)
+        if x.ndim == 1:
+            x = x[None]
+        if self.obs_mean is None:
+            return x
+        return np.clip((x - self.obs_mean) / np.sqrt(self.obs_var + self.epsilon), -self.clip_obs, self.clip_obs)
+
+    def logits(self, observations: np.ndarray) -> np.ndarray:
+        x = self.normalize(observations)
+        # the exported matrices are stored transposed, (in, out)
+        for w, b in zip(self.weights, self.biases):
+            x = self.activation_fn(x @ w + b)
+        return x @ self.action_weight + self.action_bias
+
+    def predict(self, observations: np.ndarray, deterministic: bool = True,
+                rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """Actions for a batch of observations (or a single one): argmax, or sampled from the softmax."""
+        logits = self.logits(observations)
+        if deterministic:
+            return logits.argmax(axis=-1)
+        rng = rng if rng is not None else np.random.default_rng()
+        # Gumbel-max trick samples from softmax(logits)
+        return (logits - np.log(-np.log(rng.random(logits.shape)))).argmax(axis=-1)
+
+
+def export_policy(model_path: str, out_path: str, vecnormalize_path: str = None) -> NumpyPolicy:
+    """Extract the actor network (and VecNormalize statistics if given) of a saved PPO MlpPolicy."""
+    from stable_baselines3 import PPO
+    from stable_baselines3.common.torch_layers import FlattenExtractor
+    from torch import nn
+
+    model = PPO.load(model_path, device="cpu")
+    policy = model.policy
+    if not isinstance(policy.pi_features_extractor, FlattenExtractor):
+        raise ValueError(f"only MlpPolicy actors can be exported, got {type(policy.pi_features_extractor).__name__}")
+
+    weights, biases = [], []
+    for layer in policy.mlp_extractor.policy_net:
+        if isinstance(layer, nn.Linear):
+            weights.append(layer.weight.detach().numpy().T.copy())
+            biases.append(layer.bias.detach().numpy().copy())
+    obs_mean = obs_var = clip_obs = None
+    epsilon = 1e-8
+    if vecnormalize_path is not None:
+        import pickle
+        with open(vecnormalize_path, "rb") as f:
+            vec_normalize = pickle.load(f)
+        if vec_normalize.norm_obs:
+            obs_mean = vec_normalize.obs_rms.mean.astype(np.float32)
+            obs_var = vec_normalize.obs_rms.var.astype(np.float32)
+            clip_obs = vec_normalize.clip_obs
+            epsilon = vec_normalize.epsilon
+
+    numpy_policy = NumpyPolicy(
+        weights, biases,
+        action_weight=policy.action_net.weight.detach().numpy().T.copy(),
+        action_bias=policy.action_net.bias.detach().numpy().copy(),
+        activation=policy.activation_fn.__name__,
+        obs_mean=obs_mean, obs_var=obs_var, clip_obs=clip_obs, epsilon=epsilon,
+    )
+    numpy_policy.save(out_path)
+    return numpy_policy
+
+
+def check_parity(model_path: str, npz_path: str, samples: int = 1000, seed: int = 0) -> float:
+    """Fraction of random observations on which the exported policy agrees with `model.predict`."""
+    from stable_baselines3 import PPO
+
+    model = PPO.load(model_path, device="cpu")
+    numpy_policy = NumpyPolicy.load(npz_path)
+    rng = np.random.default_rng(seed)
+    observations = rng.normal(size=(samples, *model.observation_space.shape)).astype(np.float32)
+    # VecNormalize scales observations before they reach the model
+    expected, _ = model.predict(numpy_policy.normalize(observations), deterministic=True)
+    return float(np.mean(numpy_policy.predict(observations) == expected))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a PPO MlpPolicy actor to a NumPy-only .npz runtime")
+    parser.add_argument("model_path", type=str, help="saved model, e.g. rpg_agent.zip")
+    parser.add_argument("out_path", type=str, help="where to write the .npz")
+    parser.add_argument("--vecnormalize_path", type=str, default=None, help="VecNormalize statistics saved with the model")
+    parser.add_argument("--check", type=int, default=0, help="compare against model.predict on this many random observations")
+    args = parser.parse_args()
+
+    export_policy(args.model_path, args.out_path, args.vecnormalize_path)
+    print(f"exported {args.model_path} to {args.out_path}")
+    if args.check:
+        agreement = check_parity(args.model_path, args.out_path, args.check)
+        print(f"parity with model.predict: {agreement:.2%}")
+        if agreement < 1.0:
+            raise SystemExit(1)
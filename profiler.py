@@ -0,0 +1,187 @@
+"""
+Sampling profiler for the frame server and env threads of a running process.
+
+While a session runs, a background thread reads the current stack of each watched
+thread (`sys._current_frames`) at a fixed rate and counts identical stacks. At the
+end of the session the counts are written in the collapsed-stack format that flame
+graph tools read (flamegraph.pl, speedscope, inferno): one line per stack, root
+first, frames separated by `;`, then the number of samples. Every frame is labelled
+with its function and the line it is executing, so time is attributed to lines:
+
+    env;step (env.py:398);run_until_complete (base_events.py:641);... 57
+    frame-server;_play (server.py:205);from_dict (models.py:260);... 12
+
+Nothing is sampled until a session is started, from the frame server's admin routes
+(see `CustomEnv(profile_dir=...)`) or by sending SIGUSR2 to the process:
+
+    curl "localhost:3000/profile/start?seconds=30&hz=100"
+    kill -USR2 <pid>   # starts a session, or stops the running one
+
+Sampling costs a stack walk per watched thread and sample, a few tens of
+microseconds at the usual stack depths, so the default 100 Hz takes well under 1%
+of a core. Sessions are bounded by `max_seconds`.
+"""
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SIGNAL = getattr(signal, "SIGUSR2", None)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of `threads()`, a mapping of labels to thread idents that is
+    looked up at every sample, and writes each session to `out_dir` as collapsed stacks.
+    """
+
+    def __init__(self, threads: Callable[[], Dict[str, int]], out_dir: str, name: str = "profile",
+                 hz: float = 100.0, seconds: float = 30.0, max_seconds: float = 600.0):
+        self.threads = threads
+        self.out_dir = out_dir
+        self.name = name
+        self.hz = hz
+        self.seconds = seconds
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.counts: Counter = Counter()
+        # (code, line) -> frame label, shared by all sessions
+        self.labels = {}
+        self.samples = 0
+        self.sample_time = 0.0  # Seconds spent taking samples in the current session
+        self.started_at = None
+        self.deadline = None
+        self.path: Optional[str] = None
+        self.last_path: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds: float = None, hz: float = None) -> dict:
+        """Start a session of `seconds` (capped at max_seconds) at `hz` samples per second."""
+        seconds = min(self.seconds if seconds is None else seconds, self.max_seconds)
+        hz = self.hz if hz is None else hz
+        if seconds <= 0 or hz <= 0:
+            raise ValueError(f"seconds and hz must be positive, got {seconds} and {hz}")
+        with self.lock:
+            if self.running:
+                raise RuntimeError("a profiling session is already running")
+            os.makedirs(self.out_dir, exist_ok=True)
+            self.counts = Counter()
+            self.samples = 0
+            self.sample_time = 0.0
+            self.started_at = time.perf_counter()
+            self.deadline = self.started_at + seconds
+            self.path = os.path.join(self.out_dir, f"{self.name}_{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, args=(1.0 / hz,), name="sampling-profiler", daemon=True)
+            self.thread.start()
+        logger.info(f"profiling for {seconds}s at {hz} Hz into {self.path}")
+        return self.status()
+
+    def stop(self, wait: bool = True) -> dict:
+        """End the running session early; the sampler thread writes its output."""
+        self.stop_event.set()
+        thread = self.thread
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join()
+        return self.status()
+
+    def toggle(self):
+        if self.running:
+            self.stop(wait=False)
+        else:
+            self.start()
+
+    def status(self) -> dict:
+        running = self.running
+        return {
+            "running": running,
+            "samples": self.samples,
+            "seconds": (time.perf_counter() - self.started_at) if running else None,
+            "overhead": self.sample_time / (time.perf_counter() - self.started_at) if running and self.samples else None,
+            "path": self.path if running else None,
+            "last_path": self.last_path,
+        }
+
+    def label(self, code, line: int) -> str:
+        label = self.labels.get((code, line))
+        if label is None:
+            name = getattr(code, "co_qualname", code.co_name)
+            label = self.labels[(code, line)] = f"{name} ({os.path.basename(code.co_filename)}:{line})"
+        return label
+
+    def sample(self):
+        frames = sys._current_frames()
+        for thread_label, ident in self.threads().items():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code, frame.f_lineno))
+                frame = frame.f_back
+            if stack:
+                stack.append(thread_label)
+                stack.reverse()
+                self.counts[tuple(stack)] += 1
+        self.samples += 1
+
+    def _run(self, interval: float):
+        try:
+            next_at = time.perf_counter()
+            while not self.stop_event.is_set():
+                now = time.perf_counter()
+                if now >= self.deadline:
+                    break
+                self.sample()
+                self.sample_time += time.perf_counter() - now
+                # keep the rate when a sample is late instead of drifting
+                next_at = max(next_at + interval, time.perf_counter())
+                self.stop_event.wait(next_at - time.perf_counter())
+        finally:
+            self.write()
+
+    def write(self):
+        with open(self.path, "w") as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{';'.join(frame.replace(';', ':') for frame in stack)} {count}\n")
+        self.last_path = self.path
+        logger.info(f"profile of {self.samples} samples ({self.sample_time:.3f}s sampling) written to {self.path}")
+
+
+# profilers toggled by PROFILE_SIGNAL, see install_signal_toggle
+_signal_profilers: List[SamplingProfiler] = []
+
+
+def _toggle_all(signum, frame):
+    for profiler in _signal_profilers:
+        try:
+            profiler.toggle()
+        except (RuntimeError, OSError):
+            logger.exception("could not toggle the profiler")
+
+
+def install_signal_toggle(profiler: SamplingProfiler) -> bool:
+    """
+    Start or stop `profiler` on PROFILE_SIGNAL, together with the other profilers of this process.
+    Signal handlers can only be set from the main thread; returns whether it was installed.
+    """
+    if PROFILE_SIGNAL is None or threading.current_thread() is not threading.main_thread():
+        return False
+    if not _signal_profilers:
+        signal.signal(PROFILE_SIGNAL, _toggle_all)
+    _signal_profilers.append(profiler)
+    return True
+
+
+def remove_signal_toggle(profiler: SamplingProfiler):
+    if profiler in _signal_profilers:
+        _signal_profilers.remove(profiler)
@@ -0,0 +1,263 @@
+"""
+Reward terms shared by the env and offline relabeling of recorded frames.
+
+A reward term is a function of two dicts of state columns, the previous and the new
+state (see STATE_COLUMNS), that works the same on scalars and on numpy arrays, times
+a weight. Online, `RewardFunction(previous, new)` evaluates the terms on one pair of
+frames. Offline, `relabel` evaluates them on whole columns of consecutive frames at once.
+
+Frames recorded with `CustomEnv(record_dir=...)` can then be relabeled with new terms
+without playing again. The recorder writes every decoded frame, including the frames
+between steps (skipped frames and the frames of a macro), and marks the frames that steps
+and resets returned (see snapshot.StepMarker). Relabeling runs over the transitions
+between consecutive step frames of an episode, so its rewards are the env's step rewards,
+with the action of each step. Recordings without markers only have per-frame transitions,
+which are relabeled with a warning: their rewards are not step rewards. The columns of a
+recording are extracted once and cached next to it as `<recording>.columns.npz`, so
+relabeling millions of transitions is a few numpy operations. A step whose frame the
+recorder dropped is left out, together with the step after it.
+
+    python rewards.py relabel frames/frames_3000.snap --weight died=-100 --out rewards.npz
+"""
+import argparse
+import logging
+import os
+from dataclasses import dataclass
+from operator import attrgetter
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+
+from models import LevelData
+
+logger = logging.getLogger(__name__)
+
+# state columns the terms can use: name -> attribute path on LevelData
+STATE_COLUMNS = {
+    "score": "own_player.score",
+    "health": "own_player.health",
+    "max_health": "own_player.max_health",
+    "is_zapped": "own_player.is_zapped",
+    "is_frozen": "own_player.is_frozen",
+    "level": "own_player.levelling.level",
+    "x": "own_player.position.x",
+    "y": "own_player.position.y",
+}
+
+# columns of a recording besides the state: the match index, whether the frame is a step frame,
+# whether it starts a run of step transitions (an episode start or after a missing step frame),
+# and the action that led to it (-1 for none)
+RECORD_COLUMNS = ["match", "step", "start", "action"]
+
+Columns = Dict[str, np.ndarray]
+
+
+def score_gain(previous: Columns, new: Columns):
+    return new["score"] - previous["score"]
+
+
+def damage_taken(previous: Columns, new: Columns):
+    return np.maximum(previous["health"] - new["health"], 0)
+
+
+def got_zapped(previous: Columns, new: Columns):
+    return np.logical_and(np.logical_not(previous["is_zapped"]), new["is_zapped"])
+
+
+def got_frozen(previous: Columns, new: Columns):
+    return np.logical_and(np.logical_not(previous["is_frozen"]), new["is_frozen"])
+
+
+def died(previous: Columns, new: Columns):
+    return np.logical_and(previous["health"] > 0, new["health"] <= 0)
+
+
+def distance_moved(previous: Columns, new: Columns):
+    return np.hypot(new["x"] - previous["x"], new["y"] - previous["y"])
+
+
+@dataclass
+class RewardTerm:
+    name: str
+    fn: Callable[[Columns, Columns], np.ndarray]
+    weight: float = 1.0
+
+
+# the env's reward: score gained, minus health lost, 10 for getting zapped or frozen and 30 for dying
+DEFAULT_TERMS = [
+    RewardTerm("score_gain", score_gain, 1.0),
+    RewardTerm("damage_taken", damage_taken, -1.0),
+    RewardTerm("got_zapped", got_zapped, -10.0),
+    RewardTerm("got_frozen", got_frozen, -10.0),
+    RewardTerm("died", died, -30.0),
+]
+
+# terms that can be added by name from the command line
+TERMS = {fn.__name__: fn for fn in (score_gain, damage_taken, got_zapped, got_frozen, died, distance_moved)}
+
+
+class RewardFunction:
+    """The weighted sum of `terms`, for a pair of frames (online) or for columns of frames (offline)."""
+
+    def __init__(self, terms: Iterable[RewardTerm] = None):
+        self.terms = list(DEFAULT_TERMS if terms is None else terms)
+        self.getters = [(name, attrgetter(path)) for name, path in STATE_COLUMNS.items()]
+
+    def state(self, level_data: LevelData) -> dict:
+        return {name: get(level_data) for name, get in self.getters}
+
+    def __call__(self, previous: LevelData, new: LevelData) -> float:
+        previous, new = self.state(previous), self.state(new)
+        return float(sum(term.weight * term.fn(previous, new) for term in self.terms))
+
+    def term_values(self, columns: Columns) -> Dict[str, np.ndarray]:
+        """Each term, unweighted, for the transitions between consecutive rows of `columns`; 0 where the match changes."""
+        previous = {name: column[:-1] for name, column in columns.items()}
+        new = {name: column[1:] for name, column in columns.items()}
+        new_match = previous["match"] != new["match"]
+        values = {}
+        for term in self.terms:
+            values[term.name] = np.asarray(term.fn(previous, new), dtype=np.float64)
+            values[term.name][new_match] = 0
+        return values
+
+    def total(self, values: Dict[str, np.ndarray]) -> np.ndarray:
+        """The weighted sum of term values from `term_values`."""
+        rewards = np.zeros_like(next(iter(values.values()))) if values else np.zeros(0)
+        for term in self.terms:
+            rewards += term.weight * values[term.name]
+        return rewards
+
+    def relabel(self, columns: Columns) -> np.ndarray:
+        """Rewards of the transitions between consecutive rows of `columns`."""
+        return self.total(self.term_values(columns))
+
+
+def extract_columns(records: Iterable, chunk: int = 65536) -> Columns:
+    """
+    State columns of the frames in `records` (LevelData and snapshot.StepMarker, as read by
+    snapshot.read_records), plus RECORD_COLUMNS. `match` is an index per distinct match id,
+    in order of appearance.
+    """
+    from snapshot import StepMarker
+
+    getters = [(name, attrgetter(path)) for name, path in STATE_COLUMNS.items()]
+    match_ids = {}
+    chunks: Dict[str, List[np.ndarray]] = {name: [] for name in list(STATE_COLUMNS) + RECORD_COLUMNS}
+    rows = {name: [] for name in chunks}
+    # whether the last frame can still be marked, and whether a step frame went missing since the last step
+    markable = missing = False
+    for record in records:
+        if isinstance(record, StepMarker):
+            if record.frame_missing or not markable:
+                missing = True
+                continue
+            rows["step"][-1] = 1
+            rows["start"][-1] = int(missing or record.action < 0)
+            rows["action"][-1] = record.action
+            markable = missing = False
+            continue
+        # flush before appending, so that a marker always finds its frame in rows
+        if len(rows["match"]) >= chunk:
+            for name, values in rows.items():
+                chunks[name].append(np.array(values, dtype=np.float64))
+                values.clear()
+        for name, get in getters:
+            rows[name].append(get(record))
+        rows["match"].append(match_ids.setdefault(record.game_info.match_id, len(match_ids)))
+        rows["step"].append(0)
+        rows["start"].append(0)
+        rows["action"].append(-1)
+        markable = True
+    for name, values in rows.items():
+        chunks[name].append(np.array(values, dtype=np.float64))
+    return {name: np.concatenate(parts) for name, parts in chunks.items()}
+
+
+def load_columns(path: str) -> Columns:
+    """Columns of the recording at `path`, from its cache when that is newer than the recording."""
+    from snapshot import read_records
+
+    cache = path + ".columns.npz"
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        with np.load(cache) as data:
+            if set(data.files) == set(STATE_COLUMNS) | set(RECORD_COLUMNS):
+                return {name: data[name] for name in data.files}
+    columns = extract_columns(read_records(path))
+    np.savez(cache, **columns)
+    logger.info(f"extracted {len(columns['match'])} frames, {int(columns['step'].sum())} of them step frames, from {path}")
+    return columns
+
+
+def relabel_recordings(paths: List[str], reward_fn: RewardFunction, chunk: int = 1 << 20) -> Dict[str, np.ndarray]:
+    """
+    Rewards and actions of every step in the recordings, concatenated, with the unweighted terms.
+    Recordings without step markers give their per-frame transitions, with an action of -1.
+
+    Columns are processed `chunk` transitions at a time; a chunk overlaps the previous one
+    by a frame so that no transition is lost.
+    """
+    results = {"reward": [], "action": []}
+    results.update({term.name: [] for term in reward_fn.terms})
+    for path in paths:
+        columns = load_columns(path)
+        steps = columns["step"] > 0
+        if steps.any():
+            columns = {name: column[steps] for name, column in columns.items()}
+        else:
+            logger.warning(f"{path} has no step markers, relabeling its per-frame transitions, which are not step rewards")
+        frames = len(columns["match"])
+        for start in range(0, max(frames - 1, 0), chunk):
+            part = {name: column[start:start + chunk + 1] for name, column in columns.items()}
+            # no transition into the first step of an episode, or out of a missing step frame
+            keep = part["start"][1:] == 0
+            values = reward_fn.term_values(part)
+            results["reward"].append(reward_fn.total(values)[keep])
+            results["action"].append(part["action"][1:][keep].astype(np.int64))
+            for name, term_values in values.items():
+                results[name].append(term_values[keep])
+    return {name: np.concatenate(parts) if parts else np.zeros(0) for name, parts in results.items()}
+
+
+def parse_weights(weights: List[str]) -> Dict[str, float]:
+    parsed = {}
+    for weight in weights:
+        name, _, value = weight.partition("=")
+        if name not in TERMS:
+            raise ValueError(f"unknown reward term {name!r}, expected one of {sorted(TERMS)}")
+        parsed[name] = float(value)
+    return parsed
+
+
+def terms_with_weights(weights: Dict[str, float]) -> List[RewardTerm]:
+    """DEFAULT_TERMS with `weights` changed or added; a weight of 0 drops the term."""
+    terms = {term.name: term for term in DEFAULT_TERMS}
+    for name, weight in weights.items():
+        terms[name] = RewardTerm(name, TERMS[name], weight)
+    return [term for term in terms.values() if term.weight != 0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    relabel_parser = subparsers.add_parser("relabel", help="recompute the rewards of recorded frames")
+    relabel_parser.add_argument("recordings", nargs="+", help="frame recordings (.snap), e.g. from --record_dir")
+    relabel_parser.add_argument("--weight", action="append", default=[], metavar="TERM=WEIGHT",
+                                help=f"change, add (one of {sorted(TERMS)}) or drop (0) a term of the default reward")
+    relabel_parser.add_argument("--chunk", type=int, default=1 << 20, help="transitions relabeled at a time")
+    relabel_parser.add_argument("--out", type=str, default=None, help="write the rewards and terms to this .npz")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        reward_fn = RewardFunction(terms_with_weights(parse_weights(args.weight)))
+    except ValueError as e:
+        parser.error(str(e))
+    results = relabel_recordings(args.recordings, reward_fn, chunk=args.chunk)
+    rewards = results["reward"]
+    print(f"{len(rewards)} transitions, reward mean {rewards.mean() if len(rewards) else 0:.4f}, sum {rewards.sum():.1f}")
+    for term in reward_fn.terms:
+        values = results[term.name]
+        print(f"  {term.name:14} weight {term.weight:8.2f}  nonzero {np.count_nonzero(values):8d}  sum {term.weight * values.sum():12.1f}")
+    if args.out is not None:
+        np.savez(args.out, **results)
@@ -0,0 +1,122 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import torch as th
+from gymnasium import spaces
+from stable_baselines3.common.buffers import RolloutBuffer
+from stable_baselines3.common.type_aliases import RolloutBufferSamples
+from stable_baselines3.common.vec_env import VecNormalize
+
+from encoder import ObservationEncoder
+
+
+def compact_buffer_kwargs(encoder: ObservationEncoder) -> dict:
+    """`rollout_buffer_kwargs` that make a CompactRolloutBuffer store `encoder`'s observations."""
+    return dict(feature_dtypes=encoder.feature_dtypes(), static_block=encoder.static_block())
+
+
+class CompactRolloutBuffer(RolloutBuffer):
+    """
+    RolloutBuffer that stores observations column-grouped by storage dtype.
+
+    Every feature is kept in the dtype declared for it (uint8/int8 flags and codes,
+    float16 normalized values, float32 for the rest) and widened back to float32 only
+    for the sampled minibatch. The `static_block` columns (the obstacles, when they
+    are encoded in map coordinates) are stored once per distinct content, normally
+    once per map, and each step only keeps the index of its block.
+
+    Use it through PPO's `rollout_buffer_class`, with `compact_buffer_kwargs(encoder)`
+    as `rollout_buffer_kwargs`.
+
+    :param feature_dtypes: storage dtype of each observation feature
+    :param static_block: (start, end) of the columns that are deduplicated, or None
+    """
+
+    def __init__(
+        self,
+        buffer_size: int,
+        observation_space: spaces.Space,
+        action_space: spaces.Space,
+        device="auto",
+        gae_lambda: float = 1,
+        gamma: float = 0.99,
+        n_envs: int = 1,
+        feature_dtypes: np.ndarray = None,
+        static_block: Optional[Tuple[int, int]] = None,
+    ):
+        if feature_dtypes is None:
+            raise ValueError("CompactRolloutBuffer needs feature_dtypes, see compact_buffer_kwargs")
+        if len(feature_dtypes) != observation_space.shape[0]:
+            raise ValueError(f"{len(feature_dtypes)} feature dtypes for an observation of shape {observation_space.shape}")
+
+        stored = np.ones(len(feature_dtypes), dtype=bool)
+        self.static_block = static_block
+        if static_block is not None:
+            stored[static_block[0]:static_block[1]] = False
+        feature_dtypes = np.asarray(feature_dtypes)
+        # dtype -> indices of the columns stored with it
+        self.columns = {
+            np.dtype(dtype): np.flatnonzero(stored & (feature_dtypes == dtype))
+            for dtype in np.unique(feature_dtypes[stored])
+        }
+        super().__init__(buffer_size, observation_space, action_space, device, gae_lambda, gamma, n_envs)
+
+    def reset(self) -> None:
+        # keep RolloutBuffer from allocating the full float32 observation array
+        obs_shape, self.obs_shape = self.obs_shape, (0,)
+        super().reset()
+        self.obs_shape = obs_shape
+
+        self.groups = {
+            dtype: np.zeros((self.buffer_size, self.n_envs, len(columns)), dtype=dtype)
+            for dtype, columns in self.columns.items()
+        }
+        self.static_ids = np.zeros((self.buffer_size, self.n_envs), dtype=np.int32)
+        self.static_index = {}
+        self.static_blocks = []
+
+    def add(self, obs: np.ndarray, action: np.ndarray, reward: np.ndarray, episode_start: np.ndarray,
+            value: th.Tensor, log_prob: th.Tensor) -> None:
+        obs = np.asarray(obs, dtype=np.float32).reshape((self.n_envs, *self.obs_shape))
+        for dtype, columns in self.columns.items():
+            self.groups[dtype][self.pos] = obs[:, columns]
+        if self.static_block is not None:
+            start, end = self.static_block
+            for env_idx in range(self.n_envs):
+                key = obs[env_idx, start:end].tobytes()
+                block_id = self.static_index.get(key)
+                if block_id is None:
+                    block_id = self.static_index[key] = len(self.static_blocks)
+                    self.static_blocks.append(np.frombuffer(key, dtype=np.float32))
+                self.static_ids[self.pos, env_idx] = block_id
+        super().add(obs[:, :0], action, reward, episode_start, value, log_prob)
+
+    def get(self, batch_size: Optional[int] = None):
+        if not self.generator_ready:
+            self.groups = {dtype: self.swap_and_flatten(group) for dtype, group in self.groups.items()}
+            self.static_ids = self.swap_and_flatten(self.static_ids).ravel()
+            if self.static_block is not None:
+                self.static_blocks = np.stack(self.static_blocks)
+        yield from super().get(batch_size)
+
+    def _get_samples(self, batch_inds: np.ndarray, env: Optional[VecNormalize] = None) -> RolloutBufferSamples:
+        observations = np.empty((len(batch_inds), *self.obs_shape), dtype=np.float32)
+        for dtype, columns in self.columns.items():
+            observations[:, columns] = self.groups[dtype][batch_inds]
+        if self.static_block is not None:
+            start, end = self.static_block
+            observations[:, start:end] = self.static_blocks[self.static_ids[batch_inds]]
+        data = (
+            observations,
+            self.actions[batch_inds].astype(np.float32, copy=False),
+            self.values[batch_inds].flatten(),
+            self.log_probs[batch_inds].flatten(),
+            self.advantages[batch_inds].flatten(),
+            self.returns[batch_inds].flatten(),
+        )
+        return RolloutBufferSamples(*tuple(map(self.to_torch, data)))
+
+    def nbytes(self) -> int:
+        """Bytes held by the stored observations."""
+        return (sum(group.nbytes for group in self.groups.values()) + self.static_ids.nbytes
+                + sum(block.nbytes for block in self.static_blocks))
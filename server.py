@@ -1,22 +1,33 @@
-from typing import List
-from fastapi import FastAPI, Request
+from collections import deque
+from typing import Callable, List, Optional
+from concurrent.futures import Future
+from fastapi import APIRouter, FastAPI, Request
+from fastapi.responses import JSONResponse
 import asyncio
+import gzip
+import json
+import zlib
 import threading
 import logging
+import time
+import uvicorn
 
 from models import LevelData, Move, GameState
+from delta import DeltaMerger, DELTA_HEADER
+from frame_dedup import DuplicateFrames
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+router = APIRouter()
 
 class ServerState:
     def __init__(self):
         self.should_reset = False
         self.skip_frames = 20
         self.skip_frame_count = 0
+        # When set, only every Nth frame the env waits on is passed on and skip_frames is not used
+        # (see frame_skip.FrameSkipController)
+        self.decide_every = 0
         
         self.data: LevelData = LevelData(
             game_info={
@@ -37,41 +48,236 @@ class ServerState:
             stats=[]
         )
         self.wait_for_data_event = threading.Event()  # Event to signal data update
+        self.frames_decoded = 0  # Number of frames decoded so far
+        self.frames_received = 0  # Number of frames the game posted
+        self.frames_ignored = 0  # Frames posted while the env neither waited nor had moves to send
+        self.frames_skipped = 0  # Frames dropped by skip_frames
+        self.decode_time = 0.0  # Seconds spent parsing and decoding frames
+        self.handler_time = 0.0  # Seconds spent in the frame handler
+        self.bytes_received = 0  # Frame bytes as posted, compressed or not
+        self.bytes_inflated = 0  # Frame bytes after decompression, of the frames that were read
+        self.delta_resyncs = 0  # Delta frames answered with 409 for lack of a full frame to merge into
+        # Cached frame that delta frames are merged into (see delta.py)
+        self.delta_merger = DeltaMerger()
+        # Last decoded frame, reused when the next one repeats it (see frame_dedup.py)
+        self.duplicates = DuplicateFrames()
+        # (level_data, EXACT or VOLATILE, the LevelData it repeats) of the last decoded frame when it
+        # was a repeat, None otherwise; lets the env reuse its observation of the repeated frame
+        self.repeat = None
+        # Env-side measurements published with the server counters, see metrics()
+        self.step_metrics = {}
+        self.moves_seq = 0  # Value of frames_decoded when the pending moves were set
         self.send_action_event = threading.Event()  # Event to signal data update
         self.moves : List[Move] = []
+        # Macro whose remaining move batches the handler sends one per frame, see MacroRun
+        self.macro: Optional[MacroRun] = None
+        self.macro_batches_sent = 0  # Move batches sent from macro queues
+        self.macro_interrupts = 0  # Macros cut short by their interrupt predicate
         self.reset_options = {}
         self.reset_seed = None
+        # Optional encoder run on every decoded frame (see encoder.BufferedFrameEncoder)
+        self.frame_encoder = None
+        # Optional recorder of every decoded frame (see snapshot.FrameRecorder)
+        self.frame_recorder = None
+        # Optional sampling profiler driven by the /profile routes (see profiler.SamplingProfiler)
+        self.profiler = None
+        # Coroutines waiting for a decoded frame: (min_seq, predicate, loop, future), see wait_for
+        self.waiters = []
+        self.waiters_lock = threading.Lock()
 
-server_state = ServerState()
+    def metrics(self) -> dict:
+        return {
+            "frames_received": self.frames_received,
+            "frames_decoded": self.frames_decoded,
+            "frames_ignored": self.frames_ignored,
+            "frames_skipped": self.frames_skipped,
+            "decode_time_s": self.decode_time,
+            "handler_time_s": self.handler_time,
+            "bytes_received": self.bytes_received,
+            "bytes_inflated": self.bytes_inflated,
+            "delta_resyncs": self.delta_resyncs,
+            **self.duplicates.metrics(),
+            "macro_batches_sent": self.macro_batches_sent,
+            "macro_interrupts": self.macro_interrupts,
+            "skip_frames": self.skip_frames,
+            "decide_every": self.decide_every,
+            **self.step_metrics,
+        }
+
+    def notify_frame(self, level_data: LevelData) -> bool:
+        """
+        Wake the waiters the newly decoded frame satisfies; returns whether any are left waiting.
+
+        Decoding stops once nobody is left waiting. That happens under the waiters lock, the
+        lock `wait_for` registers waiters and requests decoding under, so a waiter that
+        registers while a frame is being decoded cannot have its request cleared.
+        """
+        with self.waiters_lock:
+            remaining = []
+            for waiter in self.waiters:
+                min_seq, predicate, loop, future = waiter
+                if self.frames_decoded > min_seq and (predicate is None or predicate(level_data)):
+                    loop.call_soon_threadsafe(_resolve, future, level_data)
+                else:
+                    remaining.append(waiter)
+            self.waiters = remaining
+            if not remaining:
+                self.wait_for_data_event.clear()
+            return bool(remaining)
+
+class MacroRun:
+    """
+    Move batches the frame handler sends one per frame, without a round trip to the env in between.
+
+    Every frame decoded while the macro runs is passed to `observe`: its reward against
+    the previous frame is added up, and `interrupt(previous, new)` can cut the macro
+    short, in which case the remaining batches are dropped. The macro is `done` with
+    the frame following its last batch, or with the frame that interrupted it.
+    """
+
+    def __init__(self, batches: List[List[Move]], start: LevelData,
+                 interrupt: Callable[[LevelData, LevelData], bool] = None,
+                 reward_fn: Callable[[LevelData, LevelData], float] = None):
+        self.pending = deque(batches)
+        self.previous = start
+        self.interrupt = interrupt
+        self.reward_fn = reward_fn
+        self.reward = 0.0
+        self.frames = 0
+        self.last_sent = not batches
+        self.interrupted = False
+        self.done = False
+
+    def observe(self, level_data: LevelData, server_state: "ServerState"):
+        """Called by the handler for every frame decoded after the first batch was sent."""
+        self.frames += 1
+        if self.reward_fn is not None:
+            self.reward += self.reward_fn(self.previous, level_data)
+        if not self.last_sent and self.interrupt is not None and self.interrupt(self.previous, level_data):
+            self.interrupted = True
+            self.pending.clear()
+            server_state.moves = []
+            server_state.send_action_event.clear()
+            server_state.macro_interrupts += 1
+        self.previous = level_data
+        self.done = self.last_sent or self.interrupted
+
+def _resolve(future: asyncio.Future, level_data: LevelData):
+    if not future.done():
+        future.set_result(level_data)
+
+def inflate(body: bytes, content_encoding: str) -> bytes:
+    """Decompress a request body sent with Content-Encoding gzip or deflate."""
+    if content_encoding == "gzip":
+        return gzip.decompress(body)
+    if content_encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # some clients send raw deflate streams without the zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    if content_encoding in ("", "identity"):
+        return body
+    raise ValueError(f"unsupported Content-Encoding {content_encoding!r}")
 
-@app.post("/")
+@router.post("/")
 async def play(request: Request):
+    started = time.perf_counter()
+    try:
+        return await _play(request)
+    finally:
+        request.app.state.server_state.handler_time += time.perf_counter() - started
+
+async def _play(request: Request):
+    server_state: ServerState = request.app.state.server_state
+    server_state.frames_received += 1
+    # the body as posted, also for chunked uploads without a content-length; starlette caches it for _read_body
+    server_state.bytes_received += len(await request.body())
+    # delta frames are merged even when they are not decoded, the next ones build on them
+    delta = request.headers.get(DELTA_HEADER) == "delta"
+    body = frame = None
+    if delta:
+        started = time.perf_counter()
+        body = await _read_body(request, server_state)
+        frame = server_state.delta_merger.merge(json.loads(body))
+        server_state.decode_time += time.perf_counter() - started
+        if frame is None:
+            server_state.delta_resyncs += 1
+            return JSONResponse({"resync": True}, status_code=409)
+
     if not (server_state.send_action_event.is_set() or server_state.wait_for_data_event.is_set()):
+        server_state.frames_ignored += 1
+        if delta:
+            server_state.duplicates.forget()
         return []
 
     server_state.skip_frame_count += 1
-    if server_state.skip_frames > 0 and server_state.skip_frame_count >= server_state.skip_frames:
-        server_state.skip_frame_count = 0
+    if server_state.decide_every > 0:
+        # pass on every Nth frame
+        skip = server_state.skip_frame_count < server_state.decide_every
+        if not skip:
+            server_state.skip_frame_count = 0
+    else:
+        # drop every Nth frame
+        skip = server_state.skip_frames > 0 and server_state.skip_frame_count >= server_state.skip_frames
+        if skip:
+            server_state.skip_frame_count = 0
+    if skip:
+        server_state.frames_skipped += 1
+        if delta:
+            server_state.duplicates.forget()
         return []
     
     if server_state.wait_for_data_event.is_set():
       # logger.info("setting data")
-      body = await request.json()
-      level_data = LevelData.from_dict(body)  # Use from_dict instead of from_json
+      started = time.perf_counter()
+      if body is None:
+        body = await _read_body(request, server_state)
+      # frames that repeat the previous one reuse its LevelData and observation
+      previous = server_state.duplicates.level_data
+      level_data, repeated = server_state.duplicates.decode(
+        body, lambda: LevelData.from_dict(frame if frame is not None else json.loads(body)))
+      server_state.repeat = (level_data, repeated, previous) if repeated is not None else None
+      server_state.decode_time += time.perf_counter() - started
+      if server_state.frame_encoder is not None:
+        server_state.frame_encoder.encode(level_data, repeated=repeated)
+      if server_state.frame_recorder is not None:
+        server_state.frame_recorder.record(level_data)
       server_state.data = level_data  # Update the data with level_data
-      server_state.wait_for_data_event.clear()  # Signal that data has been updated
+      server_state.frames_decoded += 1
+      macro = server_state.macro
+      if macro is not None and server_state.frames_decoded > server_state.moves_seq:
+        macro.observe(level_data, server_state)
+      # keep decoding while someone waits for a matching frame
+      server_state.notify_frame(level_data)
+    elif delta:
+      server_state.duplicates.forget()
     
     moves = []
     if server_state.send_action_event.is_set():
       moves = server_state.moves
       server_state.moves = []
-      server_state.send_action_event.clear()
+      macro = server_state.macro
+      if macro is not None and macro.pending:
+        # the next batch goes with the next frame, which is decoded for the macro
+        server_state.moves = macro.pending.popleft()
+        server_state.macro_batches_sent += 1
+      else:
+        if macro is not None:
+          macro.last_sent = True
+        server_state.send_action_event.clear()
       server_state.wait_for_data_event.set()
     
     return moves
 
-@app.get("/reset")
-def reset():
+async def _read_body(request: Request, server_state: ServerState) -> bytes:
+    body = inflate(await request.body(), request.headers.get("content-encoding", ""))
+    server_state.bytes_inflated += len(body)
+    return body
+
+@router.get("/reset")
+def reset(request: Request):
+    server_state: ServerState = request.app.state.server_state
     response = {
         "reset": server_state.should_reset,
         "seed": server_state.reset_seed,
@@ -84,24 +290,137 @@ def reset():
     # logger.info("reset")
     return response
 
-async def wait_for_data_set():
-    while server_state.wait_for_data_event.is_set():
-        await asyncio.sleep(0.001)  # Use asyncio.sleep to yield control
+@router.get("/metrics")
+def metrics(request: Request):
+    server_state: ServerState = request.app.state.server_state
+    return server_state.metrics()
+
+def _profiler_or_404(request: Request):
+    profiler = request.app.state.server_state.profiler
+    if profiler is None:
+        return None, JSONResponse({"error": "profiling is not enabled, see CustomEnv(profile_dir=...)"}, status_code=404)
+    return profiler, None
+
+@router.get("/profile")
+def profile(request: Request):
+    profiler, error = _profiler_or_404(request)
+    return error or profiler.status()
+
+@router.get("/profile/start")
+def profile_start(request: Request, seconds: Optional[float] = None, hz: Optional[float] = None):
+    profiler, error = _profiler_or_404(request)
+    if error is not None:
+        return error
+    try:
+        return profiler.start(seconds=seconds, hz=hz)
+    except RuntimeError as e:
+        return JSONResponse({"error": str(e), **profiler.status()}, status_code=409)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+@router.get("/profile/stop")
+def profile_stop(request: Request):
+    profiler, error = _profiler_or_404(request)
+    return error or profiler.stop()
 
-async def get_data(immediate=False):
+def create_app(state: ServerState) -> FastAPI:
+    """Create a frame server app bound to its own ServerState, so several can run in one process."""
+    new_app = FastAPI()
+    new_app.state.server_state = state
+    new_app.include_router(router)
+    return new_app
+
+class FrameServer(uvicorn.Server):
+    """uvicorn server for a frame app that resolves `ready` once it accepts connections."""
+
+    def __init__(self, app: FastAPI, host: str, port: int, ready: Future):
+        super().__init__(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self.ready = ready
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started and not self.ready.done():
+            self.ready.set_result(self.config.port)
+
+    def run_until_stopped(self):
+        """Serve until `should_exit` is set, failing `ready` if the server never came up."""
+        try:
+            self.run()
+        except BaseException as e:
+            # uvicorn exits with SystemExit when it cannot bind the port
+            if not self.ready.done():
+                self.ready.set_exception(RuntimeError(f"frame server on port {self.config.port} failed to start: {e!r}"))
+            return
+        if not self.ready.done():
+            self.ready.set_exception(RuntimeError(f"frame server on port {self.config.port} stopped before it was ready"))
+
+server_state = ServerState()
+app = create_app(server_state)
+
+async def wait_for(predicate: Callable[[LevelData], bool] = None, min_seq: int = None, timeout: float = None,
+                   decode: bool = False, server_state: ServerState = server_state) -> LevelData:
+    """
+    Wait for the first frame decoded after `min_seq` (default: the current frame) that matches `predicate`.
+
+    The waiter is woken by the request handler only when such a frame arrives. With `decode`
+    the server decodes every frame until then.
+    Raises asyncio.TimeoutError after `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with server_state.waiters_lock:
+        if min_seq is None:
+            min_seq = server_state.frames_decoded
+        if server_state.frames_decoded > min_seq and (predicate is None or predicate(server_state.data)):
+            return server_state.data
+        waiter = (min_seq, predicate, loop, future)
+        server_state.waiters.append(waiter)
+        if decode:
+            server_state.wait_for_data_event.set()
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        with server_state.waiters_lock:
+            if waiter in server_state.waiters:
+                server_state.waiters.remove(waiter)
+        raise
+
+async def wait_for_state(predicate: Callable[[LevelData], bool], timeout: float = None, decode: bool = True,
+                         server_state: ServerState = server_state) -> LevelData:
+    """
+    Wait for a frame matching `predicate`, decoding every frame until one does.
+
+    With `decode=False` decoding only starts once something else requests data (e.g. the game fetching /reset).
+    """
+    try:
+        return await wait_for(predicate, timeout=timeout, decode=decode, server_state=server_state)
+    finally:
+        server_state.wait_for_data_event.clear()
+
+def game_state_sequence(*states: GameState) -> Callable[[LevelData], bool]:
+    """Predicate that matches once the game has gone through `states` in order."""
+    remaining = list(states)
+
+    def predicate(level_data: LevelData) -> bool:
+        if remaining and level_data.game_info.state == remaining[0]:
+            remaining.pop(0)
+        return not remaining
+    return predicate
+
+async def get_data(immediate=False, timeout: float = None, server_state: ServerState = server_state):
     if not immediate:
-        # Wait for the api call
-        loop = asyncio.get_event_loop()
-        await loop.run_in_executor(None, server_state.wait_for_data_event.wait)
+        # Wait for the frame after the pending moves were sent
+        seq = server_state.moves_seq
     else:
+        seq = server_state.frames_decoded
         server_state.wait_for_data_event.set()
 
     # Wait for the next api call
-    await wait_for_data_set()  # Await the coroutine properly
+    data = await wait_for(min_seq=seq, timeout=timeout, server_state=server_state)
     server_state.wait_for_data_event.clear()  # Reset the event for future use
-    return server_state.data
+    return data
 
-def set_should_reset(value: bool, seed = None, options: dict = None):
+def set_should_reset(value: bool, seed = None, options: dict = None, server_state: ServerState = server_state):
     server_state.should_reset = value
     server_state.reset_seed = seed
     server_state.reset_options = options
@@ -124,30 +443,64 @@ def set_should_reset(value: bool, seed = None, options: dict = None):
             stats=[]
         )
 
-def set_moves(moves: List[Move]):
+def set_moves(moves: List[Move], server_state: ServerState = server_state, macro: MacroRun = None):
+    """Queue `moves` for the next frame, followed by the batches of `macro` one per frame."""
+    server_state.macro = macro
     server_state.moves = moves
+    server_state.moves_seq = server_state.frames_decoded
     server_state.wait_for_data_event.clear()
     server_state.send_action_event.set()
 
-def set_skip_frames(count):
+async def wait_for_macro(macro: MacroRun, timeout: float = None, server_state: ServerState = server_state) -> LevelData:
+    """Wait for the frame that ends `macro` (queued with set_moves)."""
+    try:
+        return await wait_for(lambda level_data: macro.done, min_seq=server_state.moves_seq, timeout=timeout,
+                              server_state=server_state)
+    finally:
+        server_state.wait_for_data_event.clear()
+        if server_state.macro is macro:
+            server_state.macro = None
+            macro.pending.clear()
+
+def set_frame_encoder(encoder, server_state: ServerState = server_state):
+    server_state.frame_encoder = encoder
+
+def set_frame_recorder(recorder, server_state: ServerState = server_state):
+    server_state.frame_recorder = recorder
+
+def set_profiler(profiler, server_state: ServerState = server_state):
+    server_state.profiler = profiler
+
+def set_skip_frames(count, server_state: ServerState = server_state):
     server_state.skip_frames = count
 
-async def reset(seed = None, options: dict = None):
-    set_should_reset(True, seed=seed, options=options)
-    state = await get_data()
-    while state.game_info.state != "STARTING":
-        state = await get_data(immediate=True)
-    while state.game_info.state != "STARTED":
-        state = await get_data(immediate=True)
+def set_decide_every(count, server_state: ServerState = server_state):
+    server_state.decide_every = count
+
+async def reset(seed = None, options: dict = None, timeout: float = None, retries: int = 0,
+                server_state: ServerState = server_state):
+    """
+    Request a reset and wait until the game has gone through STARTING to STARTED.
 
-    return state
+    When that takes longer than `timeout` seconds the reset is requested again, up to
+    `retries` times, before raising TimeoutError.
+    """
+    for attempt in range(retries + 1):
+        set_should_reset(True, seed=seed, options=options, server_state=server_state)
+        try:
+            # frames are decoded from the moment the game fetches the reset
+            return await wait_for_state(game_state_sequence(GameState.STARTING, GameState.STARTED),
+                                        timeout=timeout, decode=False, server_state=server_state)
+        except asyncio.TimeoutError:
+            logger.warning(f"reset did not complete within {timeout}s (attempt {attempt + 1}/{retries + 1})")
+    raise TimeoutError(f"game did not restart after {retries + 1} reset requests")
 
-async def step(moves):
-    set_moves(moves)
+async def step(moves, server_state: ServerState = server_state):
+    set_moves(moves, server_state=server_state)
 
-    new_level_data = await get_data()
+    new_level_data = await get_data(server_state=server_state)
     return new_level_data
 
 if __name__ == "__main__":
-    import uvicorn
+    logging.basicConfig(level=logging.INFO)
     uvicorn.run(app, host="0.0.0.0", port=3000)
@@ -0,0 +1,350 @@
+"""
+Compact binary snapshots of LevelData, for frame logging and recording.
+
+A snapshot is columnar: every list of entities is stored as one column per field
+(nested dataclasses such as `position` are flattened into their own columns, lists
+of dataclasses such as `collisions` become child tables with a varint length per
+row). Numbers are stored as packed int64/float64/bool arrays, strings (ids, types,
+names) as varint indices into a string table written once per snapshot. The layout
+is derived from the model type hints, so decoding rebuilds exactly the LevelData
+that was encoded:
+
+    data = dumps(level_data)
+    assert loads(data) == level_data
+
+`FrameRecorder` appends length-prefixed snapshots to a file and `read_frames`
+iterates over them. A recording can also mark which frames were env steps, see
+`FrameRecorder.mark_step` and `read_records`.
+"""
+import hashlib
+import json
+import queue
+import struct
+import threading
+import typing
+from dataclasses import fields, is_dataclass
+from enum import Enum
+from operator import attrgetter
+from typing import Iterator, NamedTuple, Union
+
+import numpy as np
+
+from models import LevelData
+
+MAGIC = b"LDS1"
+MAX_EXACT_INT = 2 ** 53
+# length prefix of a step marker, followed by STEP_FORMAT instead of a snapshot
+STEP_MARKER = 0xFFFFFFFF
+STEP_FORMAT = struct.Struct("<i?")
+
+# column kinds
+BOOL = ord("b")
+INT = ord("q")
+FLOAT = ord("d")
+NUMBER = ord("n")  # ints and floats mixed, float64 values plus an is-int mask
+STRING = ord("s")  # varint index into the string table, 0 is None
+JSON = ord("j")    # anything else, e.g. the raw inventory dicts
+
+# field kinds of the schema
+VALUE, OBJECT, TABLE = 0, 1, 2
+
+_schemas = {}
+
+
+def _schema(cls) -> list:
+    """[(name, kind, class or enum type), ...] for the fields of a dataclass, cached."""
+    schema = _schemas.get(cls)
+    if schema is None:
+        hints = typing.get_type_hints(cls)
+        schema = []
+        for field in fields(cls):
+            hint = hints[field.name]
+            args = typing.get_args(hint)
+            if is_dataclass(hint):
+                schema.append((field.name, OBJECT, hint))
+            elif typing.get_origin(hint) is list and args and is_dataclass(args[0]):
+                schema.append((field.name, TABLE, args[0]))
+            elif isinstance(hint, type) and issubclass(hint, Enum):
+                schema.append((field.name, VALUE, hint))
+            else:
+                schema.append((field.name, VALUE, None))
+        _schemas[cls] = schema
+    return schema
+
+
+def _fingerprint(cls) -> str:
+    """Field layout of `cls` and its nested models, so that stale snapshots fail loudly."""
+    parts = []
+    for name, kind, field_cls in _schema(cls):
+        parts.append(f"{name}:{kind}")
+        if kind in (OBJECT, TABLE):
+            parts.append("(" + _fingerprint(field_cls) + ")")
+    return ",".join(parts)
+
+
+SCHEMA_HASH = hashlib.sha1(_fingerprint(LevelData).encode()).digest()[:4]
+
+
+def _write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos: int):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class _Writer:
+    def __init__(self):
+        self.body = bytearray()
+        self.strings = {None: 0}
+
+    def table(self, cls, rows: list):
+        for name, kind, field_cls in _schema(cls):
+            values = list(map(attrgetter(name), rows))
+            if kind == OBJECT:
+                self.table(field_cls, values)
+            elif kind == TABLE:
+                for value in values:
+                    _write_varint(self.body, len(value))
+                self.table(field_cls, [child for value in values for child in value])
+            else:
+                self.column(values)
+
+    def column(self, values: list):
+        body = self.body
+        types = set(map(type, values))
+        if not values or types == {bool}:
+            body.append(BOOL)
+            body += np.array(values, dtype=np.uint8).tobytes()
+        elif types == {int} and -MAX_EXACT_INT <= min(values) and max(values) <= MAX_EXACT_INT:
+            body.append(INT)
+            body += np.array(values, dtype=np.int64).tobytes()
+        elif types == {float}:
+            body.append(FLOAT)
+            body += np.array(values, dtype=np.float64).tobytes()
+        elif types == {int, float} and -MAX_EXACT_INT <= min(values) and max(values) <= MAX_EXACT_INT:
+            body.append(NUMBER)
+            body += np.array(values, dtype=np.float64).tobytes()
+            body += np.array([type(v) is int for v in values], dtype=np.uint8).tobytes()
+        elif all(issubclass(t, str) or t is type(None) for t in types):
+            body.append(STRING)
+            strings = self.strings
+            for value in values:
+                index = strings.get(value)
+                if index is None:
+                    index = strings[value] = len(strings)
+                _write_varint(body, index)
+        else:
+            data = json.dumps(values).encode()
+            body.append(JSON)
+            _write_varint(body, len(data))
+            body += data
+
+    def getvalue(self) -> bytes:
+        out = bytearray(MAGIC)
+        out += SCHEMA_HASH
+        _write_varint(out, len(self.strings) - 1)
+        for value in list(self.strings)[1:]:
+            # enum members are stored by value
+            data = str(value.value if isinstance(value, Enum) else value).encode()
+            _write_varint(out, len(data))
+            out += data
+        out += self.body
+        return bytes(out)
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        if data[:4] != MAGIC:
+            raise ValueError("not a LevelData snapshot")
+        if data[4:8] != SCHEMA_HASH:
+            raise ValueError("snapshot was written for a different version of models.py")
+        self.data = data
+        count, pos = _read_varint(data, 8)
+        strings = [None]
+        for _ in range(count):
+            length, pos = _read_varint(data, pos)
+            strings.append(data[pos:pos + length].decode())
+            pos += length
+        self.strings = strings
+        self.pos = pos
+
+    def table(self, cls, count: int) -> list:
+        columns = []
+        for name, kind, field_cls in _schema(cls):
+            if kind == OBJECT:
+                columns.append(self.table(field_cls, count))
+            elif kind == TABLE:
+                lengths = []
+                for _ in range(count):
+                    length, self.pos = _read_varint(self.data, self.pos)
+                    lengths.append(length)
+                children = self.table(field_cls, sum(lengths))
+                rows, start = [], 0
+                for length in lengths:
+                    rows.append(children[start:start + length])
+                    start += length
+                columns.append(rows)
+            else:
+                values = self.column(count)
+                if field_cls is not None:
+                    values = [field_cls(value) for value in values]
+                columns.append(values)
+        return list(map(cls, *columns))
+
+    def column(self, count: int) -> list:
+        data, pos = self.data, self.pos
+        kind = data[pos]
+        pos += 1
+        if kind == BOOL:
+            values = [value != 0 for value in data[pos:pos + count]]
+            pos += count
+        elif kind in (INT, FLOAT):
+            values = np.frombuffer(data, dtype=np.int64 if kind == INT else np.float64, count=count, offset=pos).tolist()
+            pos += count * 8
+        elif kind == NUMBER:
+            values = np.frombuffer(data, dtype=np.float64, count=count, offset=pos).tolist()
+            pos += count * 8
+            is_int = data[pos:pos + count]
+            pos += count
+            values = [int(value) if flag else value for value, flag in zip(values, is_int)]
+        elif kind == STRING:
+            strings = self.strings
+            values = []
+            for _ in range(count):
+                index, pos = _read_varint(data, pos)
+                values.append(strings[index])
+        elif kind == JSON:
+            length, pos = _read_varint(data, pos)
+            values = json.loads(data[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError(f"unknown column kind {kind!r} at offset {pos - 1}")
+        self.pos = pos
+        return values
+
+
+def dumps(level_data: LevelData) -> bytes:
+    """Encode `level_data` as a binary snapshot."""
+    writer = _Writer()
+    writer.table(LevelData, [level_data])
+    return writer.getvalue()
+
+
+def loads(data: bytes) -> LevelData:
+    """Decode a snapshot written by `dumps`."""
+    return _Reader(data).table(LevelData, 1)[0]
+
+
+class StepMarker(NamedTuple):
+    """
+    Marks the frame recorded before it as the observation of an env step.
+
+    `action` is the action index that led to it, -1 for the first observation of an
+    episode. `frame_missing` is set when that frame is not the one recorded before the
+    marker (it was dropped, or a marker was), so there is no step frame to attribute.
+    """
+    action: int
+    frame_missing: bool = False
+
+
+class FrameRecorder:
+    """
+    Records frames to `path` as snapshots, each prefixed with its length as a
+    little-endian uint32. Step markers are written as the length STEP_MARKER
+    followed by a StepMarker packed as STEP_FORMAT.
+
+    `record` only queues the frame: a writer thread encodes and writes it, so the
+    frame server's request handler is not delayed. When the writer falls
+    `max_pending` frames behind, new frames and step markers are dropped and counted
+    in `dropped`.
+    """
+
+    def __init__(self, path: str, max_pending: int = 256):
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.frames = 0
+        self.steps = 0
+        self.bytes = 0
+        self.dropped = 0
+        # record runs on the frame server thread and mark_step on the env's, the lock keeps
+        # a marker right behind the frame it checked
+        self.lock = threading.Lock()
+        self.last_recorded = None
+        self.marker_dropped = False
+        self.thread = threading.Thread(target=self._run, name="frame-recorder", daemon=True)
+        self.thread.start()
+
+    def record(self, level_data: LevelData):
+        with self.lock:
+            try:
+                self.queue.put_nowait(level_data)
+                self.last_recorded = level_data
+            except queue.Full:
+                self.dropped += 1
+
+    def mark_step(self, level_data: LevelData, action: int):
+        """Mark `level_data`, the frame an env step (or reset, with action -1) returned, as a step frame."""
+        with self.lock:
+            marker = StepMarker(action, self.marker_dropped or level_data is not self.last_recorded)
+            try:
+                self.queue.put_nowait(marker)
+                self.marker_dropped = False
+            except queue.Full:
+                self.marker_dropped = True
+                self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "ab", buffering=1 << 20) as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if isinstance(item, StepMarker):
+                    f.write(struct.pack("<I", STEP_MARKER))
+                    f.write(STEP_FORMAT.pack(*item))
+                    self.steps += 1
+                    self.bytes += STEP_FORMAT.size + 4
+                    continue
+                data = dumps(item)
+                f.write(struct.pack("<I", len(data)))
+                f.write(data)
+                self.frames += 1
+                self.bytes += len(data) + 4
+
+    def close(self):
+        """Write the queued frames and close the file."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+def read_records(path: str) -> Iterator[Union[LevelData, StepMarker]]:
+    """Iterate over the frames and step markers recorded by a FrameRecorder, in order."""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            (length,) = struct.unpack("<I", header)
+            if length == STEP_MARKER:
+                yield StepMarker(*STEP_FORMAT.unpack(f.read(STEP_FORMAT.size)))
+            else:
+                yield loads(f.read(length))
+
+
+def read_frames(path: str) -> Iterator[LevelData]:
+    """Iterate over the frames recorded by a FrameRecorder."""
+    for record in read_records(path):
+        if not isinstance(record, StepMarker):
+            yield record
@@ -0,0 +1,258 @@
+"""
+Stand-in for the game, to run env servers without it (fleet smoke runs, benchmarks).
+
+It plays the game's side of the protocol: every frame it fetches GET /reset, posts
+the frame to POST / and applies the moves it gets back to a small synthetic match.
+The player moves towards `move_to` targets, enemies chase it, attacking kills
+enemies in reach and walking over coins collects them. After a reset the match goes
+STARTING -> STARTED and ends after `match_frames` frames.
+
+Frames can be sent gzip or deflate compressed, and with the delta protocol of delta.py.
+
+    python standin.py --port 3000 --fps 60
+    python standin.py --port 3000 --delta --compress gzip
+"""
+import argparse
+import gzip
+import http.client
+import json
+import logging
+import math
+import random
+import threading
+import time
+import zlib
+
+from delta import DeltaEncoder, DELTA_HEADER
+from models import GameState
+
+logger = logging.getLogger(__name__)
+
+
+class StandInGame:
+    def __init__(self, port: int = 3000, host: str = "127.0.0.1", fps: float = 60, seed: int = 0, map_size: float = 4000,
+                 n_enemies: int = 20, n_items: int = 10, n_obstacles: int = 500, match_frames: int = 3600,
+                 starting_frames: int = 3, compress: str = None, delta: bool = False):
+        self.host = host
+        self.port = port
+        self.fps = fps
+        self.map_size = map_size
+        self.n_enemies = n_enemies
+        self.n_items = n_items
+        self.match_frames = match_frames
+        self.starting_frames = starting_frames
+        self.random = random.Random(seed)
+        self.compress = compress
+        self.delta = DeltaEncoder() if delta else None
+        self.connection = None
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.spawned = 0
+
+        self.match_id = 0
+        self.state = GameState.WAITING
+        self.state_frames = 0
+        self.obstacles = [{"x": self.random.uniform(0, map_size), "y": self.random.uniform(0, map_size)}
+                          for _ in range(n_obstacles)]
+        self.new_match()
+
+    def new_match(self):
+        self.match_id += 1
+        self.score = 0
+        self.health = 100.0
+        self.dead_frames = 0
+        self.position = self.random_position()
+        self.target = dict(self.position)
+        self.attacking = False
+        self.enemies = [self.new_enemy() for _ in range(self.n_enemies)]
+        self.items = [self.new_item() for _ in range(self.n_items)]
+
+    def random_position(self) -> dict:
+        return {"x": self.random.uniform(0, self.map_size), "y": self.random.uniform(0, self.map_size)}
+
+    def new_id(self, kind: str) -> str:
+        self.spawned += 1
+        return f"{kind}-{self.spawned}"
+
+    def new_enemy(self) -> dict:
+        return {"id": self.new_id("enemy"), "position": self.random_position(),
+                "type": "wolf", "attack_damage": 2, "direction": "left", "health": 30.0, "max_health": 30.0,
+                "is_attacking": False, "is_frozen": False, "is_pushed": False, "is_zapped": False, "points": 10}
+
+    def new_item(self) -> dict:
+        return {"id": self.new_id("coin"), "position": self.random_position(),
+                "type": "coin", "value": 1, "points": 5}
+
+    def player(self) -> dict:
+        return {
+            "id": "standin", "position": dict(self.position), "type": "player", "attack_damage": 10,
+            "direction": "right", "health": self.health, "max_health": 100.0, "is_attacking": self.attacking,
+            "is_frozen": False, "is_pushed": False, "is_zapped": False, "points": self.score,
+            "display_name": "standin", "is_dashing": False,
+            "levelling": {"level": 1, "available_skill_points": 0, "attack": 0, "speed": 0, "health": 0},
+            "score": self.score, "shield_raised": False, "special_equipped": "", "speech": "",
+            "unleashing_shockwave": False, "is_overclocking": False, "has_health_regen": False, "base_speed": 300.0,
+            "collisions": [], "items": {"big_potions": [], "speed_zappers": [], "rings": []},
+            "is_cloaked": False, "is_colliding": False, "is_dash_ready": True, "is_shield_ready": True,
+            "is_special_ready": False, "is_zap_ready": False, "overclock_duration": 0,
+        }
+
+    def frame(self) -> dict:
+        return {
+            "game_info": {"friendly_fire": True, "game_type": "rpg", "map": "standin", "match_id": str(self.match_id),
+                          "state": self.state.value, "time_remaining_s": max(self.match_frames - self.state_frames, 0) // 60,
+                          "latency": 0},
+            "own_player": self.player(),
+            "items": self.items,
+            "enemies": self.enemies,
+            "players": [],
+            "obstacles": self.obstacles,
+            "hazards": [],
+            "stats": [{"id": "standin", "score": self.score, "kills": 0, "deaths": 0, "coins": 0, "kd_ratio": 0.0,
+                       "kill_streak": 0, "overclocks": 0, "xps": 0.0, "wolf_kills": 0, "ghoul_kills": 0, "tiny_kills": 0,
+                       "minotaur_kills": 0, "player_kills": 0, "self_destructs": 0}],
+        }
+
+    def apply(self, moves: list):
+        self.attacking = False
+        for move in moves:
+            if move == "attack":
+                self.attacking = True
+            elif isinstance(move, dict) and "move_to" in move:
+                self.target = move["move_to"]
+
+    def tick(self):
+        """Advance the match by one frame."""
+        self.state_frames += 1
+        if self.state == GameState.STARTING and self.state_frames >= self.starting_frames:
+            self.state, self.state_frames = GameState.STARTED, 0
+        elif self.state == GameState.STARTED and self.state_frames >= self.match_frames:
+            self.state, self.state_frames = GameState.ENDED, 0
+        if self.state != GameState.STARTED:
+            return
+
+        if self.health <= 0:
+            self.dead_frames += 1
+            if self.dead_frames >= self.fps:
+                self.health, self.dead_frames = 100.0, 0
+                self.position = self.random_position()
+            return
+
+        step = 300.0 / self.fps
+        dx, dy = self.target["x"] - self.position["x"], self.target["y"] - self.position["y"]
+        distance = math.hypot(dx, dy)
+        if distance > step:
+            dx, dy = dx / distance * step, dy / distance * step
+        self.position = {"x": min(max(self.position["x"] + dx, 0), self.map_size),
+                         "y": min(max(self.position["y"] + dy, 0), self.map_size)}
+
+        for i, enemy in enumerate(self.enemies):
+            ex, ey = enemy["position"]["x"], enemy["position"]["y"]
+            distance = math.hypot(self.position["x"] - ex, self.position["y"] - ey)
+            if distance < 600 and distance > 1:
+                enemy["position"] = {"x": ex + (self.position["x"] - ex) / distance * step * 0.5,
+                                     "y": ey + (self.position["y"] - ey) / distance * step * 0.5}
+            if self.attacking and distance < 100:
+                enemy["health"] -= 10
+                if enemy["health"] <= 0:
+                    self.score += enemy["points"]
+                    self.enemies[i] = self.new_enemy()
+            elif distance < 50:
+                self.health = max(self.health - enemy["attack_damage"] / 10, 0)
+
+        for i, item in enumerate(self.items):
+            if math.hypot(self.position["x"] - item["position"]["x"], self.position["y"] - item["position"]["y"]) < 40:
+                self.score += item["points"]
+                self.items[i] = self.new_item()
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None):
+        """Send a request and return the response status and its JSON body."""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=5)
+        headers = dict(headers or {})
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, json.loads(response.read())
+        except Exception:
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def post_frame(self):
+        """POST the current frame, in full or as a delta, and return the moves."""
+        frame = self.frame()
+        headers = {}
+        if self.delta is not None:
+            frame = self.delta.encode(frame)
+            headers[DELTA_HEADER] = "delta"
+        body = json.dumps(frame).encode()
+        if self.compress == "gzip":
+            body = gzip.compress(body, compresslevel=1)
+        elif self.compress == "deflate":
+            body = zlib.compress(body, 1)
+        if self.compress is not None:
+            headers["Content-Encoding"] = self.compress
+        self.bytes_sent += len(body)
+        status, moves = self.request("POST", "/", body, headers)
+        if status == 409:
+            # the server has no full frame to merge the delta into
+            self.delta.resync()
+            return []
+        return moves
+
+    def run(self, stop: threading.Event = None):
+        """Send frames at `fps` until `stop` is set, reconnecting while the env server is not up."""
+        interval = 1 / self.fps
+        deadline = time.perf_counter()
+        while stop is None or not stop.is_set():
+            try:
+                _, reset = self.request("GET", "/reset")
+                if reset["reset"]:
+                    if reset.get("seed") is not None:
+                        self.random.seed(reset["seed"])
+                    self.new_match()
+                    self.state, self.state_frames = GameState.STARTING, 0
+                moves = self.post_frame()
+                self.frames_sent += 1
+                self.apply(moves)
+                self.tick()
+            except (OSError, http.client.HTTPException) as e:
+                logger.debug(f"env server on port {self.port} not reachable: {e!r}")
+                if self.delta is not None:
+                    self.delta.resync()
+                time.sleep(0.5)
+                deadline = time.perf_counter()
+                continue
+            deadline += interval
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # running behind, don't try to catch up
+                deadline = time.perf_counter()
+
+    def start(self) -> threading.Event:
+        """Run in a daemon thread; set the returned event to stop it."""
+        stop = threading.Event()
+        threading.Thread(target=self.run, args=(stop,), name=f"standin-{self.port}", daemon=True).start()
+        return stop
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--fps", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--obstacles", type=int, default=500)
+    parser.add_argument("--match_frames", type=int, default=3600, help="frames until the match ends")
+    parser.add_argument("--compress", choices=("gzip", "deflate"), default=None, help="Content-Encoding of the frames")
+    parser.add_argument("--delta", action="store_true", help="send frames with the delta protocol (see delta.py)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    StandInGame(args.port, host=args.host, fps=args.fps, seed=args.seed, n_obstacles=args.obstacles,
+                match_frames=args.match_frames, compress=args.compress, delta=args.delta).run()
@@ -0,0 +1,263 @@
+"""
+Hyperparameter sweep over PPO and observation settings, with trials running in parallel.
+
+Each trial trains its own PPO model on a CustomEnv paired with a local stand-in game
+(standin.py) on a port of its own. Trials run in a process pool. Every worker is
+pinned to its own share of the CPUs (affinity, and torch and BLAS thread counts),
+so concurrent trials do not oversubscribe the machine. After every rollout a trial
+reports its mean step reward to the other trials. A trial whose running mean falls
+below the median of the trials that got that far is stopped early (median stopping
+rule). Results are appended to a CSV file as trials finish.
+
+The search space is a JSON object mapping parameters to a list of values, or, for
+random search, to `{"uniform": [low, high]}` or `{"log_uniform": [low, high]}`:
+
+    {"n_steps": [128, 256], "learning_rate": {"log_uniform": [1e-5, 1e-3]}, "max_obstacles": [0, 500]}
+
+    python sweep.py --space space.json --mode random --n_trials 16 --timesteps 20000
+    python sweep.py --mode grid --threads_per_trial 2
+"""
+import argparse
+import csv
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+PPO_PARAMS = ("n_steps", "n_epochs", "batch_size", "learning_rate", "gamma")
+ENV_PARAMS = ("max_players", "max_enemies", "max_items", "max_hazards", "max_obstacles")
+
+DEFAULT_SPACE = {
+    "n_steps": [128, 256],
+    "n_epochs": [4, 10],
+    "batch_size": [64, 128],
+    "learning_rate": [1e-4, 3e-4],
+    "gamma": [0.95, 0.99],
+    "max_obstacles": [0, 500],
+}
+
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def check_space(space: dict):
+    unknown = set(space) - set(PPO_PARAMS) - set(ENV_PARAMS)
+    if unknown:
+        raise ValueError(f"unknown sweep parameters {sorted(unknown)}, expected some of {PPO_PARAMS + ENV_PARAMS}")
+
+
+def grid_trials(space: dict) -> List[dict]:
+    """Every combination of the listed values."""
+    check_space(space)
+    for name, values in space.items():
+        if not isinstance(values, list):
+            raise ValueError(f"grid search needs a list of values for {name!r}, got {values!r}")
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_trials(space: dict, n_trials: int, seed: int = 0) -> List[dict]:
+    """`n_trials` samples: a random choice from lists, uniform or log-uniform draws from ranges."""
+    check_space(space)
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(n_trials):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                params[name] = rng.choice(values)
+            elif "uniform" in values:
+                params[name] = rng.uniform(*values["uniform"])
+            elif "log_uniform" in values:
+                low, high = values["log_uniform"]
+                params[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+            else:
+                raise ValueError(f"unsupported range for {name!r}: {values!r}")
+        trials.append(params)
+    return trials
+
+
+def pin_worker(cpu_sets, threads: int):
+    """Pool initializer: take a CPU set for this worker and limit its threads to it."""
+    cpus = cpu_sets.get()
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    import torch
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+
+def value_at(history: List[tuple], timesteps: int) -> float:
+    """The last value of a (timesteps, value) history reported at or before `timesteps`."""
+    value = history[0][1]
+    for reported, running in history:
+        if reported > timesteps:
+            break
+        value = running
+    return value
+
+
+def make_stopping_callback(trial: int, board, grace_rollouts: int, min_trials: int):
+    from stable_baselines3.common.callbacks import BaseCallback
+
+    class MedianStoppingCallback(BaseCallback):
+        """
+        Publishes the running mean of the rollouts' mean step reward to `board`, as
+        (timesteps, value) pairs, and stops training when it is below the median of
+        the other trials that have trained at least as many steps, at the same step count.
+        """
+
+        def __init__(self):
+            super().__init__()
+            self.history = []
+            self.stopped = False
+
+        def _on_step(self) -> bool:
+            return not self.stopped
+
+        def _on_rollout_end(self) -> None:
+            reward = float(self.model.rollout_buffer.rewards.mean())
+            previous = self.history[-1][1] if self.history else 0.0
+            running = previous + (reward - previous) / (len(self.history) + 1)
+            timesteps = self.model.num_timesteps
+            self.history.append((timesteps, running))
+            # proxies only see item assignments
+            board[trial] = list(self.history)
+            if len(self.history) <= grace_rollouts:
+                return
+            others = [value_at(history, timesteps) for other, history in board.items()
+                      if other != trial and history and history[-1][0] >= timesteps]
+            if len(others) >= min_trials and running < statistics.median(others):
+                self.stopped = True
+
+    return MedianStoppingCallback()
+
+
+def run_trial(trial: int, params: dict, port: int, timesteps: int, board, standin_fps: float, grace_rollouts: int,
+              min_trials: int, step_timeout: float, seed: int) -> dict:
+    """Train one configuration against its own stand-in game and return its results row."""
+    from stable_baselines3 import PPO
+
+    from env import CustomEnv
+    from fleet import GameClient
+
+    ppo_kwargs = {name: value for name, value in params.items() if name in PPO_PARAMS}
+    env_kwargs = {name: value for name, value in params.items() if name in ENV_PARAMS}
+    for name in ("n_steps", "n_epochs", "batch_size"):
+        if name in ppo_kwargs:
+            ppo_kwargs[name] = int(ppo_kwargs[name])
+    row = {"trial": trial, **params, "status": "failed", "timesteps": 0, "mean_reward": None, "seconds": None,
+           "steps_per_s": None, "error": ""}
+
+    client = GameClient(port, standin_fps=standin_fps)
+    env = None
+    started = time.perf_counter()
+    try:
+        env = CustomEnv(port=port, skip_frames=0, step_timeout=step_timeout, **env_kwargs)
+        env.start().result()
+        client.start()
+        model = PPO("MlpPolicy", env, seed=seed, **ppo_kwargs)
+        callback = make_stopping_callback(trial, board, grace_rollouts, min_trials)
+        model.learn(total_timesteps=timesteps, callback=callback)
+        stopped = callback.stopped and model.num_timesteps < timesteps
+        row.update(status="stopped" if stopped else "completed", timesteps=model.num_timesteps,
+                   mean_reward=callback.history[-1][1] if callback.history else None)
+    except Exception as e:
+        logger.exception(f"trial {trial} failed")
+        row["error"] = repr(e)
+    finally:
+        seconds = time.perf_counter() - started
+        row["seconds"] = round(seconds, 1)
+        row["steps_per_s"] = round(row["timesteps"] / seconds, 1) if seconds > 0 else None
+        client.stop()
+        if env is not None:
+            env.close()
+    return row
+
+
+def cpu_sets(n_workers: int, threads: int) -> List[List[int]]:
+    """`threads` CPUs for each worker, from the ones this process may run on; empty sets when they run out."""
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    return [cpus[i * threads:(i + 1) * threads] for i in range(n_workers)]
+
+
+def sweep(trials: List[dict], results_path: str, n_workers: int, threads_per_trial: int = 1, timesteps: int = 10000,
+          standin_fps: float = 240, grace_rollouts: int = 3, min_trials: int = 2, step_timeout: float = 10.0,
+          seed: int = 0) -> List[dict]:
+    """Run `trials` on `n_workers` processes, appending each finished trial to the CSV at `results_path`."""
+    from fleet import allocate_ports
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    board = manager.dict()
+    worker_cpus = manager.Queue()
+    for cpus in cpu_sets(n_workers, threads_per_trial):
+        worker_cpus.put(cpus)
+    ports = allocate_ports(len(trials))
+
+    columns = ["trial"] + sorted({name for params in trials for name in params}) + [
+        "status", "timesteps", "mean_reward", "seconds", "steps_per_s", "error"]
+    rows = []
+    with open(results_path, "w", newline="") as f, \
+            ProcessPoolExecutor(n_workers, mp_context=context, initializer=pin_worker,
+                                initargs=(worker_cpus, threads_per_trial)) as pool:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        futures = [pool.submit(run_trial, trial, params, port, timesteps, board, standin_fps, grace_rollouts,
+                               min_trials, step_timeout, seed)
+                   for trial, (params, port) in enumerate(zip(trials, ports))]
+        for future in as_completed(futures):
+            row = future.result()
+            rows.append(row)
+            writer.writerow(row)
+            f.flush()
+            logger.info(f"trial {row['trial']} {row['status']}: mean reward {row['mean_reward']} in {row['seconds']}s")
+    manager.shutdown()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--space", type=str, default=None, help="JSON file with the search space, a small default grid otherwise")
+    parser.add_argument("--mode", choices=("grid", "random"), default="grid")
+    parser.add_argument("--n_trials", type=int, default=16, help="trials sampled in random mode")
+    parser.add_argument("--timesteps", type=int, default=10000, help="training steps per trial")
+    parser.add_argument("--threads_per_trial", type=int, default=1, help="CPUs and torch threads given to each trial")
+    parser.add_argument("--n_workers", type=int, default=None, help="concurrent trials, all CPUs by default")
+    parser.add_argument("--grace_rollouts", type=int, default=3, help="rollouts before a trial can be stopped early")
+    parser.add_argument("--min_trials", type=int, default=2, help="trials to compare with before stopping one early")
+    parser.add_argument("--standin_fps", type=float, default=240)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results", type=str, default="sweep_results.csv")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    space = DEFAULT_SPACE
+    if args.space is not None:
+        with open(args.space) as f:
+            space = json.load(f)
+    try:
+        trials = grid_trials(space) if args.mode == "grid" else random_trials(space, args.n_trials, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    n_workers = args.n_workers or max((os.cpu_count() or 1) // args.threads_per_trial, 1)
+    logger.info(f"running {len(trials)} trials on {n_workers} workers")
+
+    rows = sweep(trials, args.results, n_workers, threads_per_trial=args.threads_per_trial, timesteps=args.timesteps,
+                 standin_fps=args.standin_fps, grace_rollouts=args.grace_rollouts, min_trials=args.min_trials,
+                 seed=args.seed)
+    ranked = sorted(rows, key=lambda row: row["mean_reward"] if row["mean_reward"] is not None else -math.inf, reverse=True)
+    for row in ranked:
+        print(json.dumps({name: value for name, value in row.items() if name != "error" or value}))
@@ -0,0 +1,50 @@
+"""Synthetic frames for the tests, shaped like the game's POST / body."""
+import random
+
+from models import LevelData
+
+
+def player(i, rng, own=False):
+    data = dict(
+        id=f"p{i}", position=dict(x=rng.uniform(0, 4000), y=rng.uniform(0, 4000)), type="player",
+        attack_damage=rng.randint(1, 50), direction=rng.choice(["right", "left"]), health=rng.uniform(0, 100),
+        max_health=100.0, is_attacking=rng.random() < 0.5, is_frozen=rng.random() < 0.2, is_pushed=False,
+        is_zapped=rng.random() < 0.2, points=rng.randint(0, 100), display_name="x", is_dashing=False,
+        levelling=dict(level=rng.randint(1, 10), available_skill_points=rng.randint(0, 3), attack=1, speed=2, health=3),
+        score=rng.randint(0, 1000), shield_raised=False, special_equipped=rng.choice(["", "bomb", "freeze"]), speech="",
+        unleashing_shockwave=False, is_overclocking=False, has_health_regen=True, base_speed=300.0,
+    )
+    if own:
+        data.update(
+            collisions=[dict(type=rng.choice(["wolf", "obstacle", "chest"]), relative_position=dict(x=rng.uniform(-50, 50), y=1))
+                        for _ in range(rng.randint(0, 4))],
+            items=dict(big_potions=[], speed_zappers=[{}] * rng.randint(0, 2), rings=[]),
+            is_cloaked=False, is_colliding=True, is_dash_ready=rng.random() < 0.5, is_shield_ready=True,
+            is_special_ready=False, is_zap_ready=False, overclock_duration=rng.uniform(0, 5),
+        )
+    return data
+
+
+def frame_dict(seed=0, n_enemies=20, n_obstacles=50, state="STARTED") -> dict:
+    rng = random.Random(seed)
+    return dict(
+        game_info=dict(friendly_fire=True, game_type="rpg", map="m1", match_id="a", state=state,
+                       time_remaining_s=rng.uniform(0, 300), latency=rng.randint(1, 50)),
+        own_player=player(0, rng, own=True),
+        items=[dict(id=f"i{k}", position=dict(x=rng.uniform(0, 4000), y=k), type=rng.choice(["coin", "ring", "power_up"]),
+                    value=1, points=5, power=rng.choice(["bomb", "unknown"])) for k in range(rng.randint(0, 10))],
+        enemies=[dict(id=f"e{k}", position=dict(x=rng.uniform(0, 4000), y=rng.uniform(0, 4000)), type=rng.choice(["wolf", "tiny"]),
+                      attack_damage=3, direction="left", health=50, max_health=50, is_attacking=False, is_frozen=False,
+                      is_pushed=rng.random() < 0.3, is_zapped=False, points=10) for k in range(n_enemies)],
+        players=[player(k, rng) for k in range(1, 4)],
+        obstacles=[dict(x=rng.uniform(0, 4000), y=rng.uniform(0, 4000)) for _ in range(n_obstacles)],
+        hazards=[dict(id=f"h{k}", position=dict(x=k, y=k), type=rng.choice(["bomb", "icicle", "laser"]),
+                      status=rng.choice(["idle", "active"]), attack_damage=20, owner_id="p1") for k in range(3)],
+        stats=[dict(id=f"p{k}", score=rng.randint(0, 100), kills=k, deaths=0, coins=3, kd_ratio=0.5, kill_streak=1,
+                    overclocks=0, xps=1.0, wolf_kills=2, ghoul_kills=0, tiny_kills=0, minotaur_kills=0, player_kills=0,
+                    self_destructs=0) for k in range(4)],
+    )
+
+
+def frame(seed=0, **kwargs) -> LevelData:
+    return LevelData.from_dict(frame_dict(seed, **kwargs))
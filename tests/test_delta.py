@@ -0,0 +1,37 @@
+import json
+
+from delta import DeltaEncoder, DeltaMerger
+from standin import GameState, StandInGame
+
+
+def test_merge_rebuilds_the_full_frame():
+    game = StandInGame(n_enemies=12, n_items=8, n_obstacles=20, match_frames=10000)
+    game.state = GameState.STARTED
+    game.attacking = True
+    encoder, merger = DeltaEncoder(), DeltaMerger()
+    matches = set()
+    reordered = 0
+    for i in range(300):
+        if i == 150:
+            game.new_match()
+            game.state = GameState.STARTED
+        if i % 40 == 20:
+            # an enemy leaving without a replacement
+            game.enemies.pop(i % len(game.enemies))
+        # stand next to the first enemy, which respawns in its slot when killed
+        game.position = {"x": game.enemies[0]["position"]["x"] + 10, "y": game.enemies[0]["position"]["y"]}
+        game.target = dict(game.position)
+        game.attacking = True
+        game.tick()
+        # the stand-in updates its entities in place, keep the frame as it was sent
+        frame = json.loads(json.dumps(game.frame()))
+        matches.add(frame["game_info"]["match_id"])
+        body = encoder.encode(frame)
+        reordered += "order" in body.get("enemies", {})
+        assert merger.merge(body) == frame, i
+    assert reordered > 10 and len(matches) == 2
+
+
+def test_merge_without_full_frame():
+    merger = DeltaMerger()
+    assert merger.merge({"game_info": {"match_id": "1"}, "own_player": {}}) is None
@@ -0,0 +1,38 @@
+import numpy as np
+
+from features import FeatureEncoder, default_spec
+from frames import frame
+
+
+def test_entity_without_numeric_features():
+    spec = default_spec().select(drop=["game_info.time_remaining_s", "game_info.latency", "game_info.friendly_fire"])
+    encoder = FeatureEncoder(spec)
+    level_data = frame()
+    obs = encoder.encode(level_data)
+    start, end = encoder.blocks["game_info"]
+    assert end - start == 3
+    # state STARTED, the map id, game type rpg
+    assert obs[start] == 3 and obs[end - 1] == 1
+
+
+def test_default_spec_matches_observation_encoder():
+    from encoder import ObservationEncoder
+
+    limits = dict(max_players=4, max_enemies=8, max_items=5, max_hazards=2, max_obstacles=30)
+    reference = ObservationEncoder(**limits)
+    encoder = FeatureEncoder(default_spec(**limits))
+    assert encoder.size == reference.size
+
+    # same blocks in the same order, the collisions being part of ObservationEncoder's own player
+    assert encoder.blocks["own_player"][0] == reference.blocks["own_player"][0]
+    assert encoder.blocks["collisions"][1] == reference.blocks["own_player"][1]
+    for name, block in reference.blocks.items():
+        if name != "own_player":
+            assert encoder.blocks[name] == block, name
+    assert list(encoder.blocks) == ["own_player", "collisions"] + [name for name in reference.blocks if name != "own_player"]
+    assert (encoder.feature_dtypes() == reference.feature_dtypes()).all()
+
+    # fewer and more entities than slots
+    for seed, n_enemies, n_obstacles in [(0, 0, 0), (1, 3, 10), (2, 20, 60)]:
+        level_data = frame(seed, n_enemies=n_enemies, n_obstacles=n_obstacles)
+        np.testing.assert_array_equal(encoder.encode(level_data), reference.encode(level_data))
@@ -0,0 +1,41 @@
+import numpy as np
+from stable_baselines3 import PPO
+from stable_baselines3.common.vec_env import DummyVecEnv, VecNormalize
+
+from env import CustomEnv
+from frames import frame
+from numpy_policy import NumpyPolicy, export_policy
+
+
+def observations(env, rng, samples=256):
+    """Encoded frames and random observations, a batch of each."""
+    encoded = np.stack([env.encoder.encode(frame(seed, n_enemies=4, n_obstacles=10)) for seed in range(samples)])
+    return np.concatenate([encoded, rng.normal(scale=3.0, size=encoded.shape).astype(np.float32)])
+
+
+def test_predict_matches_model(tmp_path):
+    env = CustomEnv(max_players=2, max_enemies=4, max_items=3, max_hazards=2, max_obstacles=10)
+    model = PPO("MlpPolicy", env, policy_kwargs=dict(net_arch=[32, 32]), seed=0, device="cpu")
+    model.save(tmp_path / "model.zip")
+    policy = export_policy(str(tmp_path / "model.zip"), str(tmp_path / "model.npz"))
+
+    obs = observations(env, np.random.default_rng(0))
+    expected, _ = model.predict(obs, deterministic=True)
+    assert np.array_equal(policy.predict(obs), expected)
+    assert np.array_equal(NumpyPolicy.load(str(tmp_path / "model.npz")).predict(obs), expected)
+
+
+def test_predict_matches_model_with_vecnormalize(tmp_path):
+    env = CustomEnv(max_players=2, max_enemies=4, max_items=3, max_hazards=2, max_obstacles=10)
+    vec_normalize = VecNormalize(DummyVecEnv([lambda: env]), clip_obs=5.0)
+    rng = np.random.default_rng(1)
+    obs = observations(env, rng)
+    vec_normalize.obs_rms.update(obs * rng.uniform(0.5, 2.0, size=obs.shape[1]))
+    vec_normalize.save(str(tmp_path / "vecnormalize.pkl"))
+    model = PPO("MlpPolicy", vec_normalize, policy_kwargs=dict(net_arch=[32, 32]), seed=0, device="cpu")
+    model.save(tmp_path / "model.zip")
+    policy = export_policy(str(tmp_path / "model.zip"), str(tmp_path / "model.npz"), str(tmp_path / "vecnormalize.pkl"))
+
+    expected, _ = model.predict(vec_normalize.normalize_obs(obs), deterministic=True)
+    assert np.array_equal(policy.predict(obs), expected)
+    assert np.array_equal(NumpyPolicy.load(str(tmp_path / "model.npz")).predict(obs), expected)
@@ -0,0 +1,37 @@
+import numpy as np
+
+from frames import frame
+from rewards import RewardFunction, relabel_recordings
+from snapshot import FrameRecorder, read_frames
+
+
+def test_relabel_between_step_frames(tmp_path):
+    frames = [frame(seed) for seed in range(12)]
+    path = str(tmp_path / "frames.snap")
+    recorder = FrameRecorder(path)
+    reward_fn = RewardFunction()
+    rewards = []
+    # a reset, then steps of 1-3 frames (skipped or macro frames in between), then a reset after a dropped frame
+    recorder.record(frames[0])
+    recorder.mark_step(frames[0], -1)
+    previous = frames[0]
+    for step, (first, last) in enumerate([(1, 1), (2, 4), (5, 6)]):
+        for level_data in frames[first:last + 1]:
+            recorder.record(level_data)
+        recorder.mark_step(frames[last], step)
+        rewards.append(reward_fn(previous, frames[last]))
+        previous = frames[last]
+    recorder.mark_step(frames[7], 3)
+    recorder.record(frames[8])
+    recorder.mark_step(frames[8], 4)
+    recorder.record(frames[9])
+    recorder.mark_step(frames[9], -1)
+    recorder.record(frames[10])
+    recorder.mark_step(frames[10], 5)
+    rewards.append(reward_fn(frames[9], frames[10]))
+    recorder.close()
+
+    assert len(list(read_frames(path))) == 10
+    results = relabel_recordings([path], reward_fn, chunk=2)
+    assert np.allclose(results["reward"], rewards)
+    assert list(results["action"]) == [0, 1, 2, 5]
@@ -0,0 +1,116 @@
+import time
+
+from stable_baselines3.common.callbacks import BaseCallback
+
+ENV_TIMINGS = ("game_wait", "decode", "encode", "reward")
+
+
+class TimeAttributionCallback(BaseCallback):
+    """
+    Splits the wall time of every rollout and update into where it went, and logs it
+    to TensorBoard under `time/`:
+
+    - `game_wait`, `decode`, `encode`, `reward`: the env side of the steps, from the
+      `info["timings"]` every CustomEnv step reports (summed over the envs). When
+      several envs wait for their games together, the waiting is what remains of
+      the vector step once the other env work is taken out;
+    - `policy_forward`: the policy forward passes that pick the actions;
+    - `rollout_other`: the rest of the rollout (rollout buffer, callbacks, returns);
+    - `gradient_update`: the PPO update between two rollouts (logged with the next
+      rollout, like SB3's `train/` values).
+
+    Each is logged as a share of the rollout plus update time, so whichever is
+    largest tells whether the run is limited by the game, the env or the learner.
+    `rollout/steps_per_s` and `rollout/frames_dropped` (frames the games sent that
+    were never decoded, because the env was not waiting or skip_frames dropped
+    them) are logged next to `rollout/ep_len_mean`.
+    """
+
+    def __init__(self, verbose: int = 0):
+        super().__init__(verbose)
+        self.hooks = []
+        self.rollout_started_at = None
+        self.rollout_ended_at = None
+        self.gradient_update = 0.0
+        self.frames_dropped = None
+        self._reset_rollout()
+
+    def _reset_rollout(self):
+        self.timings = dict.fromkeys(ENV_TIMINGS, 0.0)
+        self.policy_forward = 0.0
+        self.env_steps = 0
+        self.forward_started_at = None
+        self.forward_ended_at = None
+
+    def _on_training_start(self) -> None:
+        # the rollout calls the policy's forward, the update only evaluate_actions
+        self.hooks = [
+            self.model.policy.register_forward_pre_hook(self._forward_started),
+            self.model.policy.register_forward_hook(self._forward_ended),
+        ]
+        self.frames_dropped = self._frames_dropped()
+
+    def _forward_started(self, module, args):
+        self.forward_started_at = time.perf_counter()
+
+    def _forward_ended(self, module, args, output):
+        self.forward_ended_at = time.perf_counter()
+        self.policy_forward += self.forward_ended_at - self.forward_started_at
+
+    def _on_rollout_start(self) -> None:
+        now = time.perf_counter()
+        if self.rollout_ended_at is not None:
+            self.gradient_update = now - self.rollout_ended_at
+        self.rollout_started_at = now
+        self._reset_rollout()
+
+    def _on_step(self) -> bool:
+        if self.forward_ended_at is None:
+            return True
+        # the env step runs between the end of the forward pass and this callback
+        env_step = time.perf_counter() - self.forward_ended_at
+        self.forward_ended_at = None
+        self.env_steps += 1
+        env_work = 0.0
+        for info in self.locals.get("infos", ()):
+            timings = info.get("timings")
+            if timings is None:
+                continue
+            for name in ("decode", "encode", "reward"):
+                self.timings[name] += timings[name]
+                env_work += timings[name]
+        self.timings["game_wait"] += max(env_step - env_work, 0.0)
+        return True
+
+    def _on_rollout_end(self) -> None:
+        self.rollout_ended_at = time.perf_counter()
+        rollout = self.rollout_ended_at - self.rollout_started_at
+        total = rollout + self.gradient_update
+        if total <= 0:
+            return
+        spent = dict(self.timings, policy_forward=self.policy_forward, gradient_update=self.gradient_update)
+        spent["rollout_other"] = max(rollout - sum(self.timings.values()) - self.policy_forward, 0.0)
+        for name, seconds in spent.items():
+            self.logger.record(f"time/{name}", seconds / total)
+
+        self.logger.record("rollout/steps_per_s", self.env_steps * self.training_env.num_envs / rollout)
+        frames_dropped = self._frames_dropped()
+        if frames_dropped is not None and self.frames_dropped is not None:
+            self.logger.record("rollout/frames_dropped", frames_dropped - self.frames_dropped)
+        self.frames_dropped = frames_dropped
+
+    def _on_training_end(self) -> None:
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def _frames_dropped(self):
+        """Frames received but never decoded, over all the envs' servers; None if the envs have none."""
+        try:
+            metrics = self.training_env.env_method("server_metrics")
+        except AttributeError:
+            return None
+        metrics = [counters for counters in metrics if counters is not None]
+        if not metrics:
+            return None
+        return sum(counters["frames_received"] - counters["frames_decoded"] for counters in metrics)
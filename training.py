@@ -0,0 +1,115 @@
+"""
+Command line arguments and training setup shared by main.py and fleet.py.
+
+Both entry points define their own arguments on top of these, parse them, check them
+with `check_arguments` and then build the env from `env_kwargs(args, feature_spec)`
+and train with `learn`. Heavy imports happen inside the functions, so that `--help`
+starts instantly.
+"""
+import argparse
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def add_training_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--n_steps", type=int, default=1000)
+    parser.add_argument("--n_epochs", type=int, default=10)
+    parser.add_argument("--checkpoint_freq", type=int, default=1000)
+    parser.add_argument("--keep_checkpoints", type=int, default=0, help="keep only the last N checkpoints, 0 keeps all")
+    parser.add_argument("--log_path", type=str, default="./logs")
+    parser.add_argument("--checkpoint_path", type=str, default="./checkpoints")
+    parser.add_argument("--mask_actions", action="store_true", help="train with sb3-contrib's MaskablePPO on the env's action masks")
+
+
+def add_env_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--encode_in_server", action="store_true", help="encode observations on the server thread")
+    parser.add_argument("--track_slots", action="store_true", help="keep entities in the observation slot of their id")
+    parser.add_argument("--distance_field_dir", type=str, default=None, help="observe obstacle clearance around the player, caching per-map grids in this directory")
+    parser.add_argument("--feature_spec", type=str, default=None, help="observe the features of this spec (JSON, as saved next to the checkpoints)")
+    parser.add_argument("--drop_features", type=str, default=None, help="comma separated entity types or entity.feature names left out of the observation")
+    parser.add_argument("--macros", action="store_true", help="act with macro actions, move sequences the server plays one per frame (see macros.py)")
+    parser.add_argument("--profile_dir", type=str, default=None, help="allow sampling profiles of the server and env threads, started with GET /profile/start or SIGUSR2 (see profiler.py)")
+
+
+def check_arguments(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    """Reject combinations of the shared arguments (and main.py's compact_observations) that are not supported."""
+    compact_observations = getattr(args, "compact_observations", False)
+    if args.mask_actions and compact_observations:
+        parser.error("--mask_actions does not support --compact_observations")
+    if (args.feature_spec or args.drop_features) and (compact_observations or args.track_slots or args.distance_field_dir):
+        parser.error("--feature_spec and --drop_features do not support --compact_observations, --track_slots or --distance_field_dir")
+
+
+def ppo_class(parser: argparse.ArgumentParser, args: argparse.Namespace):
+    """PPO, or sb3-contrib's MaskablePPO with --mask_actions."""
+    if args.mask_actions:
+        try:
+            from sb3_contrib import MaskablePPO
+        except ImportError:
+            parser.error("--mask_actions needs sb3-contrib: pip install sb3-contrib")
+        return MaskablePPO
+    from stable_baselines3 import PPO
+
+    return PPO
+
+
+def feature_spec(args: argparse.Namespace):
+    """The features.FeatureSpec of --feature_spec and --drop_features, None for the full observation."""
+    from features import FeatureSpec, default_spec
+
+    if not (args.feature_spec or args.drop_features):
+        return None
+    spec = FeatureSpec.load(args.feature_spec) if args.feature_spec else default_spec()
+    if args.drop_features:
+        spec = spec.select(drop=args.drop_features.split(","))
+    return spec
+
+
+def env_kwargs(args: argparse.Namespace, spec=None) -> dict:
+    """CustomEnv arguments of the shared env arguments."""
+    from macros import default_macros
+
+    return dict(encode_in_server=args.encode_in_server, track_slots=args.track_slots, distance_field_dir=args.distance_field_dir,
+                feature_spec=spec, macros=default_macros() if args.macros else None, profile_dir=args.profile_dir)
+
+
+def configure_logger(args: argparse.Namespace):
+    from stable_baselines3.common.logger import configure
+
+    # log training data to stdout, typically at the end of each epoch
+    return configure(args.log_path, ["stdout", "tensorboard"])
+
+
+def learn(model, args: argparse.Namespace, spec=None):
+    """Train `model` for n_steps * n_epochs steps with checkpoints, hyperparameter and time logging, and save it."""
+    from stable_baselines3.common.callbacks import CallbackList
+
+    from async_checkpoint_callback import AsyncCheckpointCallback
+    from hyper_parameter_callback import HyperParamCallback
+    from time_attribution_callback import TimeAttributionCallback
+
+    model.set_logger(configure_logger(args))
+    # the spec goes with the checkpoints, run them with --feature_spec <checkpoint_path>/feature_spec.json
+    if spec is not None:
+        os.makedirs(args.checkpoint_path, exist_ok=True)
+        spec.save(os.path.join(args.checkpoint_path, "feature_spec.json"))
+
+    # save model checkpoints, written on a background thread so rollouts against the game don't stall
+    # https://stable-baselines3.readthedocs.io/en/master/guide/callbacks.html#stoptrainingcallback
+    checkpoint_callback = AsyncCheckpointCallback(
+        save_freq=args.checkpoint_freq,
+        save_path=args.checkpoint_path,
+        name_prefix="rl_model",
+        save_replay_buffer=True,
+        save_vecnormalize=True,
+        keep_last=args.keep_checkpoints or None,
+    )
+    # log where rollout and update time goes: the game, the env or the learner
+    callback = CallbackList([checkpoint_callback, HyperParamCallback(), TimeAttributionCallback()])
+
+    # add a progress bar so you know it's not frozen
+    model.learn(total_timesteps=args.n_steps * args.n_epochs, progress_bar=True, callback=callback)
+    checkpoint_callback.close()
+    model.save("rpg_agent")
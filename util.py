@@ -10,20 +10,27 @@ MAX_LEVELS=30
 
 POSITION_FACTOR=100
 
+# Storage dtypes of the features, declared next to each serializer (see ObservationEncoder.feature_dtypes)
+F32="float32"  # unbounded values: ids, raw counters, latency
+F16="float16"  # normalized values and positions
+U8="uint8"     # flags and categorical codes
+I8="int8"      # categorical codes that use -1 for unknown
+
 def serialize_position_x(position: Position, center: Position):
   return (position.x - center.x) / POSITION_FACTOR
 def serialize_position_y(position: Position, center: Position):
   return (position.y - center.y) / POSITION_FACTOR
 
+SPECIAL_EQUIPPED_MAPPING = {
+    "": 0,
+    "bomb": 1,
+    "shockwave": 2,
+    "freeze": 3,
+}
 player_feature_count = 21
+player_feature_dtypes = [F32] + [F16] * 6 + [U8] * 3 + [F16] * 2 + [U8] * 6 + [F16, U8, U8]
 def serialize_player(player: Player, center_pos: Position):
     """Convert player data to a flattened NumPy array."""
-    special_equipped_mapping = {
-        "": 0,
-        "bomb": 1,
-        "shockwave": 2,
-        "freeze": 3,
-    }
     return [
         string_to_int(player.id),
         # player.display_name,
@@ -46,31 +53,33 @@ def serialize_player(player: Player, center_pos: Position):
         int(player.is_overclocking),
         int(player.has_health_regen),
         player.points / MAX_SCORE,
-        special_equipped_mapping.get(player.special_equipped, 0),
+        SPECIAL_EQUIPPED_MAPPING.get(player.special_equipped, 0),
         int(player.unleashing_shockwave)
     ]
 
+COLLISION_TYPE_MAPPING = {
+    "obstacle": 0,
+    "player": 1,
+    "wolf": 2,
+    "ghoul": 3,
+    "minotaur": 4,
+    "tiny": 5,
+    "bomb": 6,
+    "icicle": 7,
+    "chest": 8,
+}
 collision_feature_count=3
+collision_feature_dtypes = [F16, F16, U8]
 def serialize_collision(collision: Collision):
-    type_mapping = {
-        "obstacle": 0,
-        "player": 1,
-        "wolf": 2,
-        "ghoul": 3,
-        "minotaur": 4,
-        "tiny": 5,
-        "bomb": 6,
-        "icicle": 7,
-        "chest": 8,
-    }
     return [
         collision.relative_position.x / POSITION_FACTOR,
         collision.relative_position.y / POSITION_FACTOR,
-        type_mapping.get(collision.type,0),
+        COLLISION_TYPE_MAPPING.get(collision.type,0),
     ]
 
 max_collisions=20
 own_player_feature_count = player_feature_count + 14 + max_collisions*collision_feature_count
+own_player_feature_dtypes = player_feature_dtypes + [U8] * 6 + [F32] + [F16] * 7 + collision_feature_dtypes * max_collisions
 def serialize_own_player(own_player: OwnPlayer):
     if own_player is None:
         return [0] * own_player_feature_count
@@ -102,14 +111,15 @@ def serialize_own_player(own_player: OwnPlayer):
         own_player.levelling.speed,
     ] + serialized_collisions
 
+ENEMY_TYPE_MAPPING = {
+    "wolf": 0,
+    "ghoul": 1,
+    "minotaur": 2,
+    "tiny": 3,
+}
 enemy_feature_count=12
+enemy_feature_dtypes = [F16] * 5 + [U8] * 5 + [F16, U8]
 def serialize_enemy(enemy: Enemy, center_pos: Position):
-    enemy_type_mapping = {
-        "wolf": 0,
-        "ghoul": 1,
-        "minotaur": 2,
-        "tiny": 3,
-    }
     """Convert enemy data to a flattened NumPy array."""
     return [
         # enemy.id,
@@ -124,22 +134,23 @@ def serialize_enemy(enemy: Enemy, center_pos: Position):
         int(enemy.is_pushed),
         int(enemy.is_zapped),
         enemy.points / MAX_SCORE,
-        enemy_type_mapping.get(enemy.type, 0)
+        ENEMY_TYPE_MAPPING.get(enemy.type, 0)
     ]
 
+GAME_STATE_MAPPING = {
+    "WAITING": 0,
+    "STARTING": 1,
+    "STARTED": 3,
+    "ENDING": 4,
+    "ENDED": 5,
+    "MATCH_COMPLETED": 6,
+}
 game_info_feature_count=6
+game_info_feature_dtypes = [U8, F32, F16, F32, U8, U8]
 def serialize_gameinfo(gameinfo: GameInfo):
-    game_state_mapping = {
-        "WAITING": 0,
-        "STARTING": 1,
-        "STARTED": 3,
-        "ENDING": 4,
-        "ENDED": 5,
-        "MATCH_COMPLETED": 6,
-    }
     """Convert gameinfo data to a flattened NumPy array."""
     return [
-        game_state_mapping.get(gameinfo.state, 0),
+        GAME_STATE_MAPPING.get(gameinfo.state, 0),
         string_to_int(gameinfo.map),
         gameinfo.time_remaining_s / 60,
         gameinfo.latency,
@@ -147,66 +158,84 @@ def serialize_gameinfo(gameinfo: GameInfo):
         1 if gameinfo.game_type == "rpg" else 0
     ]
 
+HAZARD_TYPE_MAPPING = {
+    "bomb": 0,
+    "icicle": 1,
+    "speed_zapper": 2,
+}
+HAZARD_STATUS_MAPPING = {
+    "idle": 0,
+    "charging": 1,
+    "active": 2,
+}
 hazard_feature_count=5
+hazard_feature_dtypes = [F16, F16, I8, F16, U8]
 def serialize_hazard(hazard: Hazard, center_pos: Position):
     """Convert hazard data to a flattened NumPy array."""
-    hazard_type_mapping = {
-        "bomb": 0,
-        "icicle": 1,
-        "speed_zapper": 2,
-    }
-    status_mapping = {
-        "idle": 0,
-        "charging": 1,
-        "active": 2,
-    }
     return [
         # hazard.id,
         serialize_position_x(hazard.position, center_pos),
         serialize_position_y(hazard.position, center_pos),
-        hazard_type_mapping.get(hazard.type, -1),
+        HAZARD_TYPE_MAPPING.get(hazard.type, -1),
         hazard.attack_damage / MAX_DAMAGE,
-        status_mapping.get(hazard.status, 0),
+        HAZARD_STATUS_MAPPING.get(hazard.status, 0),
     ]
 
 def string_to_int(s):
     encoded = base64.b64encode(s.encode()).hex()
     return int(encoded, 16)
 
+ITEM_TYPE_MAPPING = {
+    "big_potion": 0,
+    "speed_zapper": 1,
+    "ring": 2,
+    "chest": 3,
+    "coin": 4,
+    "power_up": 5,
+}
+ITEM_POWER_MAPPING = {
+    "bomb": 0,
+    "shockwave": 0,
+    "freeze": 0,
+}
 item_feature_count=6
+item_feature_dtypes = [F16, F16, I8, F16, F32, I8]
 def serialize_item(item: Item, center_pos: Position):
     """Convert item data to a flattened NumPy array."""
-    item_type_mapping = {
-        "big_potion": 0,
-        "speed_zapper": 1,
-        "ring": 2,
-        "chest": 3,
-        "coin": 4,
-        "power_up": 5,
-    }
-    power_mapping = {
-        "bomb": 0,
-        "shockwave": 0,
-        "freeze": 0,
-    }
     return [
         # item.id,
         serialize_position_x(item.position, center_pos),
         serialize_position_y(item.position, center_pos),
-        item_type_mapping.get(item.type, -1),
+        ITEM_TYPE_MAPPING.get(item.type, -1),
         item.points / MAX_SCORE,
         item.value,
-        power_mapping.get(item.power, -1),
+        ITEM_POWER_MAPPING.get(item.power, -1),
     ]
 
 obstacle_feature_count=2
+obstacle_feature_dtypes = [F16, F16]
 def serialize_obstacle(obstacle: Position, center_pos: Position):
     return [
         serialize_position_x(obstacle, center_pos),
         serialize_position_y(obstacle, center_pos),
     ]
 
+ORIGIN = Position(0, 0)
+
+# own absolute position, the reference of obstacles encoded in map coordinates
+anchor_feature_count=2
+anchor_feature_dtypes = [F32, F32]
+def serialize_anchor(position: Position):
+    return [
+        serialize_position_x(position, ORIGIN),
+        serialize_position_y(position, ORIGIN),
+    ]
+
+# obstacle clearance samples around the own position, see distance_field.DistanceField.encode
+clearance_feature_dtypes = [F16]
+
 stat_feature_count=14
+stat_feature_dtypes = [F32] + [F16] * 3 + [F32, F16] + [F32] * 3 + [F16] * 5
 def serialize_player_stat(stat: PlayerStat):
     return [
         string_to_int(stat.id),
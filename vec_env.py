@@ -0,0 +1,115 @@
+import asyncio
+from copy import deepcopy
+from typing import Any, List, Optional, Sequence
+
+import gymnasium as gym
+import numpy as np
+from stable_baselines3.common.vec_env.base_vec_env import VecEnv, VecEnvIndices, VecEnvStepReturn
+
+from env import CustomEnv, action_masks
+
+
+class GameVecEnv(VecEnv):
+    """
+    Vectorized env over N game servers that overlaps their round trips.
+
+    `step_async` queues all N moves at once, so each server hands its move to the
+    game on its next frame. `step_wait` then waits for all N following frames on a
+    single event loop and encodes them straight into a stacked observation buffer.
+    A vector step therefore costs about one frame latency instead of N.
+
+    :param num_envs: number of game servers, listening on `base_port`, `base_port + 1`, ...
+    :param base_port: port of the first server
+    :param env_kwargs: forwarded to every `CustomEnv`
+    """
+
+    def __init__(self, num_envs: int, base_port: int = 3000, **env_kwargs):
+        if env_kwargs.get("server_process"):
+            raise ValueError("GameVecEnv runs its servers in-process, server_process is not supported")
+        if env_kwargs.get("stack_dynamic_only") and env_kwargs.get("frame_stack", 1) > 1:
+            raise ValueError("GameVecEnv needs flat observations, stack_dynamic_only is not supported")
+        self.envs = [CustomEnv(port=base_port + i, **env_kwargs) for i in range(num_envs)]
+        env = self.envs[0]
+        super().__init__(num_envs, env.observation_space, env.action_space)
+        # all envs share the event loop of the current thread
+        self.loop = env.loop
+
+        self.buf_obs = np.zeros((self.num_envs, *env.observation_space.shape), dtype=env.observation_space.dtype)
+        self.buf_dones = np.zeros((self.num_envs,), dtype=bool)
+        self.buf_rews = np.zeros((self.num_envs,), dtype=np.float32)
+        self.buf_infos: List[dict] = [{} for _ in range(self.num_envs)]
+        self.metadata = env.metadata
+
+    def reset(self):
+        for i, env in enumerate(self.envs):
+            # seed the env's own RNG the way gym.Env.reset would
+            gym.Env.reset(env, seed=self._seeds[i])
+
+        async def reset_all():
+            return await asyncio.gather(*(
+                env.async_reset(seed=self._seeds[i], options=self._options[i] or None, out=self.buf_obs[i])
+                for i, env in enumerate(self.envs)
+            ))
+
+        for i, (_, info) in enumerate(self.loop.run_until_complete(reset_all())):
+            self.reset_infos[i] = info
+        # Seeds and options are only used once
+        self._reset_seeds()
+        self._reset_options()
+        return self.buf_obs.copy()
+
+    def step_async(self, actions: np.ndarray) -> None:
+        for env, action in zip(self.envs, actions):
+            env.send_action(int(action))
+
+    def step_wait(self) -> VecEnvStepReturn:
+        results = self.loop.run_until_complete(asyncio.gather(*(
+            env.receive_step(out=self.buf_obs[i]) for i, env in enumerate(self.envs)
+        )))
+
+        done_indices = []
+        for i, (_, reward, terminated, truncated, info) in enumerate(results):
+            self.buf_rews[i] = reward
+            self.buf_dones[i] = terminated or truncated
+            info["TimeLimit.truncated"] = truncated and not terminated
+            self.buf_infos[i] = info
+            if self.buf_dones[i]:
+                # save final observation where user can get it, then reset
+                info["terminal_observation"] = self.buf_obs[i].copy()
+                done_indices.append(i)
+
+        if done_indices:
+            async def reset_done():
+                return await asyncio.gather(*(self.envs[i].async_reset(out=self.buf_obs[i]) for i in done_indices))
+
+            for i, (_, info) in zip(done_indices, self.loop.run_until_complete(reset_done())):
+                self.reset_infos[i] = info
+
+        return self.buf_obs.copy(), np.copy(self.buf_rews), np.copy(self.buf_dones), deepcopy(self.buf_infos)
+
+    def action_masks(self) -> np.ndarray:
+        """Masks of the actions that would do something in each env's current state, shape (num_envs, actions)."""
+        return self.envs[0].mask_actions(action_masks([env.state.own_player for env in self.envs]))
+
+    def close(self) -> None:
+        for env in self.envs:
+            env.close()
+
+    def get_images(self) -> Sequence[Optional[np.ndarray]]:
+        return [None for _ in self.envs]
+
+    def get_attr(self, attr_name: str, indices: VecEnvIndices = None) -> List[Any]:
+        return [getattr(env, attr_name) for env in self._get_target_envs(indices)]
+
+    def set_attr(self, attr_name: str, value: Any, indices: VecEnvIndices = None) -> None:
+        for env in self._get_target_envs(indices):
+            setattr(env, attr_name, value)
+
+    def env_method(self, method_name: str, *method_args, indices: VecEnvIndices = None, **method_kwargs) -> List[Any]:
+        return [getattr(env, method_name)(*method_args, **method_kwargs) for env in self._get_target_envs(indices)]
+
+    def env_is_wrapped(self, wrapper_class: type[gym.Wrapper], indices: VecEnvIndices = None) -> List[bool]:
+        return [isinstance(env, wrapper_class) for env in self._get_target_envs(indices)]
+
+    def _get_target_envs(self, indices: VecEnvIndices) -> List[CustomEnv]:
+        return [self.envs[i] for i in self._get_indices(indices)]